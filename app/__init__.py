@@ -5,7 +5,7 @@ from flask_dynamodb_sessions import Session
 import logging
 
 from .config import USE_AWS
-from .data.user_management import login_manager
+from .data.user_management import login_manager, register_auth_metrics
 
 # this function sets up the logging configuration
 def setup_logging():
@@ -38,6 +38,13 @@ if USE_AWS:
 
 login_manager.init_app(application)
 
+# report user lookups (and how many came from the cache) in the Server-Timing header
+register_auth_metrics(application)
+
+# Flask routes that aren't part of the Dash app (e.g., serving local files)
+from .routes import register_routes
+register_routes(application)
+
 # Initialize Dash application with Flask as server
 app = dash.Dash(__name__, server=application, title="SegBuilder",
                 url_base_pathname='/segbuilder/', external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.BOOTSTRAP])
@@ -51,7 +51,7 @@ def register_auth_callbacks(app):
         # handle the actual password change
         elif callback_context.triggered_id == "change-password-button" and change_n and change_n > 0:
             
-            user_obj = load_user(username) 
+            user_obj = load_user(username, use_cache=False) 
             
             # verify current password
             if user_obj and user_obj.check_password(current_password):
@@ -115,7 +115,7 @@ def register_auth_callbacks(app):
             logging.debug("SBDEBUG: login button triggered")
 
             if (n_clicks and n_clicks > 0) or (username_submit_n and username_submit_n > 0) or (password_submit_n and password_submit_n > 0):
-                user = load_user(username)
+                user = load_user(username, use_cache=False)
                 if user and user.check_password(password):
 
                     logging.debug("SBDEBUG SESSION: setting session['username'] to %s",user.id)
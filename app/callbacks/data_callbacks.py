@@ -1,19 +1,17 @@
 from dash.dependencies import Input, Output, State, ALL
 import simplejson as json
 import datetime
-from dash import html, dcc, no_update
+from dash import html, no_update, ctx
 from dash.exceptions import PreventUpdate
-import shutil
 import cv2
 import base64
-import uuid
 import numpy as np
-import os
 import logging
+from flask import url_for
 
 from ..data import get_user_from_session
 from ..resources import get_db_item #get_dynamodb_resource
-from ..project_models import SB_project_image, SB_project
+from ..project_models import SB_project_image, start_export, get_export_job, artifact_is_reusable, invalidate_project_exports
 from ..resources import write_file
 
 def register_data_callbacks(app):
@@ -49,61 +47,79 @@ def register_data_callbacks(app):
 
 
     @app.callback(
-        Output('download-zipfile','data'),
+        Output('download-job','data'),
+        Output('download-poll-interval','disabled'),
+        Output('download-progress','value'),
+        Output('download-progress','label'),
+        Output('download-progress','style'),
+        Output('download-frame','src'),
         Input("download-button","n_clicks"),
+        Input("download-poll-interval","n_intervals"),
         State({'type': 'file-item-checklist', 'index': ALL}, 'value'),
         State({'type': 'file-item', 'index': ALL}, 'children'),
         State('selected-project','data'),
+        State('download-job','data'),
         prevent_initial_call = True
     )
-    def initiate_download(n,filename_checklist_values,filenames,project_name):
+    def handle_download(n,n_intervals,filename_checklist_values,filenames,project_name,job_id):
         """
-        Callback to handle the initiation of a zip file download for the current project's selected
-         files that are stored on the server.
+        Callback to handle the zip file download for the current project's selected files that are
+        stored on the server.
+
+        Clicking 'Download' starts a background export job (or reuses a running or recently finished one
+        for the same selection), and the poll interval then checks on the job until it is done. The finished
+        zip file is loaded into a hidden frame so the browser saves it. If the project was saved to while the
+        job was running, its zip file is out of date, so the job is started again.
 
         Outputs:
-        - download-zipfile: Data for the downloadable zip file containing the project's files.
+        - download-job: The id of the export job for the current download.
+        - download-poll-interval (disabled): Whether polling for the job's progress is turned off.
+        - download-progress (value, label, style): The progress bar showing how far along the job is.
+        - download-frame: URL of the finished zip file.
 
         Inputs:
         - download-button (n): Number of clicks on the 'Download' button.
+        - download-poll-interval (n_intervals): Ticks of the timer that polls the job.
 
         States:
         - file-item-checklist (filename_checklist_values): Values indicating which files are selected for download.
         - file-item (filenames): The names of the files available for selection.
         - selected-project (project_name): The name of the current project.
+        - download-job (job_id): The id of the export job being polled.
         """
-        logging.debug("DOWNLOADDEBUG: in initiate_download, nclicks: %s",n)
-        logging.debug("DOWNLOADDEBUG: filename_checklist_values: %s",filename_checklist_values)
-        logging.debug("DOWNLOADDEBUG: filenames: %s",filenames)
         username = get_user_from_session()
         if not username:
             raise PreventUpdate
-        
-        # Initialize a list to store the files to be downloaded
-        download_files = []
-        # Iterate through the checklist values to determine which files are selected
-        for idx in range(len(filename_checklist_values)):
-            if filename_checklist_values[idx] != []:
-                download_files.append(filenames[idx])
-
-        logging.debug("DOWNLOADDEBUG: download_files %s",download_files)
-
-        # Create a project instance for the user and project name
-        project = SB_project(username,project_name)
-
-        # Generate a unique filename for the temporary zip file on the server
-        unique_filename = str(uuid.uuid4()) + '.zip'
-
-        # Prepare the zip file for download
-        zipfile_path = project.prepare_download(download_files,unique_filename)
-        logging.debug("DOWNLOADDEBUG: zip created")
-        try:
-            # send the file as a download
-            return dcc.send_file(zipfile_path,filename=project_name+".zip")
-        finally:
-            # Clean up the temporary zip file and directory
-            os.remove(zipfile_path)
-            shutil.rmtree(os.path.join("tmp/",username))
+
+        if ctx.triggered_id == "download-button":
+            logging.debug("DOWNLOADDEBUG: in handle_download, nclicks: %s",n)
+            logging.debug("DOWNLOADDEBUG: filename_checklist_values: %s",filename_checklist_values)
+            logging.debug("DOWNLOADDEBUG: filenames: %s",filenames)
+
+            # Initialize a list to store the files to be downloaded
+            download_files = []
+            # Iterate through the checklist values to determine which files are selected
+            for idx in range(len(filename_checklist_values)):
+                if filename_checklist_values[idx] != []:
+                    download_files.append(filenames[idx])
+
+            logging.debug("DOWNLOADDEBUG: download_files %s",download_files)
+            job_id = start_export(username,project_name,download_files)
+
+        job = get_export_job(job_id) if job_id else None
+        if job is None or job["username"] != username:
+            return None, True, 0, "", {"display":"none"}, no_update
+        if job["status"] == "running":
+            progress = int(job.get("progress",0))
+            return job_id, False, progress, "Preparing download... {}%".format(progress), {}, no_update
+        if job["status"] == "failed":
+            return None, True, 100, "Download failed: {}".format(job.get("error")), {}, no_update
+        if not artifact_is_reusable(job):
+            job_id = start_export(username,job["project"],job["files"])
+            return job_id, False, 0, "Preparing download... 0%", {}, no_update
+
+        # the click count keeps the URL changing, so downloading the same selection again reloads the frame
+        return None, True, 100, "Download ready", {}, url_for("download_export",export_id=job_id,n=n)
 
 
     @app.callback(Output('upload-notify', 'children'),
@@ -156,6 +172,9 @@ def register_data_callbacks(app):
                         img_bytes = base64.b64decode(data)
 
                         write_file(filename_on_server,img_bytes)
+                        invalidate_project_exports(username,selected_project)
+                        # the mask card thumbnails of a replaced image show the old picture
+                        SB_project_image(username,selected_project,name).delete_mask_thumbnails()
 
                         # Convert bytes to a numpy array
                         nparr = np.frombuffer(img_bytes, np.uint8)
@@ -172,6 +191,10 @@ def register_data_callbacks(app):
                         filename_on_server = "image_masks/"+username+"/"+selected_project+"/"+name
                         try:
                             write_file(filename_on_server,base64.b64decode(data))
+                            invalidate_project_exports(username,selected_project)
+                            # the archive's masks have all been replaced, so their thumbnails go too
+                            # (thumbnails are kept by file prefix, which the archive is named after)
+                            SB_project_image(username,selected_project,name[:-len(".sgbdi")]).delete_mask_thumbnails()
                             # add success message to notifications
                             children.append(html.Div('SegBuilder Archive File "{}" uploaded successfully.'.format(name)))
                         except Exception as e: 
@@ -224,6 +247,8 @@ def register_data_callbacks(app):
             image_obj.update_archive(old_mask_labels,new_masks,new_mask_labels)
             # save the composite mask image to storage 
             image_obj.save_segmented_image(segmented_image)
+            # finished downloads of this project are out of date now
+            invalidate_project_exports(username,selected_project)
             message = str(selected_image)+" saved "+str(datetime.datetime.now())
             return message, True
         return "not saved recently", False
@@ -8,7 +8,6 @@ import io
 from dash.exceptions import PreventUpdate
 import re
 import plotly.express as px
-import numpy as np
 import logging
 import cv2
 import plotly.graph_objs as go
@@ -16,8 +15,8 @@ import plotly.graph_objs as go
 from ..data import get_user_from_session
 #from ..resources import get_dynamodb_resource
 from ..project_models import SB_project_image
-from ..utils import populate_files, create_mask_cards, hex_to_rgb, make_composite_image, create_mask_from_paths, add_meta_info_to_masks, contours_from_mask, plotly_shapes_from_contours, get_label_options, get_label_colors_dict,  generate_label_cards
-from ..resources import get_db_item, put_db_item
+from ..utils import populate_files, create_mask_cards, hex_to_rgb, make_composite_image, composite_masks, create_mask_from_paths, add_meta_info_to_masks, contours_from_mask, plotly_shapes_from_contours, get_label_options, get_label_colors_dict,  generate_label_cards
+from ..resources import put_db_item, append_to_db_list
 
 CANVAS_WIDTH = 600
 
@@ -135,15 +134,8 @@ def register_ui_callbacks(app):
         elif callback_context.triggered_id == "new-class-label-button":
             if n_clicks:
 
-                # get the current label-color scheme from the database
-                db_label_records = get_db_item(table_name="project-classes",key_name="username-projectname",key_value=(username+"-"+project_name),default_return=[])
-                label_records = db_label_records["classes"]
-
-                # add the new label-color pair onto the list
-                label_records.append({"name":new_label,"color":hex_to_rgb(new_color)})
-
-                # put the updated list back in the database
-                put_db_item(table_name="project-classes",key_name="username-projectname",key_value=(username+"-"+project_name),item_name="classes",item_value=label_records)
+                # add the new label-color pair onto the project's list in the database
+                append_to_db_list(table_name="project-classes",key_name="username-projectname",key_value=(username+"-"+project_name),item_name="classes",value={"name":new_label,"color":hex_to_rgb(new_color)})
 
                 label_cards = generate_label_cards(username,project_name)
                 return label_cards, no_update, no_update
@@ -208,21 +200,14 @@ def register_ui_callbacks(app):
         
         # handle if the user creates a new project - switch to the classes tab
         elif callback_context.triggered_id == "create-project-button" and create_project_n_clicks:
-            #!!TODO: check if project name already exists
             if new_project_name == "" or not re.match(r'^[A-Za-z][A-Za-z0-9_]*$',new_project_name):
                 return no_update, no_update, no_update, no_update, no_update, {"display":"block"}, no_update
+            # add this new project name to the user's list of projects in the database
+            # (in one conditional update, which fails if a project with this name already exists)
+            elif not append_to_db_list(table_name="projects",key_name="username",key_value=username,item_name="projects",value=new_project_name,unique=True):
+                return no_update, no_update, no_update, no_update, no_update, {"display":"block"}, no_update
             else:
 
-                # get the current list of projects from the databse
-                projects_db_item = get_db_item(table_name="projects",key_name="username",key_value=username,default_return={"projects":[]})
-                curr_projects = projects_db_item["projects"]
-                
-                # add this new project name to that list
-                curr_projects.append(new_project_name)
-
-                # update the projects list in the database with the newly embiggened list
-                put_db_item(table_name="projects",key_name="username",key_value=username,item_name="projects",item_value=curr_projects)
-
                 # initialize the class labels so there is one label called "unlabeled" assigned the color black
                 # and then put it into the project-classes database for this project
                 project_init_classes = [{"name": "unlabeled","color": [0,0,0]}]
@@ -341,13 +326,14 @@ def register_ui_callbacks(app):
 
             # Load the image and the mask to move
             image = image_obj.load_image()
-            mask_to_move = image_obj.load_masks()[mask_num]
+            mask_to_move = image_obj.load_mask(mask_num)
 
             # Get label options for the project
             label_options = get_label_options(username,selected_project)
 
             # Create a new mask card for the mask to move
-            new_card = create_mask_cards(image,[mask_to_move],[curr_labels[mask_num]],label_options=label_options,new_masks=True,index_offset=len(current_new_masks_display))
+            new_card = create_mask_cards(image,[mask_to_move],[curr_labels[mask_num]],label_options=label_options,new_masks=True,index_offset=len(current_new_masks_display),
+                                         thumbnails_dir=image_obj.get_mask_thumbnails_dir(),mask_hashes=[image_obj.mask_hash(mask_num)],image_hash=image_obj.get_image_hash())
 
             # Reset the click state of the delete buttons
             delete_clicks = [None]*len(n_clicks)
@@ -390,7 +376,7 @@ def register_ui_callbacks(app):
 
             # Load the mask to be edited
             image_obj = SB_project_image(username,selected_project,selected_image_name)
-            mask_to_edit = image_obj.load_masks()[mask_num]
+            mask_to_edit = image_obj.load_mask(mask_num)
 
             # Convert the mask segmentation data into contours
             contours = contours_from_mask(mask_to_edit["segmentation"])
@@ -485,7 +471,8 @@ def register_ui_callbacks(app):
                     masks = image_obj.load_masks()
                     labels = image_obj.load_labels()
                     label_options = get_label_options(username,selected_project)
-                    display_cards = create_mask_cards(image,masks,labels,label_options=label_options)
+                    display_cards = create_mask_cards(image,masks,labels,label_options=label_options,
+                                                      thumbnails_dir=image_obj.get_mask_thumbnails_dir(),mask_hashes=image_obj.mask_hashes(),image_hash=image_obj.get_image_hash())
                     fig_image = px.imshow(image)
                     fig_image.update_layout(dragmode="drawclosedpath",
                                             width=CANVAS_WIDTH,
@@ -544,33 +531,22 @@ def register_ui_callbacks(app):
             image = image_obj.load_image()
             masks = image_obj.load_masks()
             logging.debug("masks loaded")
-            mask_image = np.zeros_like(image)
             label_colors_dict = get_label_colors_dict(username,selected_project)
-            
-            # loop through the masks from back to front
-            for i in range(len(masks)-1,-1,-1):
-                
-                curr_label = labels[i]
-                
-                # skip over deleted masks
-                if curr_label != "DELETE":
-                    curr_mask = np.array(masks[i]["segmentation"])
-                    
-                    color = label_colors_dict[curr_label]
-                    colored_mask = np.zeros_like(image)
-                    colored_mask[curr_mask > 0] = color
-                    mask_image = np.where(curr_mask[..., np.newaxis] > 0, colored_mask, mask_image)
 
-            # check if there are any masks in the "new mask" area and loop through them backwards
-            if current_new_masks:
-                for i in range(len(current_new_masks)-1,-1,-1):
-                    curr_label = new_labels[i]
-                    if curr_label != "DELETE":
-                        curr_mask = np.array(current_new_masks[i]["segmentation"])
-                        color = label_colors_dict[curr_label]
-                        colored_mask = np.zeros_like(image)
-                        colored_mask[curr_mask > 0] = color
-                        mask_image = np.where(curr_mask[..., np.newaxis] > 0, colored_mask, mask_image)
+            # the masks from front to back: the "new mask" area is in front of the existing masks,
+            # and the first mask in each list is the front-most one. Masks are only decoded when the
+            # compositor gets to them, and deleted masks are skipped over
+            def mask_layers():
+                if current_new_masks:
+                    for i in range(len(current_new_masks)):
+                        if new_labels[i] != "DELETE":
+                            yield current_new_masks[i]["segmentation"], label_colors_dict[new_labels[i]], None
+                mask_bboxes = [meta["bbox"] for meta in image_obj.mask_metadata()]
+                for i in range(len(masks)):
+                    if labels[i] != "DELETE":
+                        yield masks[i]["segmentation"], label_colors_dict[labels[i]], mask_bboxes[i]
+
+            mask_image = composite_masks(mask_layers(), image.shape).astype(image.dtype)
 
             # generate the composite image from the combined mask image and the original image
             composite_image, segmented_image = make_composite_image(image,mask_image)
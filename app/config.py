@@ -6,4 +6,73 @@ import os
 
 USE_AWS = os.getenv('USE_AWS', 'False') == 'True'
 LOCAL_FOLDER = os.getenv('LOCAL_FOLDER', 'local_storage')
-LOCAL_DB_FILE = os.getenv('LOCAL_DB_FILE', 'local_db.json')
\ No newline at end of file
+LOCAL_DB_FILE = os.getenv('LOCAL_DB_FILE', 'local_db.json')
+
+# the local stand-in for DynamoDB - either "json" (the LOCAL_DB_FILE file) or "sqlite" (the LOCAL_SQLITE_DB_FILE
+# database, which is safe to use from several worker processes). The SQLite database copies in the contents
+# of the JSON database (LOCAL_DB_FILE and its log) the first time it is opened.
+LOCAL_DB_BACKEND = os.getenv('LOCAL_DB_BACKEND', 'json')
+LOCAL_SQLITE_DB_FILE = os.getenv('LOCAL_SQLITE_DB_FILE', 'local_db.sqlite3')
+
+# the JSON local database is kept in memory and changes are appended to a log file (LOCAL_DB_WAL_FILE),
+# which is folded back into LOCAL_DB_FILE once it grows past LOCAL_DB_WAL_MAX_BYTES
+LOCAL_DB_WAL_FILE = os.getenv('LOCAL_DB_WAL_FILE', LOCAL_DB_FILE + '.wal')
+LOCAL_DB_WAL_MAX_BYTES = int(os.getenv('LOCAL_DB_WAL_MAX_BYTES', str(1024*1024)))
+
+# S3 client tuning - the client is built once per process and shared between threads,
+# so the connection pool should be at least as large as the number of worker threads
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '50'))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '3'))
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', '5'))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', '60'))
+
+# in-process cache of file contents read from storage (bytes) - set to 0 to disable
+FILE_CACHE_MAX_BYTES = int(os.getenv('FILE_CACHE_MAX_BYTES', str(256*1024*1024)))
+
+# in-process cache of decoded images and unpacked masks (numpy arrays) - set to 0 to disable
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(1024*1024*1024)))
+
+# how long (in seconds) a project's class scheme read from the database is reused across requests - set to 0 to disable.
+# Writes made by this process are seen immediately, writes from other worker processes after at most this long.
+PROJECT_CLASSES_CACHE_TTL = float(os.getenv('PROJECT_CLASSES_CACHE_TTL', '5'))
+
+# how long (in seconds) a user loaded from the users table is reused for, and how many users are kept - set the TTL
+# to 0 to disable. A password changed on another worker process can take this long to be picked up there
+# (logging in always checks the password against the database).
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', '10000'))
+
+# how long (in seconds) a cached directory listing is trusted for - set to 0 to disable
+LISTING_CACHE_TTL = float(os.getenv('LISTING_CACHE_TTL', '60'))
+
+# the maximum number of directory listings kept in the listing cache
+LISTING_CACHE_MAX_ENTRIES = int(os.getenv('LISTING_CACHE_MAX_ENTRIES', '10000'))
+
+# project cards: how many cover images to fetch at once, and the size (in pixels) of the cover thumbnails
+COVER_IMAGE_WORKERS = int(os.getenv('COVER_IMAGE_WORKERS', '8'))
+COVER_THUMBNAIL_SIZE = int(os.getenv('COVER_THUMBNAIL_SIZE', '288'))
+
+# how long (in seconds) browsers may cache a versioned local-mode file URL
+LOCAL_FILE_MAX_AGE = int(os.getenv('LOCAL_FILE_MAX_AGE', str(365*24*60*60)))
+
+# presigned S3 URLs are valid for PRESIGNED_URL_EXPIRY seconds and are reused until
+# PRESIGNED_URL_REFRESH_MARGIN seconds before they expire, so repeated renders produce the same URL
+PRESIGNED_URL_EXPIRY = int(os.getenv('PRESIGNED_URL_EXPIRY', '3600'))
+PRESIGNED_URL_REFRESH_MARGIN = int(os.getenv('PRESIGNED_URL_REFRESH_MARGIN', '300'))
+
+# mask cards: how many threads render card thumbnails (shared by every request), how many cards a single
+# request renders at once, and the image format of the thumbnails ("png", "jpeg", or "webp")
+CARD_RENDER_WORKERS = int(os.getenv('CARD_RENDER_WORKERS', str(os.cpu_count() or 4)))
+CARD_RENDER_CONCURRENCY = int(os.getenv('CARD_RENDER_CONCURRENCY', str(CARD_RENDER_WORKERS)))
+CARD_IMAGE_FORMAT = os.getenv('CARD_IMAGE_FORMAT', 'png').lower()
+
+# how many files a project download fetches from storage at once
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '8'))
+
+
+# project downloads are built by background export jobs - how many can run at once, how long
+# (in seconds) a finished download is kept so that downloading the same selection again reuses it,
+# and how often (in seconds) each worker process looks for expired downloads to delete
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '2'))
+EXPORT_ARTIFACT_TTL = int(os.getenv('EXPORT_ARTIFACT_TTL', '3600'))
+EXPORT_SWEEP_INTERVAL = int(os.getenv('EXPORT_SWEEP_INTERVAL', '600'))
\ No newline at end of file
@@ -1,2 +1,2 @@
 from .session_management import get_user_from_session
-from .user_management import User, load_user, change_password_in_db
\ No newline at end of file
+from .user_management import User, load_user, change_password_in_db, get_auth_lookup_stats, register_auth_metrics
\ No newline at end of file
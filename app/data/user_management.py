@@ -1,15 +1,27 @@
 from flask_login import UserMixin, LoginManager
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import current_app
+from flask import current_app, g, has_request_context, request
 from botocore.exceptions import ClientError
 import logging
+import threading
+import time
 logging.basicConfig(filename='/app/logs/app.log', level=logging.DEBUG)
 
-from ..resources import get_db_item, update_db_item
+from ..resources import get_db_item, update_db_item, TTLCache
+from ..config import USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES
 
 # Flask-Login manager
 login_manager = LoginManager()
 
+# Flask-Login can call load_user on every request, so users are cached by username for USER_CACHE_TTL seconds.
+# change_password_in_db drops the cached user.
+user_cache = TTLCache(USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES)
+
+# Counters for user lookups: per request (in flask.g, reported in the Server-Timing header - see
+# register_auth_metrics) and in total for the process (see get_auth_lookup_stats)
+_auth_lookup_totals = {"lookups": 0, "cache_hits": 0, "db_seconds": 0.0}
+_auth_lookup_totals_lock = threading.Lock()
+
 class User(UserMixin):
     """
     User class for managing user authentication.
@@ -44,33 +56,91 @@ class User(UserMixin):
 
 #def load_user(username,get_response_item=False):
 @login_manager.user_loader
-def load_user(username):
+def load_user(username, use_cache=True):
     """
     Load a user by username.
 
     This function is used by Flask-Login to retrieve a user object based on the username.
+    Users are served from the user cache when possible.
 
     :param username: The username to load.
+    :param use_cache: Whether a cached user can be returned (False always reads the database, e.g. when checking a password at login).
     :return: The User object if found, None otherwise.
     """
     logging.debug("LOADUSER: username,  %s,  %s",username,type(username))
 
+    if use_cache:
+        user = user_cache.get(username)
+        if user is not None:
+            _record_auth_lookup(cache_hit=True, db_seconds=0.0)
+            return user
+
+    start_time = time.perf_counter()
     try:
         password_item = get_db_item(table_name="users",key_name="username",key_value=username)
         logging.debug("LOADUSER: password_item, %s",password_item)
     except ClientError as e:
         logging.debug("%s",e.response['Error']['Message'])
         return None
+    finally:
+        _record_auth_lookup(cache_hit=False, db_seconds=time.perf_counter()-start_time)
+
+    if isinstance(password_item,dict) and "password" in password_item:
+        # password_item["password"] is actually a password hash
+        user = User(username, password_item["password"])
+        user_cache.put(username, user)
+        return user
     else:
-
-        if isinstance(password_item,dict) and "password" in password_item:
-            # password_item["password"] is actually a password hash
-            return User(username, password_item["password"])
-        else:
-            return None
+        return None
     #return users.get(username)
 
 
+def _record_auth_lookup(cache_hit, db_seconds):
+    """
+    Count one user lookup for the current request and for the process.
+
+    :param cache_hit: Whether the user came from the cache.
+    :param db_seconds: How long the database read took (0 for cache hits).
+    """
+    with _auth_lookup_totals_lock:
+        _auth_lookup_totals["lookups"] += 1
+        _auth_lookup_totals["cache_hits"] += int(cache_hit)
+        _auth_lookup_totals["db_seconds"] += db_seconds
+    if has_request_context():
+        g.auth_lookups = g.get("auth_lookups", 0) + 1
+        g.auth_lookup_cache_hits = g.get("auth_lookup_cache_hits", 0) + int(cache_hit)
+        g.auth_lookup_db_seconds = g.get("auth_lookup_db_seconds", 0.0) + db_seconds
+
+
+def get_auth_lookup_stats():
+    """
+    Get the user lookup counters for this process.
+
+    :return: A dictionary with the total number of "lookups", how many were "cache_hits",
+        and the total time spent reading the database ("db_seconds").
+    """
+    with _auth_lookup_totals_lock:
+        return dict(_auth_lookup_totals)
+
+
+def register_auth_metrics(server):
+    """
+    Report each request's user lookups in a Server-Timing response header (visible in the
+    browser's developer tools) and in the debug log.
+
+    :param server: The Flask application.
+    """
+    @server.after_request
+    def add_auth_timing(response):
+        lookups = g.get("auth_lookups", 0)
+        if lookups:
+            cache_hits = g.get("auth_lookup_cache_hits", 0)
+            db_ms = g.get("auth_lookup_db_seconds", 0.0)*1000
+            response.headers.add("Server-Timing", 'auth;desc="{} user lookups, {} cached";dur={:.1f}'.format(lookups, cache_hits, db_ms))
+            logging.debug("AUTHTIMING: %s user lookups (%s cached, %.1f ms in the database) for %s", lookups, cache_hits, db_ms, request.path)
+        return response
+
+
 def change_password_in_db(username, new_password):
     """
     Change the user's password in the database.
@@ -88,5 +158,7 @@ def change_password_in_db(username, new_password):
     except ClientError as e:
         print(e.response['Error']['Message'])
         return False
+    finally:
+        user_cache.invalidate(username)
 
     return True
\ No newline at end of file
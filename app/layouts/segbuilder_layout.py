@@ -24,7 +24,7 @@ def get_segbuilder_layout():
                     dbc.ModalBody([
                         dbc.Label("Project name (no spaces)"),
                         dbc.Input(type="text",id="create-project-name-input"),
-                        html.Div(dbc.FormText("Project names must start with a letter and contain only letters, numbers, and underscores.",color="danger"),id="create-new-project-name-message",style={"display":"none"})
+                        html.Div(dbc.FormText("Project names must be new, start with a letter, and contain only letters, numbers, and underscores.",color="danger"),id="create-new-project-name-message",style={"display":"none"})
                     ]),
                     dbc.ModalFooter(
                         dbc.Button("Create",id="create-project-button",color="primary")
@@ -98,7 +98,11 @@ def get_segbuilder_layout():
             ),
             dbc.Button(html.I(className="bi bi-arrow-repeat"),id="refresh-button",color="primary"),
             dbc.Button(dbc.Spinner("Download"),id="download-button",color="primary"),
-            html.Div(dbc.Spinner(dcc.Download(id="download-zipfile"),color="primary")),
+            # the download is built by a background export job, and the interval polls its progress
+            dbc.Progress(id="download-progress",value=0,label="",style={"display":"none"}),
+            dcc.Interval(id="download-poll-interval",interval=1000,disabled=True),
+            # the finished download is loaded into this hidden frame, which makes the browser save it as a file
+            html.Iframe(id="download-frame",style={"display":"none"}),
 
             dcc.Checklist(options=[" Select all"],value=[],id='select-all-checklist'),
             dbc.Toast(id="upload-notify",header="File uploaded",dismissable=True,is_open=False,style={"position": "fixed", "top": 66, "right": 10},),
@@ -140,5 +144,6 @@ def get_segbuilder_layout():
         dcc.Store(id="mask-move-to-front"), # the mask that goes along with the data being moved to the front
         dcc.Store(id="edit-button-polygon-data"), # polygon data converted from an existing mask
         dcc.Store(id="new-project-has-been-created"), # a flag to indicate if the user just created a new project
+        dcc.Store(id="download-job"), # the id of the export job building the current download
     ])
 
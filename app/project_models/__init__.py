@@ -1 +1,2 @@
-from .project_management import SB_project, SB_project_image
\ No newline at end of file
+from .project_management import SB_project, SB_project_image
+from .export_jobs import start_export, get_export_job, artifact_is_reusable, invalidate_project_exports
\ No newline at end of file
@@ -0,0 +1,319 @@
+import gzip
+import hashlib
+import json
+import pickle
+import struct
+import zlib
+from collections.abc import Sequence
+
+import numpy as np
+
+# Reading and writing SegBuilder archives (.sgbdi files).
+#
+# Version 1 archives are gzipped pickles of a dictionary like
+#     {"image": <RGB numpy array>, "masks": [{"segmentation": <dense HxW array>, ...}, ...], "labels": [...]}
+# so every mask has to be decompressed and unpickled to get at any one of them.
+#
+# Version 2 archives are laid out as
+#     ARCHIVE_MAGIC | header length (4 bytes, big-endian) | JSON header | payload
+# The header holds the mask shape, the labels and an index with one entry per mask
+# (offset and length into the payload, bbox, area, label and any extra per-mask metadata).
+# Each mask's payload is its bounding-box crop, bit-packed and zlib-compressed, so a single
+# mask can be decoded without touching the others.
+# The source image is normally not stored in the archive - the header's "image" entry just
+# references it by filename and SHA-256 of the image file. Self-contained archives (used for
+# downloads) also embed the original image file bytes in the payload.
+# Version 1 archives are still read transparently; everything written is version 2.
+
+ARCHIVE_MAGIC = b"SGBDI\x02"
+ARCHIVE_VERSION = 2
+_HEADER_LENGTH = struct.Struct(">I")
+
+
+def _to_json_safe(value):
+    """
+    Convert per-mask metadata (which often contains numpy values) into plain JSON types.
+
+    :param value: The value to convert.
+    :return: The value using only dicts, lists, strings, numbers, booleans, and None.
+    """
+    if isinstance(value, dict):
+        return {str(k): _to_json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_safe(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _bounding_box(segmentation):
+    """
+    Find the bounding box of the True pixels in a mask.
+
+    :param segmentation: The mask as a 2D boolean array.
+    :return: The bounding box as [x, y, width, height] ([0, 0, 0, 0] for an empty mask).
+    """
+    rows = np.flatnonzero(segmentation.any(axis=1))
+    if rows.size == 0:
+        return [0, 0, 0, 0]
+    cols = np.flatnonzero(segmentation.any(axis=0))
+    return [int(cols[0]), int(rows[0]), int(cols[-1]) - int(cols[0]) + 1, int(rows[-1]) - int(rows[0]) + 1]
+
+
+def encode_mask(mask):
+    """
+    Encode one mask for a version 2 archive.
+
+    :param mask: A mask dictionary with a "segmentation" entry (a 2D boolean array or nested list)
+        and optionally other metadata such as SAM's predicted_iou.
+    :return: A tuple (entry, payload) where entry is the mask's index entry without its
+        offset/length and payload is the compressed bytes.
+    """
+    segmentation = np.asarray(mask["segmentation"]).astype(bool)
+    bbox = _bounding_box(segmentation)
+    x, y, width, height = bbox
+    payload = zlib.compress(np.packbits(segmentation[y:y+height, x:x+width]).tobytes()) if width else b""
+    entry = {
+        "shape": list(segmentation.shape),
+        "bbox": bbox,
+        "area": int(np.count_nonzero(segmentation)),
+        "meta": _to_json_safe({k: v for k, v in mask.items() if k != "segmentation"}),
+    }
+    return entry, payload
+
+
+def decode_mask(entry, payload, shape):
+    """
+    Decode one mask from a version 2 archive.
+
+    :param entry: The mask's index entry.
+    :param payload: The mask's compressed bytes.
+    :param shape: The (height, width) of the mask.
+    :return: The mask as a full-size boolean NumPy array.
+    """
+    segmentation = np.zeros(shape, dtype=bool)
+    x, y, w, h = entry["bbox"]
+    if w and h:
+        bits = np.unpackbits(np.frombuffer(zlib.decompress(payload), dtype=np.uint8), count=w * h)
+        segmentation[y:y + h, x:x + w] = bits.reshape(h, w).astype(bool)
+    return segmentation
+
+
+def image_sha256(image_bytes):
+    """
+    Get the content hash used to reference a source image from an archive.
+
+    :param image_bytes: The image file content.
+    :return: The SHA-256 hex digest of the content.
+    """
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def write_archive(encoded_masks, labels, shape, image_filename=None, image_hash=None, embedded_image=None):
+    """
+    Build a version 2 archive.
+
+    :param encoded_masks: A list of (entry, payload) tuples as returned by encode_mask or MaskArchive.encoded_mask.
+    :param labels: The list of labels, one per mask.
+    :param shape: The (height, width) shared by every mask.
+    :param image_filename: The filename of the source image the masks belong to.
+    :param image_hash: The SHA-256 hex digest of the source image file.
+    :param embedded_image: The source image file content to embed (for self-contained archives), or None.
+    :return: The archive as bytes.
+    """
+    index = []
+    payloads = []
+    offset = 0
+    for mask_num, (entry, payload) in enumerate(encoded_masks):
+        if entry["shape"] != list(shape):
+            raise ValueError("mask {} has shape {}, expected {}".format(mask_num, entry["shape"], list(shape)))
+        index_entry = {k: v for k, v in entry.items() if k != "shape"}
+        index_entry["offset"] = offset
+        index_entry["length"] = len(payload)
+        index_entry["label"] = labels[mask_num] if mask_num < len(labels) else None
+        index.append(index_entry)
+        payloads.append(payload)
+        offset += len(payload)
+
+    header = {"version": ARCHIVE_VERSION, "shape": list(shape), "labels": list(labels), "masks": index}
+    if image_filename is not None or image_hash is not None:
+        header["image"] = {"filename": image_filename, "sha256": image_hash}
+        if embedded_image is not None:
+            header["image"]["offset"] = offset
+            header["image"]["length"] = len(embedded_image)
+            payloads.append(embedded_image)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([ARCHIVE_MAGIC, _HEADER_LENGTH.pack(len(header_bytes)), header_bytes] + payloads)
+
+
+class MaskArchive:
+    """
+    Read-only view of a SegBuilder archive (either version).
+
+    For version 2 archives only the header is parsed up front; masks are decoded one at
+    a time when they are asked for. Version 1 archives have to be unpacked completely.
+
+    Attributes:
+    - version (int): The archive format version.
+    - shape (tuple): The (height, width) of the masks, or None if there are no masks.
+    - labels (list): The labels of the masks.
+    - nbytes (int): Approximate memory used by this object.
+    """
+    def __init__(self, data):
+        """
+        Initialize a new MaskArchive from the raw bytes of an .sgbdi file.
+
+        :param data: The archive file content.
+        """
+        self.__mask_hashes = {}
+        if data[:len(ARCHIVE_MAGIC)] == ARCHIVE_MAGIC:
+            header_start = len(ARCHIVE_MAGIC) + _HEADER_LENGTH.size
+            (header_length,) = _HEADER_LENGTH.unpack_from(data, len(ARCHIVE_MAGIC))
+            header = json.loads(data[header_start:header_start + header_length].decode("utf-8"))
+            self.version = header["version"]
+            self.shape = tuple(header["shape"])
+            self.labels = header["labels"]
+            self.__index = header["masks"]
+            self.__header = header
+            self.__payload = memoryview(data)[header_start + header_length:]
+            self.__dense_masks = None
+            self.nbytes = len(data)
+        else:
+            unpacked = pickle.loads(gzip.decompress(data))
+            self.version = 1
+            self.labels = unpacked["labels"]
+            self.__index = None
+            self.__header = None
+            self.__payload = None
+            #need to make the segments back into numpy arrays instead of lists
+            self.__dense_masks = unpacked["masks"]
+            for mask in self.__dense_masks:
+                mask["segmentation"] = np.array(mask["segmentation"])
+            self.shape = self.__dense_masks[0]["segmentation"].shape if self.__dense_masks else None
+            self.nbytes = sum(mask["segmentation"].nbytes for mask in self.__dense_masks)
+
+    def __len__(self):
+        if self.__dense_masks is not None:
+            return len(self.__dense_masks)
+        return len(self.__index)
+
+    def __mask_payload(self, mask_num):
+        entry = self.__index[mask_num]
+        return bytes(self.__payload[entry["offset"]:entry["offset"] + entry["length"]])
+
+    def load_mask(self, mask_num):
+        """
+        Decode a single mask.
+
+        :param mask_num: The index of the mask.
+        :return: A mask dictionary with a "segmentation" boolean array plus any stored metadata.
+        """
+        if self.__dense_masks is not None:
+            return dict(self.__dense_masks[mask_num])
+        entry = self.__index[mask_num]
+        mask = dict(entry.get("meta", {}))
+        mask["segmentation"] = decode_mask(entry, self.__mask_payload(mask_num), self.shape)
+        return mask
+
+    def encoded_mask(self, mask_num):
+        """
+        Get a mask in the form write_archive expects, without decoding it if possible.
+
+        :param mask_num: The index of the mask.
+        :return: A tuple (entry, payload).
+        """
+        if self.__dense_masks is not None:
+            return encode_mask(self.__dense_masks[mask_num])
+        entry = {k: v for k, v in self.__index[mask_num].items() if k not in ("offset", "length", "label")}
+        entry["shape"] = list(self.shape)
+        return entry, self.__mask_payload(mask_num)
+
+    def mask_metadata(self, mask_num):
+        """
+        Get a mask's area, bounding box, and label without decoding the mask.
+
+        Version 2 archives have these in their index. Version 1 masks are already decoded,
+        so they are measured directly.
+
+        :param mask_num: The index of the mask.
+        :return: A dictionary with "area", "bbox" ([x, y, width, height]), and "label".
+        """
+        label = self.labels[mask_num] if mask_num < len(self.labels) else None
+        if self.__dense_masks is not None:
+            segmentation = np.asarray(self.__dense_masks[mask_num]["segmentation"]).astype(bool, copy=False)
+            return {"area": int(np.count_nonzero(segmentation)), "bbox": _bounding_box(segmentation), "label": label}
+        entry = self.__index[mask_num]
+        return {"area": entry["area"], "bbox": entry["bbox"], "label": label}
+
+    def mask_hash(self, mask_num):
+        """
+        Get a hash of a mask's content (its shape, bounding box, and pixels).
+
+        The hash doesn't depend on the mask's label or position in the archive, so it stays the same
+        when the archive is saved again with the same mask. Version 2 masks are hashed without decoding them.
+
+        :param mask_num: The index of the mask.
+        :return: The hash as a hex string.
+        """
+        # version 1 masks have to be encoded to be hashed, so remember the hashes
+        if mask_num not in self.__mask_hashes:
+            entry, payload = self.encoded_mask(mask_num)
+            digest = hashlib.sha256(json.dumps([list(entry["shape"]), list(entry["bbox"])]).encode("utf-8"))
+            digest.update(payload)
+            self.__mask_hashes[mask_num] = digest.hexdigest()[:32]
+        return self.__mask_hashes[mask_num]
+
+    def image_reference(self):
+        """
+        Get the reference to the source image stored in a version 2 archive.
+
+        :return: A dictionary with the image "filename" and "sha256", or None if the archive has no image entry.
+        """
+        if self.__header is None or "image" not in self.__header:
+            return None
+        image_entry = self.__header["image"]
+        return {"filename": image_entry.get("filename"), "sha256": image_entry.get("sha256")}
+
+    def load_embedded_image(self):
+        """
+        Get the source image file embedded in a self-contained archive.
+
+        :return: The image file content, or None if the image is not embedded.
+        """
+        if self.__header is None or "offset" not in self.__header.get("image", {}):
+            return None
+        image_entry = self.__header["image"]
+        return bytes(self.__payload[image_entry["offset"]:image_entry["offset"] + image_entry["length"]])
+
+
+class LazyMaskList(Sequence):
+    """
+    A read-only list of masks that decodes each mask the first time it is accessed.
+
+    :param load_mask: A function that takes a mask index and returns the decoded mask dictionary.
+    :param length: The number of masks.
+    """
+    def __init__(self, load_mask, length):
+        self.__load_mask = load_mask
+        self.__length = length
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, mask_num):
+        if isinstance(mask_num, slice):
+            return [self[i] for i in range(*mask_num.indices(self.__length))]
+        if mask_num < 0:
+            mask_num += self.__length
+        if mask_num < 0 or mask_num >= self.__length:
+            raise IndexError("mask index out of range")
+        return self.__load_mask(mask_num)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..resources import get_db_item, put_db_item, update_db_item, file_exists, write_file_stream, delete_file, get_files_in_directory
+from ..config import EXPORT_JOB_WORKERS, EXPORT_ARTIFACT_TTL, EXPORT_SWEEP_INTERVAL
+from .project_management import SB_project
+
+# Background export jobs for project downloads.
+#
+# Building the ZIP for a large project can take longer than a Dash callback is allowed to run,
+# so the Files tab starts a job and polls its status instead. Jobs run on a small pool of
+# background threads and stream the ZIP straight into storage under
+# exports/<username>/<project>/<job id>.zip.
+#
+# Job state is kept in the "exports" table so every worker process can see it:
+#     export_id: <job id>  ->  {"export": {"username", "project", "files", "status", "progress",
+#                                          "started", "updated", "finished", "artifact", "error"}}
+# status is one of "running", "done", or "failed", progress is a percentage, and the times are
+# milliseconds since the epoch (integers, since DynamoDB doesn't take floats).
+# While a job runs, its progress is written on its own to a separate attribute of the same item,
+#     "progress": {"progress", "updated"}
+# so a progress tick doesn't rewrite the whole job (with its list of files) every second.
+#
+# The job id is a hash of the user, project, and selected files, so asking for the same selection
+# again finds the same job - a running job is joined and a finished artifact is reused for
+# EXPORT_ARTIFACT_TTL seconds, unless the project has been saved to since the job started
+# (see invalidate_project_exports). Re-running a selection overwrites its artifact, so storage
+# holds at most one artifact per selection, and artifacts that can't be reused any more are deleted
+# by a sweep that runs in the background every EXPORT_SWEEP_INTERVAL seconds (see sweep_expired_exports).
+
+# jobs whose status hasn't been updated for this many seconds are assumed to have died with their worker
+STALE_JOB_SECONDS = 300
+
+# only write progress to the table this often (in seconds), so big exports don't hammer the DB
+PROGRESS_UPDATE_INTERVAL = 1.0
+
+export_job_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix="export-job")
+
+# serializes starting jobs in this process, so a double-click doesn't start the same job twice
+_start_lock = threading.Lock()
+
+# when (time.monotonic()) this process last started a sweep of expired artifacts
+_last_sweep = None
+
+
+def get_export_job_id(username, project_name, file_list):
+    """
+    Get the id of the export job for a selection of files.
+
+    :param username: The username of the user.
+    :param project_name: The name of the project.
+    :param file_list: A list of the image filenames to include.
+    :return: The job id (a hex string).
+    """
+    selection = json.dumps([username, project_name, sorted(file_list)])
+    return hashlib.sha256(selection.encode("utf-8")).hexdigest()[:32]
+
+
+def get_export_job(job_id):
+    """
+    Get the state of an export job.
+
+    A running job that hasn't reported progress for STALE_JOB_SECONDS is reported as failed.
+
+    :param job_id: The id of the job.
+    :return: The job dictionary (see the top of this file), or None if there is no such job.
+    """
+    job_item = get_db_item(table_name="exports",key_name="export_id",key_value=job_id)
+    if not job_item or "export" not in job_item:
+        return None
+    job = dict(job_item["export"])
+    # the whole job is put again when it finishes, which drops the progress attribute
+    progress = job_item.get("progress")
+    if progress and int(progress.get("updated", 0)) > int(job.get("updated", 0)):
+        job["progress"] = int(progress["progress"])
+        job["updated"] = int(progress["updated"])
+    if job.get("status") == "running" and _now() - int(job.get("updated", 0)) > STALE_JOB_SECONDS*1000:
+        job["status"] = "failed"
+        job["error"] = "The export stopped responding"
+    return job
+
+
+def artifact_is_reusable(job):
+    """
+    Check whether a job's finished ZIP can be downloaded (again).
+
+    :param job: The job dictionary.
+    :return: True if the job is done, its artifact hasn't expired, and the project hasn't been saved to since it started.
+    """
+    if job is None or job.get("status") != "done":
+        return False
+    if _now() - int(job.get("finished", 0)) > EXPORT_ARTIFACT_TTL*1000:
+        return False
+    return int(job.get("started", 0)) > _get_project_modified(job["username"], job["project"])
+
+
+def start_export(username, project_name, file_list):
+    """
+    Start an export job for a selection of files, or reuse the one that is running or already finished.
+
+    :param username: The username of the user.
+    :param project_name: The name of the project.
+    :param file_list: A list of the image filenames to include.
+    :return: The id of the job.
+    """
+    job_id = get_export_job_id(username, project_name, file_list)
+    with _start_lock:
+        job = get_export_job(job_id)
+        if job is not None and job["status"] == "running":
+            logging.debug("EXPORTDEBUG: joining running export %s", job_id)
+            return job_id
+        if artifact_is_reusable(job) and file_exists(job["artifact"]):
+            logging.debug("EXPORTDEBUG: reusing export %s", job_id)
+            return job_id
+
+        now = _now()
+        job = {
+            "username": username,
+            "project": project_name,
+            "files": list(file_list),
+            "status": "running",
+            "progress": 0,
+            "started": now,
+            "updated": now,
+            "artifact": "exports/"+username+"/"+project_name+"/"+job_id+".zip",
+        }
+        _save_job(job_id, job)
+    export_job_executor.submit(_run_export, job_id, job)
+    _schedule_sweep()
+    return job_id
+
+
+def invalidate_project_exports(username, project_name):
+    """
+    Record that a project has changed, so finished exports of it are not reused.
+
+    :param username: The username of the user.
+    :param project_name: The name of the project.
+    """
+    put_db_item(table_name="exports",key_name="export_id",key_value=_project_key(username, project_name),
+                item_name="modified",item_value=_now())
+
+
+def sweep_expired_exports():
+    """
+    Delete the export ZIPs in storage that can't be downloaded any more - ones that have expired,
+    whose project has been saved to since, or whose job failed or no longer exists.
+
+    :return: The number of files deleted.
+    """
+    deleted = 0
+    for name in get_files_in_directory("exports"):
+        if not name.endswith(".zip"):
+            continue
+        artifact = "exports/"+name
+        job_id = os.path.basename(name)[:-len(".zip")]
+        job = get_export_job(job_id)
+        if job is not None and (job["status"] == "running" or artifact_is_reusable(job)):
+            continue
+        # check again right before deleting, in case the selection was just exported again
+        job = get_export_job(job_id)
+        if job is not None and (job["status"] == "running" or artifact_is_reusable(job)):
+            continue
+        delete_file(artifact)
+        deleted += 1
+    if deleted:
+        logging.info("Deleted %d expired export(s)", deleted)
+    return deleted
+
+
+def _schedule_sweep():
+    # start a sweep on the job pool if this process hasn't done one for EXPORT_SWEEP_INTERVAL seconds
+    global _last_sweep
+    with _start_lock:
+        if _last_sweep is not None and time.monotonic() - _last_sweep < EXPORT_SWEEP_INTERVAL:
+            return
+        _last_sweep = time.monotonic()
+    export_job_executor.submit(_sweep_quietly)
+
+
+def _sweep_quietly():
+    try:
+        sweep_expired_exports()
+    except Exception as e:
+        logging.error("Sweeping expired exports failed: %s", e)
+
+
+def _now():
+    return time.time_ns() // 1000000
+
+
+def _project_key(username, project_name):
+    return "project:"+username+"/"+project_name
+
+
+def _get_project_modified(username, project_name):
+    item = get_db_item(table_name="exports",key_name="export_id",key_value=_project_key(username, project_name))
+    if not item or "modified" not in item:
+        return 0
+    return int(item["modified"])
+
+
+def _save_job(job_id, job):
+    put_db_item(table_name="exports",key_name="export_id",key_value=job_id,item_name="export",item_value=job)
+
+
+def _run_export(job_id, job):
+    """
+    Build the ZIP for an export job, streaming it into storage and recording progress as it goes.
+
+    :param job_id: The id of the job.
+    :param job: The job dictionary.
+    """
+    last_update = [time.monotonic()]
+
+    def report_progress(done, total):
+        if time.monotonic() - last_update[0] < PROGRESS_UPDATE_INTERVAL:
+            return
+        last_update[0] = time.monotonic()
+        # leave the last few percent for the upload
+        progress = int(95*done/total) if total else 95
+        try:
+            update_db_item(table_name="exports",key_name="export_id",key_value=job_id,
+                           item_name="progress",item_value={"progress": progress, "updated": _now()})
+        except Exception as e:
+            # progress is only for show, so failing to record it mustn't stop the export
+            logging.warning("Couldn't record the progress of export %s: %s", job_id, e)
+
+    try:
+        project = SB_project(job["username"], job["project"])
+        write_file_stream(job["artifact"], project.stream_download(job["files"], progress=report_progress))
+        if not file_exists(job["artifact"]):
+            raise IOError("couldn't save the download to storage")
+        job["status"] = "done"
+        job["progress"] = 100
+        job["finished"] = _now()
+    except Exception as e:
+        logging.error("Export %s failed: %s", job_id, e)
+        job["status"] = "failed"
+        job["error"] = str(e)
+    job["updated"] = _now()
+    _save_job(job_id, job)
@@ -1,19 +1,44 @@
-import os
 import boto3
 from botocore.exceptions import NoCredentialsError
 import io
 import numpy as np
 from PIL import Image, ImageOps
 import cv2
-import gzip
-import pickle
 import logging
 import botocore
 import base64
-import shutil
 import zipfile
+import time
+import functools
+import hashlib
+import threading
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from ..resources import load_file, load_file_versioned, get_file_version, write_file, delete_file, file_exists, serve_file, get_files_in_directory, get_storage_backend, LRUCache
+from ..config import IMAGE_CACHE_MAX_BYTES, COVER_THUMBNAIL_SIZE, EXPORT_WORKERS
+from .archive import MaskArchive, LazyMaskList, encode_mask, write_archive, image_sha256
+
+# Process-wide cache of decoded images and unpacked mask archives.
+# SB_project_image objects are rebuilt in every callback, so the decoded data is kept here instead,
+# keyed by (username, project, filename, kind, version) where version is the storage version of the
+# file it was decoded from - a rewritten file gets a new version and is decoded again.
+image_object_cache = LRUCache(IMAGE_CACHE_MAX_BYTES)
+
+# shared pool for fetching files from storage for project downloads
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+def get_file_prefix(image_file):
+    """
+    Get the prefix of an image filename, which its masks archive and segmented image are named after.
 
-from ..resources import load_file, write_file, file_exists, serve_file, get_files_in_directory, file_download
+    :param image_file: The filename of the image.
+    :return: The filename without its .jpg or .png extension.
+    """
+    if len(image_file) > 4 and (image_file[-4:] == ".jpg" or image_file[-4:] == ".png"):
+        return image_file[:-4]
+    return image_file
 
 class SB_project_image:
     """
@@ -28,9 +53,12 @@ class SB_project_image:
     - __image_path (str): The path to the image file in file storage (either cloud or local).
     - __masks_path (str): The path to the masks file in file storage.
     - __segments_path (str): The path to the segmented image file in file storage.
+    - __mask_thumbnails_dir_path (str): The directory for the image's rendered mask card thumbnails in file storage.
     - __masks (list): The list of masks associated with the image.
     - __labels (list): The list of labels associated with the masks.
     - __segmented_image (numpy array): The segmented image array.
+    - __archive (MaskArchive): The parsed masks archive, once loaded.
+    - __archive_version: The storage version of the loaded archive.
     """
     def __init__(self,username,project,image_file):
         """
@@ -43,28 +71,37 @@ class SB_project_image:
         self.__username = username
         self.__project = project
         self.__filename = image_file
-        self.__file_prefix = image_file
-        self.__file_suffix = ""
-        if len(image_file) > 4 and (image_file[-4:] == ".jpg" or image_file[-4:] == ".png"):
-            self.__file_prefix = image_file[:-4]
-            self.__file_suffix = image_file[-4:]
+        self.__file_prefix = get_file_prefix(image_file)
+        self.__file_suffix = image_file[len(self.__file_prefix):]
         self.__image_path = "images/"+self.__username+"/"+self.__project+"/"+self.__filename
         self.__masks_path = "image_masks/"+self.__username+"/"+self.__project+"/"+self.__file_prefix+".sgbdi"
         self.__segments_path = "segmented_images/"+self.__username+"/"+self.__project+"/"+self.__file_prefix+".png"
+        self.__mask_thumbnails_dir_path = "mask_thumbnails/"+self.__username+"/"+self.__project+"/"+self.__file_prefix
         self.__masks = None
         self.__labels = None
         self.__segmented_image = None
+        self.__archive = None
+        self.__archive_version = None
 
 
-    def __read_image(self, path):
+    def __read_image(self, path, kind="image"):
         """
         Read an image from the given path and convert it to a NumPy array.
+
+        Decoded images are kept in the image object cache, so an image that has not changed
+        in storage is only decoded once per process. The returned array is read-only.
         
         :param path: The path to the image file.
+        :param kind: Which of this image's files is being read ("image" or "segmented"), used in the cache key.
         :return: The image as a NumPy array.
         """
         # Download the image file in memory
-        file_byte_string = load_file(path)
+        file_byte_string, version = load_file_versioned(path)
+
+        cache_key = (self.__username, self.__project, self.__filename, kind, version)
+        image_array = image_object_cache.get(cache_key)
+        if image_array is not None:
+            return image_array
 
         # Create a file-like object for the image file
         image_file = io.BytesIO(file_byte_string)
@@ -81,26 +118,73 @@ class SB_project_image:
             image_array = cv2.cvtColor(image_array, cv2.COLOR_GRAY2RGB)
         #else:
         #    image_array = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+
+        # the same array is handed to every caller, so don't let anyone modify it in place
+        image_array.flags.writeable = False
+        if version is not None:
+            image_object_cache.put(cache_key, image_array, image_array.nbytes)
             
         return image_array
 
+    def __load_archive(self):
+        """
+        Load the compressed archive file (.sgbdi) for this image.
+
+        Only the archive's header is parsed here (for version 2 archives); the masks are
+        decoded individually when they are accessed. Parsed archives are kept in the image
+        object cache until the archive changes.
+
+        :return: A tuple (archive, version), or (None, None) if there is no archive.
+        """
+        compressed_data, version = load_file_versioned(self.__masks_path)
+        if compressed_data is None:
+            return None, None
+
+        cache_key = (self.__username, self.__project, self.__filename, "archive", version)
+        archive = image_object_cache.get(cache_key)
+        if archive is None:
+            archive = MaskArchive(compressed_data)
+            if version is not None:
+                image_object_cache.put(cache_key, archive, archive.nbytes)
+        return archive, version
+
+    def __load_archived_mask(self, mask_num):
+        """
+        Decode a single mask from the archive, using the image object cache.
+
+        :param mask_num: The index of the mask in the archive.
+        :return: The mask dictionary, with a read-only "segmentation" array.
+        """
+        cache_key = (self.__username, self.__project, self.__filename, "mask", self.__archive_version, mask_num)
+        mask = image_object_cache.get(cache_key)
+        if mask is None:
+            mask = self.__archive.load_mask(mask_num)
+            mask["segmentation"].flags.writeable = False
+            if self.__archive_version is not None:
+                image_object_cache.put(cache_key, mask, mask["segmentation"].nbytes)
+        return dict(mask)
+
     def __unpack_archive(self):
         """
         Unpack the masks and labels from the compressed archive file.
 
-        The .sgbdi files are archives, which are pickled dictionaries that have been gzipped
+        The masks are exposed as a LazyMaskList, so a mask is only decoded when it is used.
+        An image without an archive has no masks and no labels.
         """
-        #compressed_data = self.__load_file_from_s3(self.__masks_path)
-        compressed_data = load_file(self.__masks_path)
-        #with open(self.__masks_path,'rb') as masks_file:
-        #    compressed_data = masks_file.read()
-        decompressed_pickle_data = gzip.decompress(compressed_data)
-        data = pickle.loads(decompressed_pickle_data)       
-        self.__masks = data["masks"]
-        #need to make the segments back into numpy arrays instead of lists
-        for idx in range(len(self.__masks)):
-            self.__masks[idx]["segmentation"] = np.array(self.__masks[idx]["segmentation"])
-        self.__labels = data["labels"]
+        self.__archive, self.__archive_version = self.__load_archive()
+        if self.__archive is None:
+            self.__masks = []
+            self.__labels = []
+            return
+        self.__masks = LazyMaskList(self.__load_archived_mask, len(self.__archive))
+        self.__labels = list(self.__archive.labels)
+
+    def __invalidate_cached_masks(self):
+        """
+        Remove every cached version of this image's archive and decoded masks.
+        """
+        image_key = (self.__username, self.__project, self.__filename)
+        image_object_cache.invalidate_matching(lambda key: key[:3] == image_key and key[3] in ("archive", "mask"))
 
     def get_filename(self):
         """
@@ -138,14 +222,93 @@ class SB_project_image:
     
     def load_masks(self):
         """
-        Get the path to the segmented image.
+        Load the masks associated with the image.
+
+        Masks are decoded lazily, so indexing into the result only decodes that one mask.
         
-        :return: The path to the segmented image.
+        :return: A read-only sequence of mask dictionaries.
         """
         if not self.__masks:
             self.__unpack_archive()
         return self.__masks
     
+    def load_mask(self, mask_num):
+        """
+        Load a single mask without decoding any of the others.
+        
+        :param mask_num: The index of the mask.
+        :return: The mask dictionary.
+        """
+        masks = self.load_masks()
+        if mask_num < 0 or mask_num >= len(masks):
+            raise IndexError("mask index out of range")
+        return self.__load_archived_mask(mask_num)
+
+    def iter_masks(self):
+        """
+        Iterate over the masks, decoding one at a time.
+        
+        :return: A generator of mask dictionaries, in archive order.
+        """
+        for mask_num in range(len(self.load_masks())):
+            yield self.__load_archived_mask(mask_num)
+
+    def mask_metadata(self):
+        """
+        Get the area, bounding box, and label of every mask without decoding the masks.
+        
+        :return: A list of dictionaries with "area", "bbox" ([x, y, width, height]), and "label".
+        """
+        masks = self.load_masks()
+        return [self.__archive.mask_metadata(mask_num) for mask_num in range(len(masks))]
+
+    def mask_hashes(self):
+        """
+        Get a hash of each mask's content, e.g. for caching things rendered from the masks.
+
+        A mask keeps its hash when the archive is saved again, as long as the mask itself hasn't changed.
+
+        :return: A list with one hash (a hex string) per mask.
+        """
+        masks = self.load_masks()
+        if self.__archive is None:
+            return []
+        return [self.__archive.mask_hash(mask_num) for mask_num in range(len(masks))]
+
+    def mask_hash(self, mask_num):
+        """
+        Get the hash of a single mask's content (see mask_hashes) without hashing any of the others.
+
+        :param mask_num: The index of the mask.
+        :return: The hash as a hex string.
+        """
+        masks = self.load_masks()
+        if mask_num < 0 or mask_num >= len(masks):
+            raise IndexError("mask index out of range")
+        return self.__archive.mask_hash(mask_num)
+
+    def get_mask_thumbnails_dir(self):
+        """
+        Get the directory in file storage where the image's mask card thumbnails are kept.
+
+        :return: The directory path.
+        """
+        return self.__mask_thumbnails_dir_path
+
+    def delete_mask_thumbnails(self, keep_hashes=None):
+        """
+        Delete the image's stored mask card thumbnails, e.g. after its masks change or the image is replaced.
+
+        Thumbnails are named after the hash of their mask (see mask_hashes), so the ones for masks
+        that are still in the archive can be kept.
+
+        :param keep_hashes: The mask hashes whose thumbnails should be kept (default is None - delete them all).
+        """
+        for thumbnail_name in get_files_in_directory(self.__mask_thumbnails_dir_path):
+            if keep_hashes is not None and thumbnail_name.split("_")[0] in keep_hashes:
+                continue
+            delete_file(self.__mask_thumbnails_dir_path+"/"+thumbnail_name)
+
     def load_labels(self):
         """
         Load the labels associated with the masks.
@@ -171,7 +334,7 @@ class SB_project_image:
         
         :return: The segmented image as a NumPy array.
         """
-        image = self.__read_image(self.__segments_path)
+        image = self.__read_image(self.__segments_path, kind="segmented")
         return image
 
     def update_archive(self,old_mask_labels,new_masks,new_mask_labels):
@@ -187,14 +350,99 @@ class SB_project_image:
             new_mask_labels = []
         old_masks = self.load_masks()
         logging.debug("length of new and old masks: %s, %s",len(new_masks),len(old_masks))
-        combined_masks = new_masks+old_masks
         combined_labels = new_mask_labels+old_mask_labels
-        filtered_masks = [combined_masks[i] for i in range(len(combined_masks)) if combined_labels[i] != "DELETE" ]
-        filtered_labels = [combined_labels[i] for i in range(len(combined_masks)) if combined_labels[i] != "DELETE" ]
-        savable_data = {"image": self.load_image(), "masks": filtered_masks, "labels": list(filtered_labels)}
-        pickle_data = pickle.dumps(savable_data)
-        compressed_pickle_data = gzip.compress(pickle_data)
-        write_file(self.__masks_path,compressed_pickle_data)
+
+        # new masks have to be encoded, but old masks are copied over from the existing archive
+        # as they are, without decoding them
+        encoded_masks = []
+        filtered_labels = []
+        for i in range(len(new_masks)+len(old_masks)):
+            if combined_labels[i] == "DELETE":
+                continue
+            if i < len(new_masks):
+                encoded_masks.append(encode_mask(new_masks[i]))
+            else:
+                encoded_masks.append(self.__archive.encoded_mask(i-len(new_masks)))
+            filtered_labels.append(combined_labels[i])
+
+        # the archive only references the source image (by content hash) instead of embedding it
+        archive_data = write_archive(encoded_masks, filtered_labels, self.__archive_shape(encoded_masks),
+                                     image_filename=self.__filename, image_hash=self.get_image_hash())
+        write_file(self.__masks_path,archive_data)
+        self.__invalidate_cached_masks()
+        self.__masks = None
+        self.__labels = None
+
+        # thumbnails of the masks that were kept are still good, but the rest would never be used again
+        saved_archive = MaskArchive(archive_data)
+        self.delete_mask_thumbnails(keep_hashes={saved_archive.mask_hash(i) for i in range(len(saved_archive))})
+
+    def __archive_shape(self, encoded_masks):
+        """
+        Get the (height, width) that the masks in a new archive share.
+
+        This comes from the masks themselves when possible, so that saving does not need to decode the image.
+
+        :param encoded_masks: The encoded masks going into the archive.
+        :return: The (height, width) of the masks.
+        """
+        if encoded_masks:
+            return encoded_masks[0][0]["shape"]
+        if self.__archive is not None and self.__archive.shape is not None:
+            return self.__archive.shape
+        return self.load_image().shape[:2]
+
+    def get_image_hash(self):
+        """
+        Get the content hash of the source image file, which archives use to reference it.
+
+        :return: The SHA-256 hex digest of the image file, or None if the image can't be loaded.
+        """
+        image_bytes, version = load_file_versioned(self.__image_path)
+        if image_bytes is None:
+            return None
+        cache_key = (self.__username, self.__project, self.__filename, "image_hash", version)
+        image_hash = image_object_cache.get(cache_key)
+        if image_hash is None:
+            image_hash = image_sha256(image_bytes)
+            if version is not None:
+                image_object_cache.put(cache_key, image_hash, len(image_hash))
+        return image_hash
+
+    def export_archive(self, self_contained=True, image_bytes=None):
+        """
+        Get the masks archive in a form suitable for downloading.
+
+        Stored archives only reference their source image. A self-contained export embeds
+        the original image file as well, so the archive can be used on its own. Masks are
+        copied over without being decoded.
+
+        Exports read storage directly rather than through the file and image object caches,
+        so a big download doesn't push out the files interactive users are working on.
+
+        :param self_contained: Whether to embed the source image file in the archive.
+        :param image_bytes: The source image file, if the caller already has it (otherwise it is loaded).
+        :return: The archive as bytes, or None if the image has no archive.
+        """
+        storage = get_storage_backend()
+        compressed_data = storage.load_file(self.__masks_path)
+        if compressed_data is None:
+            return None
+        archive = MaskArchive(compressed_data)
+        encoded_masks = [archive.encoded_mask(i) for i in range(len(archive))]
+        if image_bytes is None:
+            image_bytes = storage.load_file(self.__image_path)
+        image_hash = image_sha256(image_bytes) if image_bytes is not None else None
+
+        if encoded_masks:
+            shape = encoded_masks[0][0]["shape"]
+        elif archive.shape is not None:
+            shape = archive.shape
+        else:
+            # an archive without masks doesn't record a shape, so it comes from the (upright) image
+            shape = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).size[::-1]
+        return write_archive(encoded_masks, list(archive.labels), shape, image_filename=self.__filename,
+                             image_hash=image_hash, embedded_image=image_bytes if self_contained else None)
 
     def save_segmented_image(self,new_segmented_image):
         """
@@ -216,6 +464,8 @@ class SB_project:
     - __project_name (str): The name of the project.
     - __images_dir_path (str): The directory path for the project's images.
     - __segmented_images_dir_path (str): The directory path for the project's segmented images.
+    - __image_masks_dir_path (str): The directory path for the project's mask archives.
+    - __project_covers_dir_path (str): The directory path for the project's cover thumbnails.
     """
     
     def __init__(self, username, project_name):
@@ -230,6 +480,8 @@ class SB_project:
         self.__project_name = project_name
         self.__images_dir_path = "images/"+self.__username+"/"+self.__project_name
         self.__segmented_images_dir_path = "segmented_images/"+self.__username+"/"+self.__project_name
+        self.__image_masks_dir_path = "image_masks/"+self.__username+"/"+self.__project_name
+        self.__project_covers_dir_path = "project_covers/"+self.__username+"/"+self.__project_name
 
     def get_image_names(self):
         """
@@ -238,6 +490,29 @@ class SB_project:
         :return: A list of image filenames.
         """
         return get_files_in_directory(self.__images_dir_path)
+
+    def get_image_statuses(self, image_names):
+        """
+        Find out which images have masks and which have segmented images.
+
+        Rather than checking each image's files one at a time (a request per file on S3),
+        this lists the project's mask archives and segmented images once each and then
+        looks the images up in those listings.
+
+        :param image_names: A list of image filenames in the project.
+        :return: A dictionary mapping each filename to a dictionary with "has_masks" and "has_segmented_image" booleans.
+        """
+        masked_prefixes = {name[:-len(".sgbdi")] for name in get_files_in_directory(self.__image_masks_dir_path) if name.endswith(".sgbdi")}
+        segmented_prefixes = {name[:-len(".png")] for name in get_files_in_directory(self.__segmented_images_dir_path) if name.endswith(".png")}
+
+        statuses = {}
+        for image_name in image_names:
+            file_prefix = get_file_prefix(image_name)
+            statuses[image_name] = {
+                "has_masks": file_prefix in masked_prefixes,
+                "has_segmented_image": file_prefix in segmented_prefixes,
+            }
+        return statuses
     
     def get_cover_image_url(self):
         """
@@ -250,92 +525,205 @@ class SB_project:
         """
         logging.debug("SBDEBUG: About to get the cover image for "+self.__project_name)
         cover_image = "assets/eyelogo.png"
-        image_names = get_files_in_directory(self.__images_dir_path)
+        image_names = get_files_in_directory(self.__images_dir_path, max_files=1)
 
         if len(image_names) > 0:
-            img_path = os.path.join(self.__images_dir_path,image_names[0])
+            img_path = self.__get_cover_thumbnail_path(image_names[0])
             cover_image = serve_file(img_path)
 
         return cover_image
+
+    def __get_cover_thumbnail_path(self, image_name):
+        """
+        Get the path of the cover thumbnail for an image, creating the thumbnail if needed.
+
+        Cover thumbnails are small JPEGs (COVER_THUMBNAIL_SIZE pixels on the long side) stored under
+        project_covers/<username>/<project>/, so project cards don't have to load full-size photos.
+        They are named after the image's storage version as well as its name, so an image uploaded
+        again under the same name gets a new thumbnail, and the old one is deleted.
+        If the thumbnail can't be made, the path of the original image is returned instead.
+
+        :param image_name: The filename of the image to use as the cover.
+        :return: The path of the cover thumbnail in file storage.
+        """
+        img_path = self.__images_dir_path+"/"+image_name
+        version = get_file_version(img_path)
+        if version is None:
+            return img_path
+        file_prefix = get_file_prefix(image_name)
+        version_key = hashlib.sha256(repr(version).encode("utf-8")).hexdigest()[:12]
+        thumbnail_name = file_prefix+"_"+version_key+"_cover.jpg"
+        thumbnail_path = self.__project_covers_dir_path+"/"+thumbnail_name
+        cover_names = get_files_in_directory(self.__project_covers_dir_path)
+        if thumbnail_name in cover_names:
+            return thumbnail_path
+
+        try:
+            image = Image.open(io.BytesIO(load_file(img_path)))
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((COVER_THUMBNAIL_SIZE, COVER_THUMBNAIL_SIZE))
+            thumbnail_file = io.BytesIO()
+            image.save(thumbnail_file, format="JPEG", quality=85)
+            write_file(thumbnail_path, thumbnail_file.getvalue())
+        except Exception as e:
+            logging.debug("couldn't create a cover thumbnail for %s: %s", img_path, e)
+            return img_path
+
+        # thumbnails of earlier versions of the image (including ones from before they were versioned)
+        for cover_name in cover_names:
+            if cover_name == file_prefix+"_cover.jpg" or (cover_name.startswith(file_prefix+"_")
+                    and cover_name.endswith("_cover.jpg") and len(cover_name) == len(thumbnail_name)):
+                delete_file(self.__project_covers_dir_path+"/"+cover_name)
+        return thumbnail_path
     
-    def prepare_download(self,file_list,zipfilename):
+    def get_download_entries(self, file_list):
         """
-        Prepare the project files for download by creating a ZIP archive.
+        List the files that go into a download of the selected images.
 
-        The method creates temporary directories for the project files, downloads the specified files,
-        and then archives them into a ZIP file.
+        For each image, the download has the original image, its SegBuilder archive (self-contained,
+        with the image embedded), and its segmented image, if they exist.
 
-        :param file_list: A list of filenames to be included in the download.
-        :param zipfilename: The name of the ZIP file to create.
-        :return: The path to the created ZIP file.
+        :param file_list: A list of the image filenames to include.
+        :return: A list of (path in the ZIP, function that loads the file's bytes or returns None, ZIP compression type) tuples.
         """
-        # Remove the user's temporary directory if it exists
-        if os.path.exists("tmp/"+self.__username):
-            shutil.rmtree("tmp/"+self.__username)
-
-        # Create necessary directories for downloading and archiving files
-        if not os.path.exists("tmp/downloads"):
-            os.makedirs("tmp/downloads")
-        os.makedirs("tmp/"+self.__username+'/'+self.__project_name+'/images')
-        os.makedirs("tmp/"+self.__username+'/'+self.__project_name+'/segmented_images')
-        os.makedirs("tmp/"+self.__username+'/'+self.__project_name+'/image_masks')
-
-        # Download each file in the file list
+        entries = []
         for filename in file_list:
             #strip out leading space
             if filename[0] == " ":
                 filename = filename[1:]
-            filename_plus_png = filename
 
-            # figure out the name that the segmented image will have - it's the base filename plus png (even if the original was a jpg)
+            # the segmented image is the base filename plus png (even if the original was a jpg),
+            # and the SegBuilder archive is the base file name plus .sgbdi
+            file_prefix = filename
             if len(filename) > 4 and filename[-4] == ".":
-                filename_plus_png = filename[:-4]
-            filename_plus_png += ".png"
+                file_prefix = filename[:-4]
+            image_obj = SB_project_image(self.__username,self.__project_name,filename)
+
+            # the image goes into the ZIP on its own and embedded in the archive, so it is fetched once for both
+            load_image = _SharedLoad(functools.partial(get_storage_backend().load_file, self.__images_dir_path+"/"+filename), uses=2)
+
+            # images are already compressed, so they are stored as they are rather than deflated again
+            entries.append((self.__project_name+"/images/"+filename,
+                            load_image,
+                            zipfile.ZIP_STORED))
+            entries.append((self.__project_name+"/sgbdi/"+file_prefix+".sgbdi",
+                            functools.partial(_export_archive_with_image, image_obj, load_image),
+                            zipfile.ZIP_DEFLATED))
+            entries.append((self.__project_name+"/masks/"+file_prefix+".png",
+                            functools.partial(get_storage_backend().load_file, self.__segmented_images_dir_path+"/"+file_prefix+".png"),
+                            zipfile.ZIP_STORED))
+        return entries
+
+    def stream_download(self, file_list, progress=None):
+        """
+        Stream a ZIP archive of the selected images and their masks.
+
+        Files are fetched from storage on a shared, bounded pool of worker threads (a few ahead of
+        the one being written) and written straight into the ZIP stream, so nothing is staged on disk
+        and only a handful of files are in memory at once. Files that don't exist are left out.
+
+        :param file_list: A list of the image filenames to include.
+        :param progress: An optional function called as progress(done, total) after each file is handled.
+        :return: A generator of chunks of the ZIP file.
+        """
+        entries = self.get_download_entries(file_list)
+        zip_stream = _ZipStream()
+        with zipfile.ZipFile(zip_stream, "w") as zipf:
+            for entry_num, ((archive_path, _, compress_type), data) in enumerate(zip(entries, _fetch_in_order(entries))):
+                if data is None:
+                    logging.debug("couldn't download  %s",archive_path)
+                else:
+                    zipf.writestr(zipfile.ZipInfo(archive_path, date_time=time.localtime()[:6]), data, compress_type=compress_type)
+                    yield zip_stream.drain()
+                if progress is not None:
+                    progress(entry_num+1, len(entries))
+        yield zip_stream.drain()
+
+
+class _SharedLoad:
+    """
+    Loader whose result is shared by a fixed number of calls, which may come from different threads.
 
-            # figure out the name of the SegBuilder archive file (.sgbdi) - it's the base file name plus .sgbdi
-            filename_plus_sgbdi = filename
-            if len(filename) > 4 and filename[-4] == ".":
-                filename_plus_sgbdi = filename[:-4]
-            filename_plus_sgbdi += ".sgbdi"  
-
-
-            # download the original image file
-            try:
-                file_download(self.__images_dir_path+"/"+filename,f'tmp/{self.__username}/{self.__project_name}/images/{filename}')
-            except:
-                logging.debug("couldn't download  %s",filename)
-
-            # download the image masks archive (.sgbdi file)
-            try:
-                file_download(self.__images_dir_path+"/"+filename,f'tmp/{self.__username}/{self.__project_name}/image_masks/{filename_plus_sgbdi}')
-            except:
-                logging.debug("couldn't download  %s",filename)
-
-            # download the segmented image corresponding to this image
-            try:
-                file_download(self.__segmented_images_dir_path+"/"+filename_plus_png,f'tmp/{self.__username}/{self.__project_name}/segmented_images/{filename_plus_png}')
-            except:
-                logging.debug("couldn't download  %s",filename_plus_png)
-            
-        # Create ZIP archive
-        with zipfile.ZipFile("tmp/downloads/"+zipfilename,'w') as zipf:
-            # put original images in the images/ subdirectory
-            for foldername, subfolders,filenames in os.walk(f"tmp/{self.__username}/{self.__project_name}/images"):
-                for filename in filenames:
-                    filePath = os.path.join(foldername,filename)
-                    archive_path = os.path.join(self.__project_name,'images',filename)
-                    zipf.write(filePath,arcname=archive_path)
-            # put SegBuilder masks archives in the image_masks/ subdirectory
-            for foldername, subfolders,filenames in os.walk(f"tmp/{self.__username}/{self.__project_name}/image_masks"):
-                for filename in filenames:
-                    filePath = os.path.join(foldername,filename)
-                    archive_path = os.path.join(self.__project_name,'sgbdi',filename)
-                    zipf.write(filePath,arcname=archive_path)
-            # put segmented images in the segmented_images/ subdirectory
-            for foldername, subfolders,filenames in os.walk(f"tmp/{self.__username}/{self.__project_name}/segmented_images"):
-                for filename in filenames:
-                    filePath = os.path.join(foldername,filename)
-                    archive_path = os.path.join(self.__project_name,'masks',filename)
-                    zipf.write(filePath,arcname=archive_path)
-
-        return "tmp/downloads/"+zipfilename
\ No newline at end of file
+    The first call loads the data and the others wait for it. The data is dropped after the last
+    call, so a download doesn't keep every file it has shared in memory until it finishes.
+    """
+
+    def __init__(self, loader, uses):
+        """
+        :param loader: A function that loads the data.
+        :param uses: How many times the loader will be called.
+        """
+        self.__loader = loader
+        self.__uses = uses
+        self.__loaded = False
+        self.__data = None
+        self.__lock = threading.Lock()
+
+    def __call__(self):
+        with self.__lock:
+            if not self.__loaded:
+                self.__data = self.__loader()
+                self.__loaded = True
+            data = self.__data
+            self.__uses -= 1
+            if self.__uses <= 0:
+                self.__data = None
+            return data
+
+
+def _export_archive_with_image(image_obj, load_image):
+    # the image is fetched before the archive, so a missing archive still uses up its share of the image
+    image_bytes = load_image()
+    return image_obj.export_archive(self_contained=True, image_bytes=image_bytes)
+
+
+def _fetch_in_order(entries):
+    """
+    Load the files for download entries concurrently, yielding their contents in order.
+
+    At most twice EXPORT_WORKERS files are in flight (or waiting to be yielded) at any time.
+
+    :param entries: A list of download entries as returned by SB_project.get_download_entries.
+    :return: A generator of file contents (or None for files that couldn't be loaded).
+    """
+    def load(loader):
+        try:
+            return loader()
+        except Exception as e:
+            logging.debug("error loading a file for download: %s", e)
+            return None
+
+    pending = collections.deque()
+    loaders = iter(entry[1] for entry in entries)
+    for loader in itertools.islice(loaders, EXPORT_WORKERS*2):
+        pending.append(export_executor.submit(load, loader))
+    while pending:
+        data = pending.popleft().result()
+        for loader in itertools.islice(loaders, 1):
+            pending.append(export_executor.submit(load, loader))
+        yield data
+
+
+class _ZipStream(io.RawIOBase):
+    """
+    Write-only, unseekable buffer for zipfile.ZipFile, so a ZIP can be streamed out while it is being written.
+    """
+    def __init__(self):
+        self.__buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.__buffer += data
+        return len(data)
+
+    def drain(self):
+        """
+        Take everything written so far.
+
+        :return: The bytes written since the last drain.
+        """
+        data = bytes(self.__buffer)
+        self.__buffer.clear()
+        return data
@@ -1,4 +1,5 @@
-from .aws_resources import get_dynamodb_resource, get_s3_resource, get_s3_client
+from .aws_resources import get_dynamodb_resource, get_s3_resource, get_s3_client, get_shared_s3_client, get_shared_dynamodb_resource, get_dynamodb_table
 from .local_resources import save_local_db
-from .database import get_db_item, put_db_item, update_db_item, delete_db_item, update_last_activity
-from .storage import load_file, write_file, file_exists, serve_file, get_files_in_directory, file_download
\ No newline at end of file
+from .database import get_db_item, batch_get_db_items, put_db_item, append_to_db_list, update_db_item, delete_db_item, update_last_activity
+from .storage import load_file, load_file_versioned, get_file_version, write_file, file_exists, serve_file, get_files_in_directory, file_download, open_file, write_file_stream, delete_file, get_storage_backend, StorageBackend, S3StorageBackend, LocalStorageBackend
+from .cache import LRUCache, TTLCache
\ No newline at end of file
@@ -1,9 +1,23 @@
 import os
+import threading
 import boto3
+from botocore.config import Config
+
+from ..config import S3_MAX_POOL_CONNECTIONS, S3_MAX_ATTEMPTS, S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT
 
 # These functions are wrappers for retrieving AWS resources that will be used
 # when the USE_AWS environment variable is True. 
 
+# boto3 clients are thread-safe once they are built, but building them is not cheap
+# (and building them concurrently from the default session is not safe), so the
+# shared S3 client is created lazily under a lock and then reused for the life of the process
+_shared_s3_client = None
+_shared_s3_client_lock = threading.Lock()
+
+# boto3 resources (unlike clients) must not be shared between threads, so each thread
+# keeps its own DynamoDB resource and Table objects and reuses them for every operation
+_dynamodb_thread_local = threading.local()
+
 def get_dynamodb_resource():
     """
     Get the DynamoDB resource using boto3.
@@ -33,7 +47,7 @@ def get_s3_resource():
         's3',
         region_name=region_name,
     )
-    return s3, s3.Bucket(os.getenv('S3_BUCKET_NAME', 'segbuilder'))
+    return s3, s3.Bucket(get_s3_bucket_name())
 
 def get_s3_client():
     """
@@ -50,3 +64,80 @@ def get_s3_client():
         region_name=region_name,
     )
 
+def get_s3_bucket_name():
+    """
+    Get the name of the S3 bucket used for file storage.
+
+    :return: The S3 bucket name from the S3_BUCKET_NAME environment variable.
+    """
+    return os.getenv('S3_BUCKET_NAME', 'segbuilder')
+
+def get_s3_client_config():
+    """
+    Build the botocore configuration for the shared S3 client.
+
+    The connection pool size, retry policy, and timeouts come from the
+    S3_* settings in the app config.
+
+    :return: A botocore Config object.
+    """
+    return Config(
+        region_name=os.getenv('AWS_DEFAULT_REGION', 'us-east-2'),
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+    )
+
+def get_shared_s3_client():
+    """
+    Get the process-wide S3 client, creating it on first use.
+
+    Unlike get_s3_client, this does not build a new client on every call. The client
+    is created from its own boto3 session with a pooled, retrying configuration and
+    can be used from multiple threads at once.
+
+    :return: The shared S3 client.
+    """
+    global _shared_s3_client
+    if _shared_s3_client is None:
+        with _shared_s3_client_lock:
+            if _shared_s3_client is None:
+                session = boto3.session.Session()
+                _shared_s3_client = session.client('s3', config=get_s3_client_config())
+    return _shared_s3_client
+
+
+def get_shared_dynamodb_resource():
+    """
+    Get this thread's DynamoDB resource, creating it on first use.
+
+    Unlike get_dynamodb_resource, this does not build a new resource on every call.
+    Each thread gets its own resource (built from its own boto3 session), since
+    boto3 resources are not thread-safe.
+
+    :return: The DynamoDB resource for the current thread.
+    """
+    resource = getattr(_dynamodb_thread_local, "resource", None)
+    if resource is None:
+        session = boto3.session.Session()
+        resource = session.resource('dynamodb', config=Config(
+            region_name=os.getenv('AWS_DEFAULT_REGION', 'us-east-2'),
+            retries={"mode": "standard"},
+        ))
+        _dynamodb_thread_local.resource = resource
+        _dynamodb_thread_local.tables = {}
+    return resource
+
+def get_dynamodb_table(table_name):
+    """
+    Get a DynamoDB Table object for this thread, creating it on first use.
+
+    :param table_name: The name of the DynamoDB table.
+    :return: The Table object.
+    """
+    resource = get_shared_dynamodb_resource()
+    tables = _dynamodb_thread_local.tables
+    if table_name not in tables:
+        tables[table_name] = resource.Table(table_name)
+    return tables[table_name]
\ No newline at end of file
@@ -0,0 +1,329 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Small in-process caches used to avoid re-downloading and re-decoding the same
+# files over and over. Each Dash callback builds its objects from scratch, so anything
+# we want to reuse between callbacks has to live at the process level, and since
+# Flask serves requests on multiple threads, every operation takes the lock.
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its entries.
+
+    Each entry is stored with a size (in bytes) given by the caller. When adding an entry
+    pushes the total over max_bytes, the least recently used entries are evicted.
+    Entries larger than max_bytes are never stored, and a max_bytes of 0 disables the cache.
+
+    Attributes:
+    - max_bytes (int): The maximum total size of the cached entries.
+    - current_bytes (int): The total size of the entries currently cached.
+    """
+    def __init__(self, max_bytes):
+        """
+        Initialize a new LRUCache instance.
+
+        :param max_bytes: The maximum total size (in bytes) of the cached entries.
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get an entry and mark it as most recently used.
+
+        :param key: The key of the entry.
+        :param default: The value to return if the key is not cached.
+        :return: The cached value, or default if the key is not cached.
+        """
+        with self.__lock:
+            if key not in self.__entries:
+                return default
+            self.__entries.move_to_end(key)
+            return self.__entries[key][0]
+
+    def put(self, key, value, size):
+        """
+        Add or replace an entry, evicting least recently used entries as needed.
+
+        :param key: The key of the entry.
+        :param value: The value to cache.
+        :param size: The size of the value in bytes.
+        """
+        with self.__lock:
+            self.__remove(key)
+            if size > self.max_bytes:
+                return
+            self.__entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def invalidate(self, key):
+        """
+        Remove an entry if it is cached.
+
+        :param key: The key of the entry to remove.
+        """
+        with self.__lock:
+            self.__remove(key)
+
+    def invalidate_matching(self, predicate):
+        """
+        Remove every entry whose key satisfies the predicate.
+
+        :param predicate: A function that takes a key and returns True if the entry should be removed.
+        """
+        with self.__lock:
+            for key in [k for k in self.__entries if predicate(k)]:
+                self.__remove(key)
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __remove(self, key):
+        # caller must hold the lock
+        if key in self.__entries:
+            _, size = self.__entries.pop(key)
+            self.current_bytes -= size
+
+
+class ListingCache:
+    """
+    Thread-safe cache of directory listings with a time-to-live.
+
+    A listing may be complete (every file under the directory) or partial (only the first
+    few files, which is all that is needed for things like cover images). Files written
+    by this process are added to complete listings in place, so only changes made outside
+    the process (another worker, or someone editing the bucket directly) have to wait for
+    the TTL to expire. A ttl of 0 disables the cache.
+
+    The number of listings is bounded - when it is full, the least recently used listing is
+    evicted - and expired listings are dropped as new ones are added. Listings are indexed by
+    directory, so recording a write only looks at the listings of the directories above the file.
+
+    Attributes:
+    - ttl (float): The number of seconds a listing is trusted for.
+    - max_entries (int): The maximum number of listings.
+    """
+    def __init__(self, ttl, max_entries):
+        """
+        Initialize a new ListingCache instance.
+
+        :param ttl: The number of seconds a listing is trusted for.
+        :param max_entries: The maximum number of listings.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # directory path -> (fetched_at, files, set of files, complete), in least recently used order
+        self.__listings = OrderedDict()
+        # directory path without trailing slashes -> the directory paths cached under it
+        self.__directories = {}
+        self.__last_purge = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def get(self, directory_path, max_files=None):
+        """
+        Get a cached listing if it is fresh and has enough files to answer the query.
+
+        :param directory_path: The directory that was listed.
+        :param max_files: The number of files needed, or None for all of them.
+        :return: A list of filenames (at most max_files), or None if the cache can't answer.
+        """
+        with self.__lock:
+            listing = self.__listings.get(directory_path)
+            if listing is None:
+                return None
+            fetched_at, files, _, complete = listing
+            if time.monotonic() - fetched_at > self.ttl:
+                self.__remove(directory_path)
+                return None
+            self.__listings.move_to_end(directory_path)
+            if complete:
+                return list(files) if max_files is None else files[:max_files]
+            if max_files is not None and len(files) >= max_files:
+                return files[:max_files]
+            return None
+
+    def put(self, directory_path, files, complete):
+        """
+        Store a listing, evicting expired and least recently used listings as needed.
+
+        A partial listing never replaces a fresh complete one.
+
+        :param directory_path: The directory that was listed.
+        :param files: The filenames in the directory.
+        :param complete: Whether the listing includes every file in the directory.
+        """
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            existing = self.__listings.get(directory_path)
+            if not complete and existing is not None and existing[3] and now - existing[0] <= self.ttl:
+                return
+            # dropping expired listings means a pass over all of them, so it is done at most once per ttl
+            if now - self.__last_purge > self.ttl:
+                self.__last_purge = now
+                for expired_path in [path for path, listing in self.__listings.items() if now - listing[0] > self.ttl]:
+                    self.__remove(expired_path)
+            self.__remove(directory_path)
+            files = list(files)
+            self.__listings[directory_path] = (now, files, set(files), complete)
+            self.__directories.setdefault(directory_path.rstrip("/"), set()).add(directory_path)
+            while len(self.__listings) > self.max_entries:
+                self.__remove(next(iter(self.__listings)))
+
+    def add_file(self, path):
+        """
+        Record that a file has been written, updating any cached listings that contain it.
+
+        Complete listings get the new file added in place. Partial listings are dropped,
+        since the new file might belong among their first few files.
+
+        :param path: The path of the file that was written.
+        """
+        with self.__lock:
+            for directory_path, relative_path in self.__listings_containing(path):
+                fetched_at, files, names, complete = self.__listings[directory_path]
+                if not complete:
+                    self.__remove(directory_path)
+                elif relative_path not in names:
+                    files.append(relative_path)
+                    names.add(relative_path)
+
+    def remove_file(self, path):
+        """
+        Record that a file has been deleted, updating any cached listings that contain it.
+
+        Partial listings are dropped, since their next file is not known.
+
+        :param path: The path of the file that was deleted.
+        """
+        with self.__lock:
+            for directory_path, relative_path in self.__listings_containing(path):
+                fetched_at, files, names, complete = self.__listings[directory_path]
+                if not complete:
+                    self.__remove(directory_path)
+                elif relative_path in names:
+                    files.remove(relative_path)
+                    names.discard(relative_path)
+
+    def clear(self):
+        """
+        Remove every cached listing.
+        """
+        with self.__lock:
+            self.__listings.clear()
+            self.__directories.clear()
+
+    def __len__(self):
+        return len(self.__listings)
+
+    def __listings_containing(self, path):
+        # caller must hold the lock - the (directory path, path relative to it) of every cached
+        # listing of a directory above the file
+        found = []
+        parts = path.split("/")
+        for depth in range(len(parts)-1, -1, -1):
+            directory = "/".join(parts[:depth])
+            for directory_path in self.__directories.get(directory, ()):
+                found.append((directory_path, "/".join(parts[depth:])))
+        return found
+
+    def __remove(self, directory_path):
+        # caller must hold the lock
+        if self.__listings.pop(directory_path, None) is None:
+            return
+        directory = directory_path.rstrip("/")
+        cached_paths = self.__directories[directory]
+        cached_paths.discard(directory_path)
+        if not cached_paths:
+            del self.__directories[directory]
+
+
+class TTLCache:
+    """
+    Thread-safe cache whose entries expire a fixed number of seconds after they are added.
+
+    The number of entries is bounded - when it is full, the oldest entry is evicted.
+    A ttl of 0 disables the cache.
+
+    Attributes:
+    - ttl (float): The number of seconds an entry is kept for.
+    - max_entries (int): The maximum number of entries.
+    """
+    def __init__(self, ttl, max_entries):
+        """
+        Initialize a new TTLCache instance.
+
+        :param ttl: The number of seconds an entry is kept for.
+        :param max_entries: The maximum number of entries.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get an entry if it hasn't expired.
+
+        :param key: The key of the entry.
+        :param default: The value to return if the key is not cached (or has expired).
+        :return: The cached value, or default.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+            if time.monotonic() - entry[0] > self.ttl:
+                del self.__entries[key]
+                return default
+            return entry[1]
+
+    def put(self, key, value):
+        """
+        Add or replace an entry, restarting its time-to-live.
+
+        :param key: The key of the entry.
+        :param value: The value to cache.
+        """
+        if self.ttl <= 0:
+            return
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.monotonic(), value)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove an entry if it is cached.
+
+        :param key: The key of the entry to remove.
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
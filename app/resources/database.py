@@ -1,21 +1,71 @@
-from  app.config import USE_AWS
-from .aws_resources import get_dynamodb_resource
-from .local_resources import get_local_db, save_local_db
+from  app.config import USE_AWS, LOCAL_DB_BACKEND, PROJECT_CLASSES_CACHE_TTL
+from flask import g, has_app_context
+from .aws_resources import get_dynamodb_table, get_shared_dynamodb_resource
+from botocore.exceptions import ClientError
+from .local_resources import get_local_item, put_local_item, update_local_item, delete_local_item, append_to_local_list
+from .sqlite_resources import get_sqlite_item, get_sqlite_items, put_sqlite_item, update_sqlite_item, delete_sqlite_item, append_to_sqlite_list
+from .cache import TTLCache
 import logging
 import datetime
+import time
+import copy
 
 # This file contains the functions for doing CRUD operations with either
 # AWS resources (DynamoDB) or the DB file on the local file system.
 # For each CRUD operation, we have one AWS and one local funciont,
 # and then there is a wrapper that determines which to call based on the
 # USE_AWS environment variable.
+# When running locally with LOCAL_DB_BACKEND set to "sqlite", the wrappers call
+# the SQLite version of each operation instead of the local JSON one.
+#
+# Reads from the tables in _item_caches are cached twice: for the rest of the current request
+# (in flask.g, so one callback never reads the same item twice) and across requests for a
+# short time-to-live. Writes made through the wrappers here drop the cached copies.
+
+
+# cross-request caches by table name, keyed by key value - the values are items, or None for missing items
+_item_caches = {
+    "project-classes": TTLCache(PROJECT_CLASSES_CACHE_TTL, 10000),
+}
+_NOT_CACHED = object()
+
+def _request_item_cache():
+    # the per-request cache, or None outside of a request (e.g., in a background export job)
+    if not has_app_context():
+        return None
+    if "db_item_cache" not in g:
+        g.db_item_cache = {}
+    return g.db_item_cache
+
+def _get_cached_item(table_name,key_value):
+    request_cache = _request_item_cache()
+    if request_cache is not None and (table_name,key_value) in request_cache:
+        return request_cache[(table_name,key_value)]
+    item = _item_caches[table_name].get(key_value,_NOT_CACHED)
+    if item is not _NOT_CACHED and request_cache is not None:
+        request_cache[(table_name,key_value)] = item
+    return item
+
+def _cache_item(table_name,key_value,item):
+    _item_caches[table_name].put(key_value,item)
+    request_cache = _request_item_cache()
+    if request_cache is not None:
+        request_cache[(table_name,key_value)] = item
+
+def _invalidate_cached_item(table_name,key_value):
+    if table_name not in _item_caches:
+        return
+    _item_caches[table_name].invalidate(key_value)
+    request_cache = _request_item_cache()
+    if request_cache is not None:
+        request_cache.pop((table_name,key_value),None)
 
 
 def get_db_item_aws(table_name,key,key_value,default_return=None):
     """
     Retrieve an item from an AWS DynamoDB table.
 
-    This function connects to the DynamoDB resource, retrieves the specified table,
+    This function gets the (cached) handle for the specified DynamoDB table,
     and attempts to get the item with the given key and key value. If the item is
     not found, it returns the default return value.
 
@@ -25,8 +75,7 @@ def get_db_item_aws(table_name,key,key_value,default_return=None):
     :param default_return: The value to return if the item is not found.
     :return: The retrieved item, or the default return value if not found.
     """
-    dynamodb = get_dynamodb_resource()
-    db_table = dynamodb.Table(table_name)
+    db_table = get_dynamodb_table(table_name)
     response = db_table.get_item(Key={key:key_value})
     return_item = default_return
     if "Item" in response:
@@ -38,9 +87,9 @@ def get_db_item_local(table_name,key_value,default_return=None):
     """
     Retrieve an item from a local database.
 
-    This function reads the local database JSON file, retrieves the specified table,
-    and attempts to get the item with the given key value. If the item is not found,
-    it returns the default return value.
+    This function looks up the item with the given key value in the specified table of
+    the (in-memory) local database. If the item is not found, it returns the default
+    return value.
 
     :param table_name: The name of the local database table.
     :param key_value: The key value for the item to retrieve.
@@ -51,11 +100,23 @@ def get_db_item_local(table_name,key_value,default_return=None):
     - design decision: allowing the key value to be a regular dictionary key 
     - not using the partition key with key value like DynamoDB uses
     """
-    local_db = get_local_db()
-    db_table = local_db[table_name]
-    return_item = default_return
-    if key_value in db_table:
-        return_item = db_table[key_value]
+    return_item = get_local_item(table_name,key_value)
+    if return_item is None:
+        return_item = default_return
+    return return_item
+
+def get_db_item_sqlite(table_name,key_value,default_return=None):
+    """
+    Retrieve an item from the local SQLite database.
+
+    :param table_name: The name of the local database table.
+    :param key_value: The key value for the item to retrieve.
+    :param default_return: The value to return if the item is not found.
+    :return: The retrieved item, or the default return value if not found.
+    """
+    return_item = get_sqlite_item(table_name,key_value)
+    if return_item is None:
+        return_item = default_return
     return return_item
 
 def get_db_item(table_name,key_name,key_value,default_return=None):
@@ -64,7 +125,8 @@ def get_db_item(table_name,key_name,key_value,default_return=None):
 
     This function checks the USE_AWS flag to determine whether to retrieve the item
     from an AWS DynamoDB table or from a local database. It delegates the retrieval
-    to the appropriate function based on this decision.
+    to the appropriate function based on this decision. Items from cached tables
+    (see _item_caches) are served from the cache when possible.
 
     :param table_name: The name of the database table.
     :param key_name: The key of the item to retrieve (used only for AWS).
@@ -72,17 +134,136 @@ def get_db_item(table_name,key_name,key_value,default_return=None):
     :param default_return: The value to return if the item is not found.
     :return: The retrieved item, or the default return value if not found.
     """
+    if table_name in _item_caches:
+        item = _get_cached_item(table_name,key_value)
+        if item is _NOT_CACHED:
+            item = _get_db_item_uncached(table_name,key_name,key_value,None)
+            _cache_item(table_name,key_value,item)
+        # callers may change what they get back, so they can't have the cached copy
+        return copy.deepcopy(item) if item is not None else default_return
+    return _get_db_item_uncached(table_name,key_name,key_value,default_return)
+
+def _get_db_item_uncached(table_name,key_name,key_value,default_return):
     if USE_AWS:
         return get_db_item_aws(table_name,key_name,key_value,default_return)
+    elif LOCAL_DB_BACKEND == "sqlite":
+        return get_db_item_sqlite(table_name,key_value,default_return)
     else:
         return get_db_item_local(table_name,key_value,default_return)
     
 
+# DynamoDB's BatchGetItem takes at most this many keys per request
+BATCH_GET_MAX_KEYS = 100
+
+# how many times keys left unprocessed by BatchGetItem are retried before giving up
+BATCH_GET_MAX_RETRIES = 8
+
+def batch_get_db_items_aws(table_name,key_name,key_values):
+    """
+    Retrieve several items from an AWS DynamoDB table with BatchGetItem.
+
+    The keys are sent 100 at a time (the most BatchGetItem allows), and any keys
+    DynamoDB leaves unprocessed (e.g., when throttled) are retried with a short backoff,
+    up to BATCH_GET_MAX_RETRIES times.
+
+    :param table_name: The name of the DynamoDB table.
+    :param key_name: The name of the key.
+    :param key_values: The key values of the items to retrieve.
+    :return: A dictionary mapping each key value that was found to its item.
+    :raises ClientError: (ProvisionedThroughputExceededException) if keys are still unprocessed after the last retry.
+    """
+    dynamodb = get_shared_dynamodb_resource()
+    unique_key_values = list(dict.fromkeys(key_values))
+    items = {}
+    for start in range(0, len(unique_key_values), BATCH_GET_MAX_KEYS):
+        request_items = {table_name: {"Keys": [{key_name:key_value} for key_value in unique_key_values[start:start+BATCH_GET_MAX_KEYS]]}}
+        attempt = 0
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response.get("Responses", {}).get(table_name, []):
+                items[item[key_name]] = item
+            request_items = response.get("UnprocessedKeys") or {}
+            if request_items:
+                attempt += 1
+                if attempt > BATCH_GET_MAX_RETRIES:
+                    unprocessed = len(request_items.get(table_name, {}).get("Keys", []))
+                    logging.error("BatchGetItem on %s left %d keys unprocessed after %d retries", table_name, unprocessed, BATCH_GET_MAX_RETRIES)
+                    raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException",
+                                                 "Message": "{} keys still unprocessed after {} retries".format(unprocessed, BATCH_GET_MAX_RETRIES)}},
+                                      "BatchGetItem")
+                time.sleep(min(0.05*(2**attempt), 1.0))
+    return items
+
+def batch_get_db_items_local(table_name,key_values):
+    """
+    Retrieve several items from the local database.
+
+    :param table_name: The name of the local database table.
+    :param key_values: The key values of the items to retrieve.
+    :return: A dictionary mapping each key value that was found to its item.
+    """
+    items = {}
+    for key_value in key_values:
+        item = get_local_item(table_name,key_value)
+        if item is not None:
+            items[key_value] = item
+    return items
+
+def batch_get_db_items_sqlite(table_name,key_values):
+    """
+    Retrieve several items from the local SQLite database in one query.
+
+    :param table_name: The name of the local database table.
+    :param key_values: The key values of the items to retrieve.
+    :return: A dictionary mapping each key value that was found to its item.
+    """
+    return get_sqlite_items(table_name,key_values)
+
+def batch_get_db_items(table_name,key_name,key_values):
+    """
+    Retrieve several items from the database at once, either AWS DynamoDB or local.
+
+    On AWS, this is one BatchGetItem request per 100 keys instead of one GetItem per key.
+
+    :param table_name: The name of the database table.
+    :param key_name: The name of the key (used only for AWS).
+    :param key_values: The key values of the items to retrieve.
+    :return: A dictionary mapping each key value that was found to its item. Keys that
+        were not found are left out.
+    """
+    if table_name not in _item_caches:
+        return _batch_get_db_items_uncached(table_name,key_name,key_values)
+
+    items = {}
+    missing_key_values = []
+    for key_value in key_values:
+        item = _get_cached_item(table_name,key_value)
+        if item is _NOT_CACHED:
+            missing_key_values.append(key_value)
+        elif item is not None:
+            items[key_value] = copy.deepcopy(item)
+    if missing_key_values:
+        fetched_items = _batch_get_db_items_uncached(table_name,key_name,missing_key_values)
+        for key_value in missing_key_values:
+            _cache_item(table_name,key_value,fetched_items.get(key_value))
+            if key_value in fetched_items:
+                items[key_value] = copy.deepcopy(fetched_items[key_value])
+    return items
+
+def _batch_get_db_items_uncached(table_name,key_name,key_values):
+    if USE_AWS:
+        return batch_get_db_items_aws(table_name,key_name,key_values)
+    elif LOCAL_DB_BACKEND == "sqlite":
+        return batch_get_db_items_sqlite(table_name,key_values)
+    else:
+        return batch_get_db_items_local(table_name,key_values)
+
+
 def put_db_item_aws(table_name,key_name,key_value,item_name,item_value):
     """
     Put an item into an AWS DynamoDB table.
 
-    This function connects to the DynamoDB resource, retrieves the specified table,
+    This function gets the (cached) handle for the specified DynamoDB table,
     and puts the item with the given key and key value.
 
     :param table_name: The name of the DynamoDB table.
@@ -91,8 +272,7 @@ def put_db_item_aws(table_name,key_name,key_value,item_name,item_value):
     :param item_name: The name of the attribute to put.
     :param item_value: The value of the attribute to put.
     """
-    dynamodb = get_dynamodb_resource()
-    db_table = dynamodb.Table(table_name)
+    db_table = get_dynamodb_table(table_name)
     db_table.put_item(Item={key_name:key_value,item_name:item_value})
 
 # design decision: allowing the key value to be a regular dictionary key 
@@ -101,8 +281,8 @@ def put_db_item_local(table_name,key_value,item_name,item_value):
     """
     Put an item into a local database.
 
-    This function reads the local database JSON file, retrieves the specified table,
-    and puts the item with the given key value.
+    This function puts the item with the given key value into the specified table of the
+    local database (appending the change to the local database's log).
 
     :param table_name: The name of the local database table.
     :param key_value: The key value for the item.
@@ -113,10 +293,18 @@ def put_db_item_local(table_name,key_value,item_name,item_value):
     - design decision: allowing the key value to be a regular dictionary key 
     - not using the partition key with key value like DynamoDB uses
     """
-    local_db = get_local_db()
-    db_table = local_db[table_name]
-    db_table[key_value] = {item_name:item_value}
-    save_local_db(local_db)
+    put_local_item(table_name,key_value,{item_name:item_value})
+
+def put_db_item_sqlite(table_name,key_value,item_name,item_value):
+    """
+    Put an item into the local SQLite database, replacing any existing item with the same key.
+
+    :param table_name: The name of the local database table.
+    :param key_value: The key value for the item.
+    :param item_name: The name of the attribute to put.
+    :param item_value: The value of the attribute to put.
+    """
+    put_sqlite_item(table_name,key_value,{item_name:item_value})
 
 def put_db_item(table_name,key_name,key_value,item_name,item_value):
     """
@@ -132,17 +320,22 @@ def put_db_item(table_name,key_name,key_value,item_name,item_value):
     :param item_name: The name of the attribute to put.
     :param item_value: The value of the attribute to put.
     """
-    if USE_AWS:
-        return put_db_item_aws(table_name,key_name,key_value,item_name,item_value)
-    else:
-        return put_db_item_local(table_name,key_value,item_name,item_value)
+    try:
+        if USE_AWS:
+            return put_db_item_aws(table_name,key_name,key_value,item_name,item_value)
+        elif LOCAL_DB_BACKEND == "sqlite":
+            return put_db_item_sqlite(table_name,key_value,item_name,item_value)
+        else:
+            return put_db_item_local(table_name,key_value,item_name,item_value)
+    finally:
+        _invalidate_cached_item(table_name,key_value)
        
 
 def delete_db_item_aws(table_name,key_name,key_value):
     """
     Delete an item from an AWS DynamoDB table.
 
-    This function connects to the DynamoDB resource, retrieves the specified table,
+    This function gets the (cached) handle for the specified DynamoDB table,
     and deletes the item with the given key and key value.
 
     :param table_name: The name of the DynamoDB table.
@@ -150,8 +343,7 @@ def delete_db_item_aws(table_name,key_name,key_value):
     :param key_value: The value of the key for the item.
     :return: The response from the DynamoDB delete operation.
     """
-    dynamodb = get_dynamodb_resource()
-    db_table = dynamodb.Table(table_name)
+    db_table = get_dynamodb_table(table_name)
     response = db_table.delete_item(Key={key_name: key_value})
     return response
 
@@ -161,20 +353,24 @@ def delete_db_item_local(table_name,key_value):
     """
     Delete an item from a local database.
 
-    This function reads the local database JSON file, retrieves the specified table,
-    and deletes the item with the given key value if it exists.
+    This function deletes the item with the given key value from the specified table of
+    the local database, if it exists.
 
     :param table_name: The name of the local database table.
     :param key_value: The key value for the item.
     :return: True if the item was successfully deleted, False if the item was not found.
     """
-    local_db = get_local_db()
-    db_table = local_db[table_name]
-    if key_value in db_table:
-        db_table.remove(key_value)
-        save_local_db(local_db)
-        return True
-    return False
+    return delete_local_item(table_name,key_value)
+
+def delete_db_item_sqlite(table_name,key_value):
+    """
+    Delete an item from the local SQLite database.
+
+    :param table_name: The name of the local database table.
+    :param key_value: The key value for the item.
+    :return: True if the item was successfully deleted, False if the item was not found.
+    """
+    return delete_sqlite_item(table_name,key_value)
 
 def delete_db_item(table_name,key_name,key_value):
     """
@@ -189,17 +385,22 @@ def delete_db_item(table_name,key_name,key_value):
     :param key_value: The value of the key for the item.
     :return: The response from the delete operation (AWS) or a boolean indicating success (local).
     """
-    if USE_AWS:
-        return delete_db_item_aws(table_name,key_name,key_value)
-    else:
-        return delete_db_item_local(table_name,key_value)
+    try:
+        if USE_AWS:
+            return delete_db_item_aws(table_name,key_name,key_value)
+        elif LOCAL_DB_BACKEND == "sqlite":
+            return delete_db_item_sqlite(table_name,key_value)
+        else:
+            return delete_db_item_local(table_name,key_value)
+    finally:
+        _invalidate_cached_item(table_name,key_value)
 
 
 def update_db_item_aws(table_name,key_name,key_value,item_name,item_value):
     """
     Update an item in an AWS DynamoDB table.
 
-    This function connects to the DynamoDB resource, retrieves the specified table,
+    This function gets the (cached) handle for the specified DynamoDB table,
     and updates the item with the given key and key value, setting the specified 
     attribute to the new value.
 
@@ -210,8 +411,7 @@ def update_db_item_aws(table_name,key_name,key_value,item_name,item_value):
     :param item_value: The new value of the attribute.
     :return: The response from the DynamoDB update operation.
     """
-    dynamodb = get_dynamodb_resource()
-    db_table = dynamodb.Table(table_name)
+    db_table = get_dynamodb_table(table_name)
 
     response = db_table.update_item(
         Key = {key_name:key_value},
@@ -229,7 +429,8 @@ def update_db_item_local(table_name,key_value,item_name,item_value):
     """
     Update an item in a local database.
 
-    This function uses the put_db_item_local function to update the item in the local database.
+    Like DynamoDB's update_item, only the given attribute is set - the item's other
+    attributes are kept, and the item is created if it doesn't exist.
 
     :param table_name: The name of the local database table.
     :param key_value: The key value for the item.
@@ -237,7 +438,23 @@ def update_db_item_local(table_name,key_value,item_name,item_value):
     :param item_value: The new value of the attribute.
     :return: True - need to check what AWS's response is and change this to emulate that
     """
-    put_db_item_local(table_name,key_value,item_name,item_value)
+    update_local_item(table_name,key_value,item_name,item_value)
+    return True
+
+def update_db_item_sqlite(table_name,key_value,item_name,item_value):
+    """
+    Update an item in the local SQLite database.
+
+    Like DynamoDB's update_item, only the given attribute is set - the item's other
+    attributes are kept, and the item is created if it doesn't exist.
+
+    :param table_name: The name of the local database table.
+    :param key_value: The key value for the item.
+    :param item_name: The name of the attribute to update.
+    :param item_value: The new value of the attribute.
+    :return: True - to match update_db_item_local
+    """
+    update_sqlite_item(table_name,key_value,item_name,item_value)
     return True
 
 def update_db_item(table_name,key_name,key_value,item_name,item_value):
@@ -255,10 +472,106 @@ def update_db_item(table_name,key_name,key_value,item_name,item_value):
     :param item_value: The new value of the attribute.
     :return: The response from the update operation (AWS) or True (local).
     """
-    if USE_AWS:
-        return update_db_item_aws(table_name,key_name,key_value,item_name,item_value)
-    else:
-        return update_db_item_local(table_name,key_value,item_name,item_value)
+    try:
+        if USE_AWS:
+            return update_db_item_aws(table_name,key_name,key_value,item_name,item_value)
+        elif LOCAL_DB_BACKEND == "sqlite":
+            return update_db_item_sqlite(table_name,key_value,item_name,item_value)
+        else:
+            return update_db_item_local(table_name,key_value,item_name,item_value)
+    finally:
+        _invalidate_cached_item(table_name,key_value)
+
+
+def append_to_db_list_aws(table_name,key_name,key_value,item_name,value,unique=False):
+    """
+    Append a value to a list attribute of an item in an AWS DynamoDB table.
+
+    This is a single UpdateItem call using list_append, so concurrent appends from
+    other workers are never lost. The list (and the item) are created if they don't exist.
+    If unique is True, a condition expression makes the update fail when the list
+    already contains the value.
+
+    :param table_name: The name of the DynamoDB table.
+    :param key_name: The name of the key for the item.
+    :param key_value: The value of the key for the item.
+    :param item_name: The name of the list attribute.
+    :param value: The value to append.
+    :param unique: Whether to skip the append if the value is already in the list.
+    :return: True if the value was appended, False if it was already in the list.
+    """
+    db_table = get_dynamodb_table(table_name)
+    update_args = {
+        "Key": {key_name:key_value},
+        "UpdateExpression": "set #item = list_append(if_not_exists(#item, :empty), :val)",
+        "ExpressionAttributeNames": {"#item": item_name},
+        "ExpressionAttributeValues": {":empty": [], ":val": [value]},
+    }
+    if unique:
+        update_args["ConditionExpression"] = "attribute_not_exists(#item) OR NOT contains(#item, :value)"
+        update_args["ExpressionAttributeValues"][":value"] = value
+    try:
+        db_table.update_item(**update_args)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
+
+def append_to_db_list_local(table_name,key_value,item_name,value,unique=False):
+    """
+    Append a value to a list attribute of an item in the local database.
+
+    The read and the write happen under the local database's lock, as one change.
+
+    :param table_name: The name of the local database table.
+    :param key_value: The key value for the item.
+    :param item_name: The name of the list attribute.
+    :param value: The value to append.
+    :param unique: Whether to skip the append if the value is already in the list.
+    :return: True if the value was appended, False if it was already in the list.
+    """
+    return append_to_local_list(table_name,key_value,item_name,value,unique)
+
+def append_to_db_list_sqlite(table_name,key_value,item_name,value,unique=False):
+    """
+    Append a value to a list attribute of an item in the local SQLite database.
+
+    The read and the write happen in one transaction.
+
+    :param table_name: The name of the local database table.
+    :param key_value: The key value for the item.
+    :param item_name: The name of the list attribute.
+    :param value: The value to append.
+    :param unique: Whether to skip the append if the value is already in the list.
+    :return: True if the value was appended, False if it was already in the list.
+    """
+    return append_to_sqlite_list(table_name,key_value,item_name,value,unique)
+
+def append_to_db_list(table_name,key_name,key_value,item_name,value,unique=False):
+    """
+    Append a value to a list attribute of an item, either in AWS DynamoDB or local.
+
+    Use this instead of get_db_item followed by put_db_item of the whole list - it is
+    one round-trip and concurrent appends can't overwrite each other.
+
+    :param table_name: The name of the database table.
+    :param key_name: The name of the key for the item (used only for AWS).
+    :param key_value: The value of the key for the item.
+    :param item_name: The name of the list attribute.
+    :param value: The value to append.
+    :param unique: Whether to skip the append if the value is already in the list.
+    :return: True if the value was appended, False if it was already in the list.
+    """
+    try:
+        if USE_AWS:
+            return append_to_db_list_aws(table_name,key_name,key_value,item_name,value,unique)
+        elif LOCAL_DB_BACKEND == "sqlite":
+            return append_to_db_list_sqlite(table_name,key_value,item_name,value,unique)
+        else:
+            return append_to_db_list_local(table_name,key_value,item_name,value,unique)
+    finally:
+        _invalidate_cached_item(table_name,key_value)
 
 
 #!! Am I actually using this anywhere?
@@ -1,12 +1,35 @@
 import os
 import json
+import copy
+import logging
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows - only one process can safely use the local DB
+    fcntl = None
 
-from ..config import LOCAL_FOLDER, LOCAL_DB_FILE
+from ..config import LOCAL_FOLDER, LOCAL_DB_FILE, LOCAL_DB_WAL_FILE, LOCAL_DB_WAL_MAX_BYTES
 
 # These functions are for loading/saving to local files when the USE_AWS environment variable is false
 # LOCAL_FOLDER is based on an environment variable and will be the local location where we're storing files.
 # LOCAL_DB_FILE is the local JSON file we're using as a stand-in for a nosql database like DynamoDB
 # This probably wouldn't scale well, but since it is for a single user, it will probably be fine.
+#
+# The JSON database is loaded into memory once and reads are served from there. Changes are
+# not written by rewriting LOCAL_DB_FILE - each one is appended as a line of JSON to a log file
+# (LOCAL_DB_WAL_FILE) and fsynced, and the in-memory copy is updated. Once the log
+# grows past LOCAL_DB_WAL_MAX_BYTES, it is folded back into LOCAL_DB_FILE (compaction).
+# Before every operation, the modification time and size of both files are checked, so changes
+# made by other processes (or by hand) are picked up: a changed LOCAL_DB_FILE is reloaded, and
+# new lines in the log are replayed.
+
+_local_db = None
+# (mtime_ns, size) of LOCAL_DB_FILE when it was loaded
+_snapshot_version = None
+# how many bytes of the log have been applied to _local_db
+_wal_offset = 0
+_local_db_lock = threading.RLock()
+
 
 def get_local_folder():
     """
@@ -22,26 +45,233 @@ def get_local_folder():
 
 def get_local_db():
     """
-    Load the local database from a JSON file.
-
-    This function checks if the local database file exists. If not, it creates
-    an empty JSON file. It then reads and returns the contents of the file.
+    Get a copy of the whole local database.
 
     :return: The contents of the local database as a dictionary.
     """
-    if not os.path.exists(LOCAL_DB_FILE):
-        with open(LOCAL_DB_FILE, 'w') as f:
-            json.dump({}, f)
-    with open(LOCAL_DB_FILE, 'r') as f:
-        return json.load(f)
+    with _local_db_lock:
+        _refresh_local_db()
+        return copy.deepcopy(_local_db)
 
 def save_local_db(data):
     """
-    Save data to the local database JSON file.
+    Replace the whole local database.
 
-    This function writes the provided data to the local database file in JSON format.
+    This function writes the provided data to the local database file in JSON format
+    and clears the log of changes.
 
     :param data: The data to save to the local database.
     """
-    with open(LOCAL_DB_FILE, 'w') as f:
-        json.dump(data, f)
+    global _local_db
+    with _local_db_lock, _WalLock():
+        _local_db = copy.deepcopy(data)
+        _write_snapshot()
+
+def get_local_item(table_name, key_value):
+    """
+    Read an item from the local database.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :return: A copy of the item, or None if it doesn't exist.
+    """
+    with _local_db_lock:
+        _refresh_local_db()
+        item = _local_db.get(table_name, {}).get(key_value)
+        return copy.deepcopy(item)
+
+def put_local_item(table_name, key_value, item):
+    """
+    Create or replace an item in the local database.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :param item: The item.
+    """
+    with _local_db_lock, _WalLock():
+        _refresh_local_db()
+        _append_to_wal({"op": "put", "table": table_name, "key": key_value, "item": item})
+
+def update_local_item(table_name, key_value, item_name, item_value):
+    """
+    Set one attribute of an item in the local database, creating the item if it doesn't exist.
+
+    Like DynamoDB's update_item, the item's other attributes are kept.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :param item_name: The name of the attribute to set.
+    :param item_value: The new value of the attribute.
+    """
+    with _local_db_lock, _WalLock():
+        _refresh_local_db()
+        item = copy.deepcopy(_local_db.get(table_name, {}).get(key_value)) or {}
+        item[item_name] = item_value
+        _append_to_wal({"op": "put", "table": table_name, "key": key_value, "item": item})
+
+def append_to_local_list(table_name, key_value, item_name, value, unique=False):
+    """
+    Append a value to a list attribute of an item in the local database, as one change.
+
+    The item and the list are created if they don't exist.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :param item_name: The name of the list attribute.
+    :param value: The value to append.
+    :param unique: Whether to skip the append if the value is already in the list.
+    :return: True if the value was appended, False if it was already in the list.
+    """
+    with _local_db_lock, _WalLock():
+        _refresh_local_db()
+        item = copy.deepcopy(_local_db.get(table_name, {}).get(key_value)) or {}
+        values = item.setdefault(item_name, [])
+        if unique and value in values:
+            return False
+        values.append(value)
+        _append_to_wal({"op": "put", "table": table_name, "key": key_value, "item": item})
+        return True
+
+def delete_local_item(table_name, key_value):
+    """
+    Delete an item from the local database.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :return: True if the item was deleted, False if it didn't exist.
+    """
+    with _local_db_lock, _WalLock():
+        _refresh_local_db()
+        if key_value not in _local_db.get(table_name, {}):
+            return False
+        _append_to_wal({"op": "delete", "table": table_name, "key": key_value})
+        return True
+
+
+class _WalLock:
+    """
+    Exclusive lock between processes for writing to the local database (a no-op without fcntl).
+    It is only ever taken while holding _local_db_lock, and must not be nested.
+    """
+    # whether this process holds the lock (only read or changed while holding _local_db_lock)
+    held = False
+
+    def __enter__(self):
+        self.__file = open(LOCAL_DB_WAL_FILE + ".lock", "a")
+        if fcntl is not None:
+            fcntl.flock(self.__file, fcntl.LOCK_EX)
+        _WalLock.held = True
+        return self
+
+    def __exit__(self, *exc_info):
+        _WalLock.held = False
+        if fcntl is not None:
+            fcntl.flock(self.__file, fcntl.LOCK_UN)
+        self.__file.close()
+
+
+def _file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _apply(record):
+    # caller must hold _local_db_lock
+    if record["op"] == "put":
+        _local_db.setdefault(record["table"], {})[record["key"]] = record["item"]
+    elif record["op"] == "delete":
+        _local_db.get(record["table"], {}).pop(record["key"], None)
+
+def _refresh_local_db():
+    """
+    Bring the in-memory database up to date with LOCAL_DB_FILE and the log.
+    The caller must hold _local_db_lock.
+    """
+    global _local_db, _snapshot_version, _wal_offset
+    snapshot_version = _file_version(LOCAL_DB_FILE)
+    wal_version = _file_version(LOCAL_DB_WAL_FILE)
+    wal_size = wal_version[1] if wal_version else 0
+
+    # If anything changed, catch up while holding the _WalLock - another process may be in the middle of
+    # compacting, which rewrites LOCAL_DB_FILE (possibly in place, see _write_snapshot) and then empties
+    # and refills the log, so neither file can be trusted until it is done
+    changed = _local_db is None or snapshot_version != _snapshot_version or wal_size != _wal_offset
+    if changed and not _WalLock.held:
+        with _WalLock():
+            return _refresh_local_db()
+
+    if _local_db is None or snapshot_version != _snapshot_version or wal_size < _wal_offset:
+        if snapshot_version is None:
+            with open(LOCAL_DB_FILE, 'w') as f:
+                json.dump({}, f)
+            snapshot_version = _file_version(LOCAL_DB_FILE)
+        with open(LOCAL_DB_FILE, 'r') as f:
+            _local_db = json.load(f)
+        _snapshot_version = snapshot_version
+        _wal_offset = 0
+
+    if wal_size > _wal_offset:
+        with open(LOCAL_DB_WAL_FILE, 'rb') as f:
+            f.seek(_wal_offset)
+            new_data = f.read()
+        # a line without a newline at the end is still being written (or was cut off by a crash)
+        complete_length = new_data.rfind(b"\n") + 1
+        for line in new_data[:complete_length].splitlines():
+            try:
+                _apply(json.loads(line))
+            except (ValueError, KeyError) as e:
+                logging.error("Skipping a bad line in the local DB log: %s", e)
+        _wal_offset += complete_length
+
+def _append_to_wal(record):
+    """
+    Write one change to the log (and fsync it), apply it in memory, and compact if the log is too big.
+    The caller must hold _local_db_lock and the _WalLock, and must have just refreshed the in-memory
+    database (so the log has no lines from other processes that we would skip past).
+    """
+    global _wal_offset
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    with open(LOCAL_DB_WAL_FILE, 'ab') as f:
+        # anything past what we've applied is the start of a line cut off by a crashed writer - drop it
+        # so it doesn't swallow this line
+        if os.fstat(f.fileno()).st_size > _wal_offset:
+            f.truncate(_wal_offset)
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    _apply(json.loads(line))
+    _wal_offset += len(line)
+    if _wal_offset > LOCAL_DB_WAL_MAX_BYTES:
+        _write_snapshot()
+
+def _write_snapshot():
+    """
+    Write the in-memory database to LOCAL_DB_FILE and empty the log.
+    The caller must hold _local_db_lock and the _WalLock.
+
+    The new file is written next to the old one and renamed over it, so LOCAL_DB_FILE is never
+    half-written. If we crash before the log is emptied, replaying it again is harmless.
+    """
+    global _snapshot_version, _wal_offset
+    temp_file = LOCAL_DB_FILE + ".tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(_local_db, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, LOCAL_DB_FILE)
+    except OSError:
+        # LOCAL_DB_FILE can't be replaced when it is bind-mounted on its own (e.g. in Docker),
+        # so fall back to rewriting it in place
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        with open(LOCAL_DB_FILE, 'w') as f:
+            json.dump(_local_db, f)
+            f.flush()
+            os.fsync(f.fileno())
+    with open(LOCAL_DB_WAL_FILE, 'wb') as f:
+        os.fsync(f.fileno())
+    _snapshot_version = _file_version(LOCAL_DB_FILE)
+    _wal_offset = 0
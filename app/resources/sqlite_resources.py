@@ -0,0 +1,200 @@
+import os
+import json
+import sqlite3
+import threading
+import logging
+
+from ..config import LOCAL_DB_FILE, LOCAL_DB_WAL_FILE, LOCAL_SQLITE_DB_FILE
+from .local_resources import get_local_db
+
+# These functions are for the SQLite stand-in for DynamoDB, used when USE_AWS is false and
+# LOCAL_DB_BACKEND is "sqlite".
+# Every table lives in one "items" table, with one row per item: the table name, the item's key,
+# and the item itself (a dictionary of attributes) as JSON. Unlike the JSON file, a write only
+# touches its own row, and the database runs in WAL mode, so several worker processes can
+# read and write it at once without losing each other's updates.
+# The first time the SQLite file is opened, the contents of the JSON local database (LOCAL_DB_FILE
+# plus any changes still in its log) are copied into it - see migrate_json_db.
+
+# connections can't be shared between threads, so each thread opens its own
+_thread_local = threading.local()
+
+# how long (in milliseconds) a write waits for another process's write to finish before giving up
+BUSY_TIMEOUT_MS = 5000
+
+
+def get_sqlite_db():
+    """
+    Get this thread's connection to the SQLite database, opening it (and setting it up) on first use.
+
+    :return: The sqlite3 connection.
+    """
+    connection = getattr(_thread_local, "connection", None)
+    if connection is None:
+        directory = os.path.dirname(LOCAL_SQLITE_DB_FILE)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # isolation_level=None means we start transactions ourselves
+        connection = sqlite3.connect(LOCAL_SQLITE_DB_FILE, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT_MS))
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS items ("
+                           "table_name TEXT NOT NULL, item_key TEXT NOT NULL, item TEXT NOT NULL, "
+                           "PRIMARY KEY (table_name, item_key)) WITHOUT ROWID")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        migrate_json_db(connection)
+        _thread_local.connection = connection
+    return connection
+
+
+def migrate_json_db(connection):
+    """
+    Copy the contents of the JSON local database into the SQLite database, once.
+
+    The JSON database is read through local_resources, so changes that are still in its log
+    (LOCAL_DB_WAL_FILE) and haven't been compacted into LOCAL_DB_FILE are copied too.
+    The migration runs in a single transaction and is recorded in the meta table, so it only
+    ever happens once even if several processes start at the same time. The JSON files are left
+    as they are.
+
+    :param connection: The sqlite3 connection.
+    :return: The number of items copied.
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        if connection.execute("SELECT 1 FROM meta WHERE name = 'migrated_from'").fetchone() is not None:
+            connection.execute("COMMIT")
+            return 0
+        rows = []
+        if os.path.exists(LOCAL_DB_FILE) or os.path.exists(LOCAL_DB_WAL_FILE):
+            for table_name, db_table in get_local_db().items():
+                for key_value, item in db_table.items():
+                    rows.append((table_name, key_value, json.dumps(item)))
+        connection.executemany("INSERT OR IGNORE INTO items (table_name, item_key, item) VALUES (?, ?, ?)", rows)
+        connection.execute("INSERT INTO meta (name, value) VALUES ('migrated_from', ?)", (os.path.abspath(LOCAL_DB_FILE),))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    if rows:
+        logging.info("Copied %d items from %s into the SQLite database", len(rows), LOCAL_DB_FILE)
+    return len(rows)
+
+
+def get_sqlite_item(table_name, key_value):
+    """
+    Read an item from the SQLite database.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :return: The item (a dictionary of attributes), or None if it doesn't exist.
+    """
+    row = get_sqlite_db().execute("SELECT item FROM items WHERE table_name = ? AND item_key = ?",
+                                  (table_name, key_value)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def get_sqlite_items(table_name, key_values):
+    """
+    Read several items from the SQLite database in one query.
+
+    :param table_name: The name of the table.
+    :param key_values: The key values of the items.
+    :return: A dictionary mapping each key value that was found to its item.
+    """
+    unique_key_values = list(dict.fromkeys(key_values))
+    items = {}
+    # stay well under SQLite's limit on the number of parameters in one statement
+    for start in range(0, len(unique_key_values), 500):
+        chunk = unique_key_values[start:start+500]
+        rows = get_sqlite_db().execute("SELECT item_key, item FROM items WHERE table_name = ? AND item_key IN ({})".format(",".join("?"*len(chunk))),
+                                       [table_name] + chunk).fetchall()
+        for item_key, item in rows:
+            items[item_key] = json.loads(item)
+    return items
+
+
+def put_sqlite_item(table_name, key_value, item):
+    """
+    Create or replace an item in the SQLite database.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :param item: The item (a dictionary of attributes).
+    """
+    get_sqlite_db().execute("INSERT OR REPLACE INTO items (table_name, item_key, item) VALUES (?, ?, ?)",
+                            (table_name, key_value, json.dumps(item)))
+
+
+def update_sqlite_item(table_name, key_value, item_name, item_value):
+    """
+    Set one attribute of an item in the SQLite database, creating the item if it doesn't exist.
+
+    The read and the write happen in one transaction, so concurrent updates to other
+    attributes of the same item are not lost.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :param item_name: The name of the attribute to set.
+    :param item_value: The new value of the attribute.
+    """
+    connection = get_sqlite_db()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute("SELECT item FROM items WHERE table_name = ? AND item_key = ?",
+                                 (table_name, key_value)).fetchone()
+        item = json.loads(row[0]) if row is not None else {}
+        item[item_name] = item_value
+        connection.execute("INSERT OR REPLACE INTO items (table_name, item_key, item) VALUES (?, ?, ?)",
+                           (table_name, key_value, json.dumps(item)))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def append_to_sqlite_list(table_name, key_value, item_name, value, unique=False):
+    """
+    Append a value to a list attribute of an item in the SQLite database, in one transaction.
+
+    The item and the list are created if they don't exist.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :param item_name: The name of the list attribute.
+    :param value: The value to append.
+    :param unique: Whether to skip the append if the value is already in the list.
+    :return: True if the value was appended, False if it was already in the list.
+    """
+    connection = get_sqlite_db()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute("SELECT item FROM items WHERE table_name = ? AND item_key = ?",
+                                 (table_name, key_value)).fetchone()
+        item = json.loads(row[0]) if row is not None else {}
+        values = item.setdefault(item_name, [])
+        if unique and value in values:
+            connection.execute("COMMIT")
+            return False
+        values.append(value)
+        connection.execute("INSERT OR REPLACE INTO items (table_name, item_key, item) VALUES (?, ?, ?)",
+                           (table_name, key_value, json.dumps(item)))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return True
+
+
+def delete_sqlite_item(table_name, key_value):
+    """
+    Delete an item from the SQLite database.
+
+    :param table_name: The name of the table.
+    :param key_value: The key value of the item.
+    :return: True if the item was deleted, False if it didn't exist.
+    """
+    cursor = get_sqlite_db().execute("DELETE FROM items WHERE table_name = ? AND item_key = ?",
+                                     (table_name, key_value))
+    return cursor.rowcount > 0
@@ -1,395 +1,802 @@
 
+import io
 import logging
 import os
+import threading
+import time
 import botocore
 import shutil
+import tempfile
 from flask import url_for
-import shutil
 
-from .aws_resources import get_s3_client, get_s3_resource
+from .aws_resources import get_shared_s3_client, get_s3_bucket_name
 from .local_resources import get_local_folder
-from ..config import USE_AWS
+from .cache import LRUCache, ListingCache
+from ..config import USE_AWS, FILE_CACHE_MAX_BYTES, LISTING_CACHE_TTL, LISTING_CACHE_MAX_ENTRIES, PRESIGNED_URL_EXPIRY, PRESIGNED_URL_REFRESH_MARGIN
 
-# This file contains the functions for doing various filesystem operations with either
+# This file contains the classes and functions for doing various filesystem operations with either
 # AWS resources (S3) or the local file system.
-# For each operation, we have one AWS and one local funcion,
-# and then there is a wrapper that determines which to call based on the
-# USE_AWS environment variable.
+# Each storage backend (S3StorageBackend or LocalStorageBackend) implements the same set of
+# operations, and a single backend object is built once per process based on the
+# USE_AWS environment variable. The module-level wrappers (load_file, write_file, ...)
+# delegate to that shared backend.
+# Files read through load_file are kept in a size-bounded LRU cache and revalidated
+# against storage (ETag on S3, mtime+size locally) on every read, so a changed file
+# is never served stale but an unchanged one is not downloaded again.
+# Directory listings are cached too, and files written through write_file are added
+# to the cached listings in place.
+
+
+class StorageBackend:
+    """
+    Base class for file storage backends.
+
+    Subclasses implement each of the file operations for a particular kind of storage.
+    Paths are always relative "keys" like images/<user>/<project>/<file>.
+    """
+
+    def load_file(self, path):
+        """
+        Load a file.
+
+        :param path: The path of the file to load.
+        :return: The file content as bytes, or None if an error occurs.
+        """
+        raise NotImplementedError
+
+    def load_file_if_modified(self, path, validator):
+        """
+        Load a file only if it has changed since the given validator was produced.
+
+        A validator is an opaque value identifying one version of a file (an ETag on S3,
+        the modification time and size on the local filesystem).
 
-def load_file_from_s3(s3_path):
-    """
-    Load a file from S3 storage.
+        :param path: The path of the file to load.
+        :param validator: The validator of the cached copy, or None if there is no cached copy.
+        :return: A tuple (not_modified, data, validator). If not_modified is True the cached copy
+            is still current and data is None. Otherwise data is the file content (or None if an
+            error occurs) and validator identifies that content.
+        """
+        raise NotImplementedError
 
-    This function uses the S3 client to retrieve the file specified by the S3 path from the S3 bucket.
-    It reads the file content and returns it. If an error occurs during the process, it logs the error
-    and returns None.
+    def get_file_version(self, path):
+        """
+        Get the validator of a file's current version (see load_file_if_modified) without loading it.
 
-    :param s3_path: The S3 path of the file to load.
-    :return: The file content as bytes, or None if an error occurs.
-    """
-    s3_client = get_s3_client() 
-    _, s3_bucket = get_s3_resource()
-    s3_bucket_name = s3_bucket.name
-    try:
-        obj = s3_client.get_object(Bucket=s3_bucket_name,Key=s3_path)
-        data = obj['Body'].read()
-        return data
-    except Exception as e:
-        logging.debug("Error occurred while reading the file from S3: %s", e)
-        return None
-    
-def load_file_from_filesystem(file_path):
-    """
-    Load a file from the local filesystem.
-
-    This function retrieves the file specified by the file path from the local folder.
-    It reads the file content and returns it. If an error occurs during the process, it logs the error
-    and returns None.
-
-    :param file_path: The path of the file to load from the local filesystem.
-    :return: The file content as bytes, or None if an error occurs.
-    """
-    base_dir = get_local_folder()
-    full_path = os.path.join(base_dir,file_path)
-    try:
-        with open(full_path, 'rb') as file:
-            content = file.read()
-        return content
-    except Exception as e:
-        logging.debug("Error occurred while reading the file from the filesystem: %s", e)
-        return None
+        :param path: The path of the file.
+        :return: The validator, or None if the file doesn't exist or an error occurs.
+        """
+        raise NotImplementedError
+
+    def write_file(self, path, data):
+        """
+        Write a file.
+
+        :param path: The path where the file will be written.
+        :param data: The data to be written to the file.
+        """
+        raise NotImplementedError
+
+    def file_exists(self, path):
+        """
+        Check if a file exists.
+
+        :param path: The path of the file to check.
+        :return: True if the file exists, False otherwise.
+        """
+        raise NotImplementedError
+
+    def serve_file(self, path):
+        """
+        Get a URL that a browser can use to display the file.
+
+        :param path: The path of the file to serve.
+        :return: The URL to serve the file.
+        """
+        raise NotImplementedError
+
+    def get_files_in_directory(self, directory_path, max_files=None):
+        """
+        List the files under a directory (or prefix).
+
+        :param directory_path: The directory path to list files from.
+        :param max_files: Stop after this many files, or None to list everything.
+        :return: A list of filenames relative to the directory.
+        """
+        raise NotImplementedError
+
+    def file_download(self, remote_file, local_file):
+        """
+        Download a file from storage to a path on the local machine.
+
+        :param remote_file: The path of the file in storage.
+        :param local_file: The local path where the file will be saved.
+        """
+        raise NotImplementedError
+
+    def open_file(self, path):
+        """
+        Open a file for streaming reads.
+
+        :param path: The path of the file to open.
+        :return: A readable file-like object (the caller closes it), or None if an error occurs.
+        """
+        raise NotImplementedError
+
+    def write_file_stream(self, path, chunks):
+        """
+        Write a file from an iterable of byte strings, without holding the whole file in memory
+        or staging it anywhere else first.
+
+        Unlike write_file, errors (including any raised while producing the chunks) are raised,
+        and a partly written file is never left at the path.
+
+        :param path: The path where the file will be written.
+        :param chunks: An iterable of byte strings making up the file.
+        """
+        raise NotImplementedError
+
+    def delete_file(self, path):
+        """
+        Delete a file. Deleting a file that doesn't exist is not an error.
+
+        :param path: The path of the file to delete.
+        """
+        raise NotImplementedError
+
+
+class S3StorageBackend(StorageBackend):
+    """
+    Storage backend that keeps files in an S3 bucket.
+
+    All operations share a single pooled S3 client (see get_shared_s3_client), so
+    no boto3 sessions or clients are constructed per call. Presigned URLs are reused
+    until shortly before they expire, so the browser can cache the objects they point to.
+
+    Attributes:
+    - client: The shared S3 client.
+    - bucket_name (str): The name of the S3 bucket.
+    """
+
+    def __init__(self, client=None, bucket_name=None):
+        """
+        Initialize a new S3StorageBackend instance.
+
+        :param client: The S3 client to use (defaults to the shared process-wide client).
+        :param bucket_name: The S3 bucket name (defaults to the S3_BUCKET_NAME environment variable).
+        """
+        self.client = client if client is not None else get_shared_s3_client()
+        self.bucket_name = bucket_name if bucket_name is not None else get_s3_bucket_name()
+        # presigned URLs by key - the values are (url, expires_at) tuples
+        self.__presigned_urls = LRUCache(PRESIGNED_URL_CACHE_MAX_BYTES)
+
+    def load_file(self, s3_path):
+        """
+        Load a file from S3 storage.
+
+        This function uses the S3 client to retrieve the file specified by the S3 path from the S3 bucket.
+        It reads the file content and returns it. If an error occurs during the process, it logs the error
+        and returns None.
+
+        :param s3_path: The S3 path of the file to load.
+        :return: The file content as bytes, or None if an error occurs.
+        """
+        try:
+            obj = self.client.get_object(Bucket=self.bucket_name,Key=s3_path)
+            data = obj['Body'].read()
+            return data
+        except Exception as e:
+            logging.debug("Error occurred while reading the file from S3: %s", e)
+            return None
+
+    def load_file_if_modified(self, s3_path, validator):
+        """
+        Load a file from S3 storage unless its ETag still matches the cached copy.
+
+        This sends a conditional GET (If-None-Match), so an unchanged object costs a
+        round-trip but no data transfer.
+
+        :param s3_path: The S3 path of the file to load.
+        :param validator: The ETag of the cached copy, or None.
+        :return: A tuple (not_modified, data, etag) - see StorageBackend.load_file_if_modified.
+        """
+        request = {"Bucket": self.bucket_name, "Key": s3_path}
+        if validator:
+            request["IfNoneMatch"] = validator
+        try:
+            obj = self.client.get_object(**request)
+            return False, obj['Body'].read(), obj.get('ETag')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return True, None, validator
+            logging.debug("Error occurred while reading the file from S3: %s", e)
+            return False, None, None
+        except Exception as e:
+            logging.debug("Error occurred while reading the file from S3: %s", e)
+            return False, None, None
+
+    def get_file_version(self, s3_path):
+        """
+        Get the ETag of a file in S3 storage with a HEAD request.
+
+        :param s3_path: The S3 path of the file.
+        :return: The ETag, or None if the file doesn't exist or an error occurs.
+        """
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=s3_path).get('ETag')
+        except Exception as e:
+            logging.debug("Error occurred while checking the file in S3: %s", e)
+            return None
+
+    def write_file(self, s3_path, data):
+        """
+        Write a file to S3 storage.
+
+        This function uses the S3 client to put the file specified by the S3 path into the S3 bucket.
+        If an error occurs during the process, it logs the error.
+
+        :param s3_path: The S3 path where the file will be written.
+        :param data: The data to be written to the file.
+        """
+        try:
+            self.client.put_object(Bucket=self.bucket_name, Key=s3_path, Body=data)
+        except Exception as e:
+            logging.error("Error occurred while writing the file to S3: %s", e)
+        # the browser may have cached the old content under the old URL, so sign a new one next time
+        self.__presigned_urls.invalidate(s3_path)
+
+    def file_exists(self, s3_path):
+        """
+        Check if a file exists in S3 storage.
+
+        This function uses the S3 client to check if the file specified by the S3 path exists in the S3 bucket.
+        It returns True if the file exists, and False if it does not. If an unexpected error occurs, it logs the error
+        and raises an exception.
+
+        :param s3_path: The S3 path of the file to check.
+        :return: True if the file exists, False otherwise.
+        """
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=s3_path)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == '404':
+                # The object does not exist.
+                return False
+            else:
+                # Something else has gone wrong.
+                logging.error("Unexpected error checking for S3 file: %s", e)
+                raise
+
+    def serve_file(self, s3path):
+        """
+        Generate a presigned URL to serve a file from S3 storage.
+
+        This function uses the S3 client to generate a presigned URL for the file specified
+        by the S3 path. The URL is valid for PRESIGNED_URL_EXPIRY seconds (one hour by default)
+        and is reused until PRESIGNED_URL_REFRESH_MARGIN seconds before it expires, so repeated
+        renders give the browser the same URL. The response is marked cacheable for the time the
+        URL is reused. If the credentials are missing or invalid, it logs the error and returns
+        a default image URL.
+
+        We are mostly using this so we can display an image from S3 as the src or an html img tag.
+
+        :param s3path: The S3 path of the file to serve.
+        :return: The presigned URL for the file, or a default image URL if an error occurs.
+        """
+        cached = self.__presigned_urls.get(s3path)
+        if cached is not None and time.time() < cached[1] - PRESIGNED_URL_REFRESH_MARGIN:
+            return cached[0]
+
+        try:
+            expires_at = time.time() + PRESIGNED_URL_EXPIRY
+            cover_image = self.client.generate_presigned_url('get_object',
+                                                Params={'Bucket': self.bucket_name,
+                                                        'Key': s3path,
+                                                        'ResponseCacheControl': "private, max-age={}".format(max(PRESIGNED_URL_EXPIRY-PRESIGNED_URL_REFRESH_MARGIN, 0))},
+                                                ExpiresIn=PRESIGNED_URL_EXPIRY)
+            self.__presigned_urls.put(s3path, (cover_image, expires_at), len(cover_image))
+            return cover_image
+        except botocore.exceptions.NoCredentialsError as e:
+            logging.error("SBDEBUG: NoCredentialsError")
+            logging.error("%s",e)
+            return "assets/eyelogo.png"
+
+    def get_files_in_directory(self, directory_path, max_files=None):
+        """
+        List files in an S3 directory.
+
+        This function uses the S3 client to list files in the specified S3 directory path.
+        It retrieves a paginator to handle large result sets and appends the filenames
+        to a list, which is then returned.
+
+        :param directory_path: The S3 directory path to list files from.
+        :param max_files: Stop after this many files, or None to list everything.
+        :return: A list of filenames in the specified S3 directory.
+        """
+        files = []
+        # list with a trailing slash so that e.g. images/user/proj doesn't also match images/user/proj2
+        prefix = directory_path.rstrip("/")+"/"
+        pagination_config = {}
+        if max_files is not None:
+            pagination_config = {"MaxItems": max_files, "PageSize": min(max_files, 1000)}
+        paginator = self.client.get_paginator('list_objects_v2')
+        result = paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, PaginationConfig=pagination_config)
+        for page in result:
+            for obj in page.get('Contents', []):
+                filename = obj['Key'][len(prefix):]
+                files.append(filename)
+        logging.debug("SBDEBUG: here are the images read from s3"+str(files))
+        return files
+
+    def file_download(self, remote_file, local_file):
+        """
+        Download a file from S3 storage to the local filesystem.
+
+        This function uses the S3 client to download the file specified by the remote
+        S3 path to the local path. If an error occurs during the process, it logs the error.
+
+        :param remote_file: The S3 path of the file to download.
+        :param local_file: The local path where the file will be saved.
+        """
+        try:
+            self.client.download_file(self.bucket_name, remote_file, local_file)
+            logging.debug(f"Successfully downloaded {remote_file} from S3 to {local_file}")
+        except Exception as e:
+            logging.error(f"Error occurred while downloading the file from S3: {e}")
+
+    def open_file(self, s3_path):
+        """
+        Open a file in S3 storage for streaming reads.
+
+        :param s3_path: The S3 path of the file to open.
+        :return: The streaming body of the object, or None if an error occurs.
+        """
+        try:
+            return self.client.get_object(Bucket=self.bucket_name,Key=s3_path)['Body']
+        except Exception as e:
+            logging.debug("Error occurred while opening the file from S3: %s", e)
+            return None
+
+    def write_file_stream(self, s3_path, chunks):
+        """
+        Write a file to S3 storage from an iterable of byte strings.
+
+        The S3 client's managed transfer reads the chunks as it goes and uploads them in parts,
+        and an unfinished upload is aborted, so the object only appears once it is complete.
+
+        :param s3_path: The S3 path where the file will be written.
+        :param chunks: An iterable of byte strings making up the file.
+        """
+        try:
+            # buffered, so every read returns as many bytes as were asked for - the transfer
+            # takes a short read to be a short part, and S3 rejects parts under 5 MiB
+            self.client.upload_fileobj(io.BufferedReader(_ChunkReader(chunks)), self.bucket_name, s3_path)
+        finally:
+            self.__presigned_urls.invalidate(s3_path)
+
+    def delete_file(self, s3_path):
+        """
+        Delete a file from S3 storage.
+
+        :param s3_path: The S3 path of the file to delete.
+        """
+        try:
+            self.client.delete_object(Bucket=self.bucket_name, Key=s3_path)
+        except Exception as e:
+            logging.error("Error occurred while deleting the file from S3: %s", e)
+        self.__presigned_urls.invalidate(s3_path)
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Storage backend that keeps files under the local folder (LOCAL_FOLDER).
+    """
+
+    def full_path(self, file_path):
+        """
+        Get the path of a file on the local filesystem.
+
+        :param file_path: The storage path of the file.
+        :return: The path of the file inside the local folder.
+        """
+        return os.path.join(get_local_folder(),file_path)
+
+    def load_file(self, file_path):
+        """
+        Load a file from the local filesystem.
+
+        This function retrieves the file specified by the file path from the local folder.
+        It reads the file content and returns it. If an error occurs during the process, it logs the error
+        and returns None.
+
+        :param file_path: The path of the file to load from the local filesystem.
+        :return: The file content as bytes, or None if an error occurs.
+        """
+        try:
+            with open(self.full_path(file_path), 'rb') as file:
+                content = file.read()
+            return content
+        except Exception as e:
+            logging.debug("Error occurred while reading the file from the filesystem: %s", e)
+            return None
+
+    def load_file_if_modified(self, file_path, validator):
+        """
+        Load a file from the local filesystem unless its modification time and size still
+        match the cached copy.
+
+        :param file_path: The path of the file to load from the local filesystem.
+        :param validator: The (mtime_ns, size) tuple of the cached copy, or None.
+        :return: A tuple (not_modified, data, validator) - see StorageBackend.load_file_if_modified.
+        """
+        full_path = self.full_path(file_path)
+        try:
+            stat = os.stat(full_path)
+        except OSError as e:
+            logging.debug("Error occurred while reading the file from the filesystem: %s", e)
+            return False, None, None
+        current_validator = (stat.st_mtime_ns, stat.st_size)
+        if validator == current_validator:
+            return True, None, validator
+        return False, self.load_file(file_path), current_validator
+
+    def get_file_version(self, file_path):
+        """
+        Get the modification time and size of a file in the local filesystem.
+
+        :param file_path: The path of the file in the local filesystem.
+        :return: The (mtime_ns, size) tuple, or None if the file doesn't exist or an error occurs.
+        """
+        try:
+            stat = os.stat(self.full_path(file_path))
+        except OSError as e:
+            logging.debug("Error occurred while checking the file in the filesystem: %s", e)
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def write_file(self, file_path, data):
+        """
+        Write a file to the local filesystem.
+
+        This function writes the data to the file specified by the file path in the local folder.
+        It ensures that the directory exists before writing the file. If an error occurs during
+        the process, it logs the error.
+
+        :param file_path: The path where the file will be written in the local filesystem.
+        :param data: The data to be written to the file.
+        """
+        full_path = self.full_path(file_path)
+        try:
+            # Ensure the directory exists
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+            # open the file
+            with open(full_path, "wb") as file:
+                file.write(data)
+        except Exception as e:
+            logging.error("Error occurred while writing the file to the filesystem: %s", e)
+
+    def file_exists(self, file_path):
+        """
+        Check if a file exists in the local filesystem.
+
+        This function checks if the file specified by the file path exists in the local folder.
+
+        :param file_path: The path of the file to check in the local filesystem.
+        :return: True if the file exists, False otherwise.
+        """
+        return os.path.exists(self.full_path(file_path))
+
+    def serve_file(self, file_path):
+        """
+        Serve a file from the local filesystem.
+
+        This function returns the URL of the serve_local_file route (see app/routes.py), which
+        streams the file straight from the local folder. The URL includes the file's modification
+        time, so the browser can cache it until the file is rewritten.
+
+        :param file_path: The path of the file to serve in the local filesystem.
+        :return: The URL to serve the file.
+        """
+        try:
+            version = os.stat(self.full_path(file_path)).st_mtime_ns
+        except OSError:
+            version = None
+        return url_for('serve_local_file', file_path=file_path, v=version, _external=True)
+
+    def get_files_in_directory(self, directory_path, max_files=None):
+        """
+        List files in a local directory.
+
+        This function lists files in the specified local directory path.
+        It walks the directory tree and appends the relative file paths
+        to a list, which is then returned.
+
+        :param directory_path: The local directory path to list files from.
+        :param max_files: Stop after this many files, or None to list everything.
+        :return: A list of filenames in the specified local directory.
+        """
+        full_path = self.full_path(directory_path)
+        files = []
+        try:
+            for root, dirs, filenames in os.walk(full_path):
+                for filename in filenames:
+                    relative_path = os.path.relpath(os.path.join(root, filename), full_path)
+                    files.append(relative_path)
+                    if max_files is not None and len(files) >= max_files:
+                        return files
+        except Exception as e:
+            logging.error("Error occurred while listing files in the local directory: %s", e)
+        logging.debug("SBDEBUG: here are the files read from the local filesystem: " + str(files))
+        return files
+
+    def file_download(self, remote_file, local_file):
+        """
+        Copy a file from the local filesystem to another location in the local filesystem.
+
+        This function copies the file specified by the remote file path to the local path.
+        If an error occurs during the process, it logs the error.
+
+        This function is kinda silly since we don't really need to "download" anything
+        since it is already on the local machine, but we're including it so that all of the
+        UI features work when running locally
+
+        :param remote_file: The path of the file to copy from in the local filesystem.
+        :param local_file: The path where the file will be copied to in the local filesystem.
+        """
+        full_remote_path = self.full_path(remote_file)
+        try:
+            shutil.copy(full_remote_path, local_file)
+            logging.debug(f"Successfully copied {full_remote_path} to {local_file}")
+        except Exception as e:
+            logging.error(f"Error occurred while copying the file from the filesystem: {e}")
+
+    def open_file(self, file_path):
+        """
+        Open a file in the local folder for streaming reads.
+
+        :param file_path: The path of the file to open in the local filesystem.
+        :return: The open file, or None if an error occurs.
+        """
+        try:
+            return open(self.full_path(file_path), 'rb')
+        except Exception as e:
+            logging.debug("Error occurred while opening the file from the filesystem: %s", e)
+            return None
+
+    def write_file_stream(self, file_path, chunks):
+        """
+        Write a file in the local folder from an iterable of byte strings.
+
+        The chunks are written to a temporary file next to the destination, which is then
+        renamed into place.
+
+        :param file_path: The path where the file will be written in the local filesystem.
+        :param chunks: An iterable of byte strings making up the file.
+        """
+        full_path = self.full_path(file_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # each write gets its own temporary file, so concurrent writes to the same path (e.g., from
+        # two worker processes) can't interleave - the last one to finish wins, whole
+        file = tempfile.NamedTemporaryFile(dir=os.path.dirname(full_path), prefix=".", suffix=".part", delete=False)
+        try:
+            with file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(file.name, full_path)
+        finally:
+            if os.path.exists(file.name):
+                os.remove(file.name)
+
+    def delete_file(self, file_path):
+        """
+        Delete a file from the local folder.
+
+        :param file_path: The path of the file to delete in the local filesystem.
+        """
+        try:
+            os.remove(self.full_path(file_path))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error("Error occurred while deleting the file from the filesystem: %s", e)
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Read-only, unseekable file-like view of an iterable of byte strings (for S3's upload_fileobj).
+    """
+    def __init__(self, chunks):
+        self.__chunks = iter(chunks)
+        self.__buffer = b""
+
+    def readable(self):
+        return True
 
-def load_file(path):
-    """
-    Load a file from either S3 or the local filesystem based on the configuration.
+    def readinto(self, buffer):
+        while not self.__buffer:
+            try:
+                self.__buffer = next(self.__chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.__buffer))
+        buffer[:size] = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return size
 
-    This function checks the USE_AWS flag to determine whether to load the file from
-    S3 storage or from the local filesystem. It delegates the loading process to the 
-    appropriate function based on this decision.
 
-    :param path: The path of the file to load.
-    :return: The file content as bytes, or None if an error occurs.
-    """
-    if USE_AWS:
-        return load_file_from_s3(path)
-    else:
-        return load_file_from_filesystem(path)
-    
-def write_file_to_s3(s3_path,data):
-    """
-    Write a file to S3 storage.
+# presigned URLs are small, so this is plenty for hundreds of thousands of objects
+PRESIGNED_URL_CACHE_MAX_BYTES = 64*1024*1024
 
-    This function uses the S3 client to put the file specified by the S3 path into the S3 bucket.
-    If an error occurs during the process, it logs the error.
+# the storage backend is built once per process and shared by every request thread
+_storage_backend = None
+_storage_backend_lock = threading.Lock()
 
-    :param s3_path: The S3 path where the file will be written.
-    :param data: The data to be written to the file.
-    """
-    s3_client = get_s3_client() 
-    _, s3_bucket = get_s3_resource()
-    s3_bucket_name = s3_bucket.name
-    try:
-        s3_client.put_object(Bucket=s3_bucket_name, Key=s3_path, Body=data)
-    except Exception as e:
-        logging.error("Error occurred while writing the file to S3: %s", e)
+# cache of file contents, keyed by path - the values are (validator, bytes) tuples
+file_cache = LRUCache(FILE_CACHE_MAX_BYTES)
 
-       
+# cache of directory listings, keyed by directory path
+listing_cache = ListingCache(LISTING_CACHE_TTL, LISTING_CACHE_MAX_ENTRIES)
 
-def write_file_to_filesystem(file_path,data):
+def get_storage_backend():
     """
-    Write a file to the local filesystem.
+    Get the process-wide storage backend, creating it on first use.
 
-    This function writes the data to the file specified by the file path in the local folder.
-    It ensures that the directory exists before writing the file. If an error occurs during 
-    the process, it logs the error.
+    This function checks the USE_AWS flag to determine whether to build an
+    S3StorageBackend or a LocalStorageBackend. The same object is returned on every
+    later call.
 
-    :param file_path: The path where the file will be written in the local filesystem.
-    :param data: The data to be written to the file.
+    :return: The shared StorageBackend.
     """
-    base_dir = get_local_folder()
-    full_path = os.path.join(base_dir,file_path)
-    try:
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-
-        # open the file
-        with open(full_path, "wb") as file:
-            file.write(data)
-    except Exception as e:
-        logging.error("Error occurred while writing the file to the filesystem: %s", e)
+    global _storage_backend
+    if _storage_backend is None:
+        with _storage_backend_lock:
+            if _storage_backend is None:
+                if USE_AWS:
+                    _storage_backend = S3StorageBackend()
+                else:
+                    _storage_backend = LocalStorageBackend()
+    return _storage_backend
 
 
-def write_file(path,data):
+def load_file_versioned(path):
     """
-    Write a file to either S3 or the local filesystem based on the configuration.
+    Load a file along with a token identifying the version that was loaded.
 
-    This function checks the USE_AWS flag to determine whether to write the file to
-    S3 storage or to the local filesystem. It delegates the writing process to the 
-    appropriate function based on this decision.
+    The version is the storage validator (the ETag on S3, the modification time and size
+    locally), so it changes whenever the file is rewritten. Callers can use it as part of
+    a cache key for anything derived from the file's content.
 
-    :param path: The path where the file will be written.
-    :param data: The data to be written to the file.
-    """
-    if USE_AWS:
-        write_file_to_s3(path,data)
+    :param path: The path of the file to load.
+    :return: A tuple (data, version). Both are None if an error occurs.
+    """
+    cached = file_cache.get(path)
+    cached_validator = cached[0] if cached else None
+    not_modified, data, validator = get_storage_backend().load_file_if_modified(path, cached_validator)
+    if not_modified:
+        return cached[1], cached_validator
+    if data is None or validator is None:
+        file_cache.invalidate(path)
     else:
-        write_file_to_filesystem(path,data)
+        file_cache.put(path, (validator, data), len(data))
+    return data, validator
+
+def load_file(path):
+    """
+    Load a file from either S3 or the local filesystem based on the configuration.
 
+    The content is served from the file cache when storage reports that the file has
+    not changed since it was cached.
 
-def file_exists_in_s3(s3_path):
+    :param path: The path of the file to load.
+    :return: The file content as bytes, or None if an error occurs.
     """
-    Check if a file exists in S3 storage.
+    data, _ = load_file_versioned(path)
+    return data
 
-    This function uses the S3 client to check if the file specified by the S3 path exists in the S3 bucket.
-    It returns True if the file exists, and False if it does not. If an unexpected error occurs, it logs the error
-    and raises an exception.
+def get_file_version(path):
+    """
+    Get a token identifying the current version of a file (as returned by load_file_versioned)
+    without loading it, either from S3 or the local filesystem based on the configuration.
 
-    :param s3_path: The S3 path of the file to check.
-    :return: True if the file exists, False otherwise.
+    :param path: The path of the file.
+    :return: The version, or None if the file doesn't exist or an error occurs.
     """
-    s3_client = get_s3_client() 
-    _, s3_bucket = get_s3_resource()
-    s3_bucket_name = s3_bucket.name
-    try:
-        response = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_path)
-        return True
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            # The object does not exist.
-            return False
-        else:
-            # Something else has gone wrong.
-            logging.error("Unexpected error checking for S3 file: %s", e)
-            raise
+    return get_storage_backend().get_file_version(path)
 
-def file_exists_in_filesystem(file_path):
+def write_file(path,data):
     """
-    Check if a file exists in the local filesystem.
+    Write a file to either S3 or the local filesystem based on the configuration.
 
-    This function checks if the file specified by the file path exists in the local folder.
+    Any cached copy of the file is dropped, and the file is added to any cached
+    listings of the directories it is in.
 
-    :param file_path: The path of the file to check in the local filesystem.
-    :return: True if the file exists, False otherwise.
+    :param path: The path where the file will be written.
+    :param data: The data to be written to the file.
     """
-    base_dir = get_local_folder()
-    full_path = os.path.join(base_dir, file_path)
-    return os.path.exists(full_path)
+    get_storage_backend().write_file(path,data)
+    file_cache.invalidate(path)
+    listing_cache.add_file(path)
 
 def file_exists(path):
     """
     Check if a file exists, either in S3 or the local filesystem based on the configuration.
 
-    This function checks the USE_AWS flag to determine whether to check for the file in
-    S3 storage or in the local filesystem. It delegates the check to the appropriate 
-    function based on this decision.
-
     :param path: The path of the file to check.
     :return: True if the file exists, False otherwise.
     """
-    if USE_AWS:
-        return file_exists_in_s3(path)
-    else:
-        return file_exists_in_filesystem(path)
-    
-def serve_file_in_s3(s3path):
-    """
-    Generate a presigned URL to serve a file from S3 storage.
-
-    This function uses the S3 client to generate a presigned URL for the file specified
-    by the S3 path. The URL is valid for one hour. If the credentials are missing or 
-    invalid, it logs the error and returns a default image URL.
-
-    We are mostly using this so we can display an image from S3 as the src or an html img tag.
-
-    :param s3path: The S3 path of the file to serve.
-    :return: The presigned URL for the file, or a default image URL if an error occurs.
-    """
-    s3_client = get_s3_client() 
-    _, s3_bucket = get_s3_resource()
-    s3_bucket_name = s3_bucket.name
-
-    try:
-        cover_image = s3_client.generate_presigned_url('get_object',
-                                            Params={'Bucket': s3_bucket_name,
-                                                    'Key': s3path},
-                                            ExpiresIn=3600)
-        return cover_image
-    except botocore.exceptions.NoCredentialsError as e:
-        logging.error("SBDEBUG: NoCredentialsError")
-        logging.error("%s",e)
-        return "assets/eyelogo.png"
-
-def serve_file_locally(file_path):
-    """
-    Serve a file from the local filesystem.
-
-    This function copies the file specified by the file path to the static directory so it can
-    be used/displayed from flask. If the directories do not exist, it creates them.
-
-    :param file_path: The path of the file to serve in the local filesystem.
-    :return: The URL to serve the file.
-    """
-    base_dir = get_local_folder()
-    full_path = os.path.join(base_dir,file_path)
-    logging.debug("In serve_file_locally")
-    logging.debug("\tfull_path %s",full_path)
-
-    static_path = os.path.join("app","static",full_path[1:])
-    logging.debug("\tstatic_path %s",static_path)
-
-    dir = os.path.dirname(full_path)
-    logging.debug("\tdir %s",dir)
-
-    static_dir = os.path.dirname(static_path)
-    logging.debug("\tstatic_dir %s",static_dir)
-    
-    # Ensure the directory exists
-    os.makedirs(static_dir, exist_ok=True)
-    shutil.copyfile(full_path, static_path)
-
-    #return static_path 
-    return url_for('static', filename=full_path, _external=True)
+    return get_storage_backend().file_exists(path)
 
 def serve_file(path):
     """
     Serve a file, either from S3 or the local filesystem based on the configuration.
 
-    This function checks the USE_AWS flag to determine whether to serve the file from
-    S3 storage or from the local filesystem. It delegates the serving process to the 
-    appropriate function based on this decision.
-
     :param path: The path of the file to serve.
     :return: The URL to serve the file.
     """
-    if USE_AWS:
-        return serve_file_in_s3(path)
-    else:
-        return serve_file_locally(path)
-    
-
-def get_files_in_s3_prefix(directory_path):
-    """
-    List files in an S3 directory.
-
-    This function uses the S3 client to list files in the specified S3 directory path.
-    It retrieves a paginator to handle large result sets and appends the filenames
-    to a list, which is then returned.
-
-    :param directory_path: The S3 directory path to list files from.
-    :return: A list of filenames in the specified S3 directory.
-    """
-    s3_client = get_s3_client() 
-    _, s3_bucket = get_s3_resource()
-    s3_bucket_name = s3_bucket.name
-    logging.debug("SBDEBUG: inside get_image_names")
-    files = []
-    logging.debug("SBDEBUG: about to connect to s3")
-    paginator = s3_client.get_paginator('list_objects_v2') 
-    logging.debug("SBDEBUG: got the paginator")
-    result = paginator.paginate(Bucket=s3_bucket_name, Prefix=directory_path)
-    for page in result:
-        for obj in page.get('Contents', []):
-            filename = obj['Key'][(len(directory_path)+1):]
-            files.append(filename)
-    logging.debug("SBDEBUG: here are the images read from s3"+str(files))
-    return files
-
-def get_files_in_local_directory(directory_path):
-    """
-    List files in a local directory.
-
-    This function lists files in the specified local directory path.
-    It walks the directory tree and appends the relative file paths
-    to a list, which is then returned.
-
-    :param directory_path: The local directory path to list files from.
-    :return: A list of filenames in the specified local directory.
-    """
-    base_dir = get_local_folder()
-    full_path = os.path.join(base_dir, directory_path)
-    files = []
-    try:
-        for root, dirs, filenames in os.walk(full_path):
-            for filename in filenames:
-                relative_path = os.path.relpath(os.path.join(root, filename), full_path)
-                files.append(relative_path)
-    except Exception as e:
-        logging.error("Error occurred while listing files in the local directory: %s", e)
-    logging.debug("SBDEBUG: here are the files read from the local filesystem: " + str(files))
-    return files
+    return get_storage_backend().serve_file(path)
 
-def get_files_in_directory(directory_path):
+def get_files_in_directory(directory_path, max_files=None):
     """
     List files in a directory, either in S3 or the local filesystem based on the configuration.
 
-    This function checks the USE_AWS flag to determine whether to list files from
-    an S3 directory or a local directory. It delegates the listing process to the 
-    appropriate function based on this decision.
+    Listings are served from the listing cache while they are fresh. Asking for only the
+    first few files (e.g., for a cover image) avoids listing the whole directory.
 
     :param directory_path: The directory path to list files from.
+    :param max_files: Stop after this many files, or None to list everything.
     :return: A list of filenames in the specified directory.
     """
-    if USE_AWS:
-        return get_files_in_s3_prefix(directory_path)
-    else:
-        return get_files_in_local_directory(directory_path)
-    
+    files = listing_cache.get(directory_path, max_files)
+    if files is not None:
+        return files
+    files = get_storage_backend().get_files_in_directory(directory_path, max_files)
+    listing_cache.put(directory_path, files, complete=(max_files is None or len(files) < max_files))
+    return list(files)
 
-def file_download_from_s3(remote_file,local_file):
+def file_download(remote_file, local_file):
     """
-    Download a file from S3 storage to the local filesystem.
-
-    This function uses the S3 client to download the file specified by the remote
-    S3 path to the local path. If an error occurs during the process, it logs the error.
+    Download or copy a file, either from S3 or the local filesystem based on the configuration.
 
-    :param remote_file: The S3 path of the file to download.
-    :param local_file: The local path where the file will be saved.
+    :param remote_file: The path of the file to download or copy.
+    :param local_file: The local path where the file will be saved or copied.
     """
-    s3_client = get_s3_client() 
-    _, s3_bucket = get_s3_resource()
-    s3_bucket_name = s3_bucket.name
-    try:
-        s3_client.download_file(s3_bucket_name, remote_file, local_file)
-        logging.debug(f"Successfully downloaded {remote_file} from S3 to {local_file}")
-    except Exception as e:
-        logging.error(f"Error occurred while downloading the file from S3: {e}")
+    get_storage_backend().file_download(remote_file, local_file)
 
-def file_download_from_filesystem(remote_file, local_file):
-    """
-    Copy a file from the local filesystem to another location in the local filesystem.
 
-    This function copies the file specified by the remote file path to the local path.
-    If an error occurs during the process, it logs the error.
+def open_file(path):
+    """
+    Open a file for streaming reads, either from S3 or the local filesystem based on the configuration.
 
-    This function is kinda silly since we don't really need to "download" anything
-    since it is already on the local machine, but we're including it so that all of the
-    UI features work when running locally
+    This bypasses the file cache, so it is meant for large files that are read once.
 
-    :param remote_file: The path of the file to copy from in the local filesystem.
-    :param local_file: The path where the file will be copied to in the local filesystem.
+    :param path: The path of the file to open.
+    :return: A readable file-like object (the caller closes it), or None if an error occurs.
     """
-    base_dir = get_local_folder()
-    full_remote_path = os.path.join(base_dir, remote_file)
-    try:
-        shutil.copy(full_remote_path, local_file)
-        logging.debug(f"Successfully copied {full_remote_path} to {local_file}")
-    except Exception as e:
-        logging.error(f"Error occurred while copying the file from the filesystem: {e}")
+    return get_storage_backend().open_file(path)
 
-def file_download(remote_file, local_file):
+def write_file_stream(path, chunks):
     """
-    Download or copy a file, either from S3 or the local filesystem based on the configuration.
+    Write a file from an iterable of byte strings, either to S3 or the local filesystem based on the configuration.
 
-    This function checks the USE_AWS flag to determine whether to download the file
-    from S3 storage or copy it from another location in the local filesystem. It delegates
-    the operation to the appropriate function based on this decision.
+    The file is never held in memory or staged on disk as a whole. Errors are raised (see StorageBackend.write_file_stream).
 
-    :param remote_file: The path of the file to download or copy.
-    :param local_file: The local path where the file will be saved or copied.
+    :param path: The path where the file will be written.
+    :param chunks: An iterable of byte strings making up the file.
     """
-    if USE_AWS:
-        file_download_from_s3(remote_file, local_file)
-    else:
-        file_download_from_filesystem(remote_file, local_file)
+    try:
+        get_storage_backend().write_file_stream(path, chunks)
+    finally:
+        file_cache.invalidate(path)
+    listing_cache.add_file(path)
 
+def delete_file(path):
+    """
+    Delete a file, either from S3 or the local filesystem based on the configuration.
 
+    :param path: The path of the file to delete.
+    """
+    get_storage_backend().delete_file(path)
+    file_cache.invalidate(path)
+    listing_cache.remove_file(path)
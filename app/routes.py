@@ -0,0 +1,83 @@
+import os
+from flask import send_file, abort, request
+from werkzeug.security import safe_join
+
+from .config import LOCAL_FILE_MAX_AGE
+from .data import get_user_from_session
+from .resources.local_resources import get_local_folder
+from .resources import open_file
+from .project_models import get_export_job, artifact_is_reusable
+
+# Plain Flask routes that sit next to the Dash app.
+# When running locally (USE_AWS is False), images are displayed through the serve_local_file route,
+# which streams them straight out of LOCAL_FOLDER. This is the local stand-in for presigned S3 URLs.
+# Project downloads are built by background export jobs (whose progress the Files tab polls through a Dash
+# callback), and their finished ZIP files are downloaded through the download_export route.
+
+def register_routes(server):
+
+    @server.route("/files/<path:file_path>")
+    def serve_local_file(file_path):
+        """
+        Stream a file from the local storage folder.
+
+        Files are sent with send_file, so conditional GETs (ETag/Last-Modified) and Range
+        requests are handled for us. URLs made by serve_file carry a "v" query parameter with
+        the file's modification time, so those can be cached by the browser for a long time -
+        a rewritten file gets a new URL.
+
+        Paths look like <kind>/<username>/<project>/<file>, and users can only get their own files.
+
+        :param file_path: The path of the file in local storage.
+        :return: The file response.
+        """
+        username = get_user_from_session()
+        path_parts = file_path.split("/")
+        if username is None or len(path_parts) < 3 or path_parts[1] != username:
+            abort(403)
+
+        # safe_join returns None for anything that would escape the storage folder (.., absolute paths, etc.)
+        full_path = safe_join(os.path.abspath(get_local_folder()), file_path)
+        if full_path is None or not os.path.isfile(full_path):
+            abort(404)
+
+        response = send_file(full_path, conditional=True)
+        response.cache_control.private = True
+        response.cache_control.public = False
+        if request.args.get("v"):
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = LOCAL_FILE_MAX_AGE
+        else:
+            # unversioned URLs can still be revalidated cheaply with If-None-Match/If-Modified-Since
+            response.cache_control.max_age = 0
+            response.cache_control.must_revalidate = True
+        return response
+
+    @server.route("/exports/<export_id>")
+    def download_export(export_id):
+        """
+        Download the ZIP built by a finished export job.
+
+        The file is streamed from storage rather than read into memory first. Downloads that can't be
+        reused any more (older than EXPORT_ARTIFACT_TTL, or made before the project was last saved to)
+        are refused, and are deleted from storage by the export sweep - they have to be exported again.
+
+        :param export_id: The id of the export job.
+        :return: The ZIP file response.
+        """
+        job = _get_user_export(export_id)
+        if not artifact_is_reusable(job):
+            abort(410)
+        artifact = open_file(job["artifact"])
+        if artifact is None:
+            abort(404)
+        return send_file(artifact, mimetype="application/zip", as_attachment=True,
+                         download_name=job["project"]+".zip")
+
+    def _get_user_export(export_id):
+        # users can only see their own exports - anything else looks like it doesn't exist
+        username = get_user_from_session()
+        job = get_export_job(export_id)
+        if username is None or job is None or job["username"] != username:
+            abort(404)
+        return job
@@ -1,7 +1,7 @@
 import cv2
 import numpy as np
 import base64
-from matplotlib.path import Path
+import functools
 import plotly.express as px
 
 def create_mask_from_paths(path_coordinates, img_shape):
@@ -9,46 +9,106 @@ def create_mask_from_paths(path_coordinates, img_shape):
     Create a binary mask from path coordinates.
 
     This function generates a binary mask of the specified image shape, with True values
-    inside the paths defined by the path coordinates.
+    inside the paths defined by the path coordinates. Each path is rasterized separately
+    (see polygon_to_mask) and the results are combined, so a pixel is in the mask if it is
+    inside any of the paths.
 
     :param path_coordinates: A list of path coordinates, where each path is defined by a list of (x, y) tuples.
     :param img_shape: The shape of the image (height, width, channels).
     :return: A binary mask with True values inside the paths.
     """
-    height, width, _ = img_shape
-
-    # Create a meshgrid of (x, y) coordinates
-    x, y = np.meshgrid(np.arange(width),np.arange(height))
-    x, y = x.flatten(), y.flatten()
-
-    # Stack the flattened x and y coordinates into a single array of points
-    # Each point is represented as a (x, y) tuple
-    points = np.vstack((x,y)).T
+    height, width = img_shape[:2]
 
     # Initialize an empty binary mask of the same height and width as the image
     mask = np.zeros((height, width), dtype=bool)
 
-    # Iterate over each set of path coordinates
+    # Iterate over each set of path coordinates, only touching the part of the mask within the path's bounding box
     for path_coords in path_coordinates:
-        # Create a Path object from the path coordinates
-        path = Path(path_coords)
-        # Use the Path object to determine which points are inside the path
-        # Update the mask with True values where points are inside the path
-        mask |= path.contains_points(points).reshape(height, width)
+        polygon_mask = polygon_to_mask(path_coords, height, width)
+        if polygon_mask is not None:
+            (y0, x0), inside = polygon_mask
+            mask[y0:y0+inside.shape[0], x0:x0+inside.shape[1]] |= inside
 
     return mask
 
-def encode_img_for_display(cv2rgbimg):
+def polygon_to_mask(path_coords, height, width):
+    """
+    Rasterize a closed polygon within its bounding box.
+
+    A pixel (x, y) is inside the polygon if a ray from it towards +x crosses the polygon's edges an
+    odd number of times (the even-odd rule), which gives the same pixels as matplotlib's
+    Path.contains_points on the pixel coordinates, including for pixels exactly on an edge.
+    The crossings are worked out one scanline (row of pixels) at a time for all edges at once,
+    so only the polygon's bounding box is ever allocated.
+
+    :param path_coords: The polygon's vertices, as a list of (x, y) tuples. The polygon is closed automatically.
+    :param height: The height of the image.
+    :param width: The width of the image.
+    :return: A tuple of the bounding box's top-left corner (row, column) and a boolean array covering the
+        bounding box that is True inside the polygon, or None if the polygon doesn't cover any pixels.
+    """
+    vertices = np.asarray(path_coords, dtype=float).reshape(-1, 2)
+    vertices = vertices[~np.isnan(vertices).any(axis=1)]
+    if len(vertices) < 3:
+        return None
+
+    # The bounding box of the polygon, clipped to the image
+    x0 = max(int(np.floor(vertices[:, 0].min())), 0)
+    x1 = min(int(np.ceil(vertices[:, 0].max())), width - 1)
+    y0 = max(int(np.floor(vertices[:, 1].min())), 0)
+    y1 = min(int(np.ceil(vertices[:, 1].max())), height - 1)
+    if x0 > x1 or y0 > y1:
+        return None
+    box_height, box_width = y1 - y0 + 1, x1 - x0 + 1
+
+    # Each edge runs from a vertex (start) to the next one (end), with the last edge closing the polygon
+    start_x, start_y = vertices[:, 0], vertices[:, 1]
+    end_x, end_y = np.roll(start_x, -1), np.roll(start_y, -1)
+
+    # An edge crosses a scanline if exactly one of its ends is at or below it (rows x edges)
+    scanlines = np.arange(y0, y1 + 1, dtype=float)[:, None]
+    end_below = end_y >= scanlines
+    rows, edges = np.nonzero((start_y >= scanlines) != end_below)
+
+    # Where each crossing is along the scanline
+    crossing_x = end_x[edges] + ((scanlines[rows, 0] - end_y[edges]) * (start_x[edges] - end_x[edges])) / (start_y[edges] - end_y[edges])
+
+    # Each crossing flips every pixel to its left - pixels exactly on the crossing are flipped for edges
+    # heading up the image and not for edges heading down, the same as matplotlib. Count how many pixels
+    # in the bounding box get flipped by each crossing...
+    flipped = np.where(end_below[rows, edges], np.floor(crossing_x) + 1, np.ceil(crossing_x)) - x0
+    flipped = np.clip(flipped, 0, box_width).astype(np.intp)
+
+    # ...then a pixel is flipped once by every crossing that reaches past it
+    crossings = np.zeros((box_height, box_width + 1), dtype=np.int32)
+    np.add.at(crossings, (rows, flipped), 1)
+    crossings_past = np.cumsum(crossings[:, ::-1], axis=1)[:, ::-1]
+    inside = (crossings_past[:, 1:] & 1).astype(bool)
+
+    return (y0, x0), inside
+
+def encode_img(cv2rgbimg, image_format="png"):
+    """
+    Encode an image as an image file.
+
+    :param cv2rgbimg: The CV2 RGB image to encode.
+    :param image_format: The image format, e.g. "png" (the default), "jpeg", or "webp".
+    :return: The encoded image file as bytes.
+    """
+    _, buffer = cv2.imencode('.'+image_format, cv2rgbimg)
+    return buffer.tobytes()
+
+def encode_img_for_display(cv2rgbimg, image_format="png"):
     """
     Encode an image for display in the application.
 
-    This function encodes a CV2 RGB image as a PNG and then base64 encodes the PNG for display.
+    This function encodes a CV2 RGB image as a PNG (or another format OpenCV can write) and then base64 encodes it for display.
 
     :param cv2rgbimg: The CV2 RGB image to encode.
-    :return: The base64 encoded PNG image as a string.
+    :param image_format: The image format, e.g. "png" (the default), "jpeg", or "webp".
+    :return: The base64 encoded image as a string.
     """
-    _, buffer = cv2.imencode('.png', cv2rgbimg)
-    encoded_image = base64.b64encode(buffer).decode('utf-8')
+    encoded_image = base64.b64encode(encode_img(cv2rgbimg, image_format)).decode('utf-8')
     return encoded_image
 
 
@@ -99,19 +159,23 @@ def create_checkerboard(image_shape, square_size=50):
     Create a checkerboard pattern image to indicate transparent background areas of masks.
 
     This function generates a checkerboard pattern image of the specified shape and square size.
+    Mask cards ask for the same checkerboard over and over, so the patterns are cached by
+    (shape, square size) - the returned array is shared and read-only.
 
     :param image_shape: The shape of the image (rows, cols, channels).
     :param square_size: The size of each square in the checkerboard pattern (default is 50).
     :return: A checkerboard pattern image as a NumPy array.
     """
-    rows, cols, _ = image_shape
-    checkerboard = np.zeros((rows, cols), dtype=np.uint8)
-    for i in range(rows):
-        for j in range(cols):
-            if (i // square_size) % 2 == (j // square_size) % 2:
-                checkerboard[i, j] = 150
-            else:
-                checkerboard[i, j] = 50
+    rows, cols = image_shape[:2]
+    return _cached_checkerboard(int(rows), int(cols), int(square_size))
+
+@functools.lru_cache(maxsize=16)
+def _cached_checkerboard(rows, cols, square_size):
+    # a square is light where its row band and column band have the same parity, dark otherwise
+    row_bands = (np.arange(rows) // square_size) % 2
+    col_bands = (np.arange(cols) // square_size) % 2
+    checkerboard = np.where(row_bands[:, None] == col_bands[None, :], 150, 50).astype(np.uint8)
+    checkerboard.setflags(write=False)
     return checkerboard
 
 def apply_mask_to_image(image, mask, square_size=50):
@@ -119,7 +183,7 @@ def apply_mask_to_image(image, mask, square_size=50):
     Apply a mask to an image and overlay a checkerboard pattern where the mask is False.
 
     This function overlays a checkerboard pattern on the regions of the image where the mask is False.
-    It ensures that the mask is a boolean array and creates a 3-channel checkerboard pattern.
+    It ensures that the mask is a boolean array, and the checkerboard is applied to all 3 channels.
 
     :param image: The original image as a NumPy array.
     :param mask: The binary mask as a NumPy array.
@@ -127,20 +191,84 @@ def apply_mask_to_image(image, mask, square_size=50):
     :return: The image with the checkerboard pattern applied where the mask is False.
     """
     # Ensure the mask is a boolean array
-    mask = mask.astype(bool)
+    mask = np.asarray(mask).astype(bool)
     
     # Create a checkerboard pattern
     checkerboard = create_checkerboard(image.shape, square_size)
     
-    # Create a 3-channel version of the checkerboard pattern
-    checkerboard_rgb = np.stack([checkerboard] * 3, axis=-1)
-    
-    # Overlay the checkerboard pattern on the image where the mask is False
-    masked_image = np.where(mask[..., None], image, checkerboard_rgb)
+    # Overlay the checkerboard pattern on the image where the mask is False (broadcasting it across the channels)
+    masked_image = np.where(mask[..., None], image, checkerboard[..., None])
 
     return masked_image
 
 
+def resize_to_width(image, width):
+    """
+    Shrink an image to a given width, keeping its aspect ratio.
+
+    Images that are already narrower than the width are returned as they are.
+
+    :param image: The image as a NumPy array.
+    :param width: The width to shrink the image to.
+    :return: The resized image.
+    """
+    rows, cols = image.shape[:2]
+    if cols <= width:
+        return image
+    height = max(1, int(round(rows * width / cols)))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+def resize_mask(mask, shape):
+    """
+    Resize a binary mask to a given shape.
+
+    When shrinking, each pixel of the result is True if any of the pixels it covers are True,
+    so small and thin masks don't disappear.
+
+    :param mask: The binary mask as a NumPy array.
+    :param shape: The (height, width) to resize the mask to.
+    :return: The resized mask as a boolean NumPy array.
+    """
+    mask = np.asarray(mask)
+    if mask.shape[:2] == tuple(shape[:2]):
+        return mask.astype(bool)
+    # area averaging in floating point gives each output pixel the fraction of it that is covered
+    # (with integers, a tiny fraction would round down to 0)
+    coverage = cv2.resize(mask.astype(np.float32), (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    return coverage > 0
+
+def create_mask_thumbnail(image, mask, width, thumbnail=None, crop_padding=None, square_size=50):
+    """
+    Render a mask over its image (with the checkerboard where the mask is False) at thumbnail size.
+
+    The image and the mask are shrunk before they are combined, so the work and the result are
+    sized for the thumbnail rather than for the full image. The checkerboard squares are shrunk
+    along with the image, so the thumbnail looks like a scaled-down copy of the full-size version.
+
+    :param image: The original image as a NumPy array.
+    :param mask: The binary mask as a NumPy array (the same height and width as the image).
+    :param width: The width of the thumbnail.
+    :param thumbnail: The image already shrunk with resize_to_width, so a batch of thumbnails only shrinks it once (optional).
+    :param crop_padding: If given, only show the mask's bounding box, with this fraction of its size added as padding on each side.
+    :param square_size: The size of each square in the checkerboard pattern at full size (default is 50).
+    :return: The thumbnail as a NumPy array.
+    """
+    mask = np.asarray(mask).astype(bool)
+    if crop_padding is not None:
+        x, y, w, h = mask_bbox(mask)
+        if w and h:
+            pad_x, pad_y = int(round(w * crop_padding)), int(round(h * crop_padding))
+            x0, y0 = max(x - pad_x, 0), max(y - pad_y, 0)
+            x1, y1 = min(x + w + pad_x, mask.shape[1]), min(y + h + pad_y, mask.shape[0])
+            image, mask = image[y0:y1, x0:x1], mask[y0:y1, x0:x1]
+            thumbnail = None
+    if thumbnail is None:
+        thumbnail = resize_to_width(image, width)
+    thumbnail_mask = resize_mask(mask, thumbnail.shape)
+    thumbnail_square_size = max(1, int(round(square_size * thumbnail.shape[1] / image.shape[1])))
+    return apply_mask_to_image(thumbnail, thumbnail_mask, thumbnail_square_size)
+
+
 def get_cv2_image(filename):
     """
     Read an image using OpenCV.
@@ -190,6 +318,68 @@ def hex_to_rgb(hex_color):
     return [int(hex_color[i:i+2], 16) for i in (0, 2 ,4)]
 
 
+def mask_bbox(segmentation):
+    """
+    Find the bounding box of the True pixels in a mask.
+
+    :param segmentation: The binary mask as a NumPy array.
+    :return: The bounding box as [x, y, width, height] ([0, 0, 0, 0] for an empty mask).
+    """
+    rows = np.flatnonzero(segmentation.any(axis=1))
+    if rows.size == 0:
+        return [0, 0, 0, 0]
+    cols = np.flatnonzero(segmentation.any(axis=0))
+    return [int(cols[0]), int(rows[0]), int(cols[-1]) - int(cols[0]) + 1, int(rows[-1]) - int(rows[0]) + 1]
+
+def build_label_index(layers, shape):
+    """
+    Flatten a stack of masks into a single label-index raster.
+
+    The layers are given from front to back. Each pixel of the raster holds the number of the
+    front-most layer covering it (counting from 1), or 0 if no layer covers it. Each layer only
+    touches the raster within its bounding box, and layers are consumed one at a time, so a
+    generator can decode masks lazily.
+
+    :param layers: An iterable of (segmentation, color, bbox) tuples, front to back. segmentation is a binary
+        mask (a NumPy array or nested list), color is the layer's color (e.g., [R, G, B]), and bbox is
+        [x, y, width, height] or None to work it out from the mask.
+    :param shape: The (height, width) of the raster.
+    :return: A tuple of the label-index raster and the palette, a (layers+1) x 3 uint8 array mapping each
+        label index to its color (index 0 is black).
+    """
+    label_index = np.zeros(shape[:2], dtype=np.uint16)
+    colors = [(0, 0, 0)]
+    for segmentation, color, bbox in layers:
+        segmentation = np.asarray(segmentation, dtype=bool)
+        if bbox is None:
+            bbox = mask_bbox(segmentation)
+        x, y, w, h = (int(v) for v in bbox)
+        colors.append(tuple(color))
+        if not (w and h):
+            continue
+        if len(colors) - 1 > np.iinfo(label_index.dtype).max:
+            label_index = label_index.astype(np.int32)
+        # only claim the pixels that aren't already covered by a layer in front of this one
+        region = label_index[y:y+h, x:x+w]
+        region[segmentation[y:y+h, x:x+w] & (region == 0)] = len(colors) - 1
+    return label_index, np.array(colors, dtype=np.uint8).reshape(-1, 3)
+
+def composite_masks(layers, shape):
+    """
+    Draw a stack of colored masks into a single image.
+
+    This builds the label-index raster (see build_label_index) and then colors it in one pass
+    with a palette lookup, so the cost is one pass over the image plus each mask's bounding box,
+    however many masks there are.
+
+    :param layers: An iterable of (segmentation, color, bbox) tuples, front to back (see build_label_index).
+    :param shape: The (height, width) of the image.
+    :return: The mask image as a height x width x 3 uint8 NumPy array (black where there are no masks).
+    """
+    label_index, palette = build_label_index(layers, shape)
+    return palette[label_index]
+
+
 def make_composite_image(image,mask_image):
     """
     Create a composite image by blending an original image with a mask image.
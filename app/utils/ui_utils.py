@@ -1,17 +1,50 @@
 
 import cv2
+import base64
 from dash import html, dcc
 import dash_bootstrap_components as dbc
 import datetime
 import logging 
-
-from .image_utils import encode_img_for_display, apply_mask_to_image
+import contextvars
+import collections
+import itertools
+import threading
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from .image_utils import encode_img, create_mask_thumbnail, resize_to_width
 from ..project_models import SB_project, SB_project_image
-from ..resources import get_db_item
+from ..resources import get_db_item, batch_get_db_items, write_file, serve_file, get_files_in_directory
+from ..config import COVER_IMAGE_WORKERS, CARD_RENDER_WORKERS, CARD_RENDER_CONCURRENCY, CARD_IMAGE_FORMAT
 
 IMG_WIDTH = 300
 #IMG_HEIGHT = 400
 
+# shared pool for fetching project cover images, so a user with many projects doesn't wait on them one at a time
+cover_image_executor = ThreadPoolExecutor(max_workers=COVER_IMAGE_WORKERS, thread_name_prefix="cover-image")
+
+# shared pool for rendering mask card thumbnails - OpenCV releases the GIL while resizing and encoding,
+# so the cards for an image with many masks are rendered on several cores at once
+card_render_executor = ThreadPoolExecutor(max_workers=CARD_RENDER_WORKERS, thread_name_prefix="card-render")
+
+# bump this when the way mask cards are drawn changes, so thumbnails saved by older code aren't reused
+CARD_RENDER_VERSION = 1
+
+def get_project_classes(username,project_names):
+    """
+    Retrieve the class label records (names and colors) for several of a user's projects at once.
+
+    The records for all of the projects are fetched together with one batch read.
+
+    :param username: The username of the user.
+    :param project_names: A list of project names.
+    :return: A dictionary mapping each project name to its list of class records ({"name":..., "color":[r,g,b]}).
+    """
+    keys = {username+"-"+project_name: project_name for project_name in project_names}
+    db_items = batch_get_db_items(table_name="project-classes",key_name="username-projectname",key_values=list(keys))
+    return {project_name: db_items.get(key, {}).get("classes", []) for key, project_name in keys.items()}
+
 def generate_label_cards(username,project_name):
     """
     Generate label cards for a given project and user.
@@ -24,8 +57,7 @@ def generate_label_cards(username,project_name):
     :return: A list of dbc.Card objects representing the labels.
     """
     # Retrieve label records from the database
-    db_label_records = get_db_item(table_name="project-classes",key_name="username-projectname",key_value=(username+"-"+project_name),default_return={"classes":[]})
-    label_records = db_label_records["classes"]
+    label_records = get_project_classes(username,[project_name])[project_name]
 
     # Iterate over each label record and create a dbc.Card for each label and append into a running list
     label_cards = []
@@ -37,7 +69,7 @@ def generate_label_cards(username,project_name):
         label_cards.append(label_card)
     return label_cards
 
-def create_mask_cards(img, masks, labels, label_options = ["unlabeled"], new_masks=False, index_offset = 0):
+def create_mask_cards(img, masks, labels, label_options = ["unlabeled"], new_masks=False, index_offset = 0, crop_padding = None, thumbnails_dir = None, mask_hashes = None, image_hash = None):
     """
     Create mask cards for displaying image masks with label options.
 
@@ -50,10 +82,14 @@ def create_mask_cards(img, masks, labels, label_options = ["unlabeled"], new_mas
     :param label_options: A list of label options for the dropdowns (default is ["unlabeled"]).
     :param new_masks: A flag indicating whether the masks are new (default is False).
     :param index_offset: An offset for the mask indices (default is 0).
+    :param crop_padding: If given, each card only shows its mask's bounding box, padded by this fraction of its size (default is None - show the whole image).
+    :param thumbnails_dir: The directory in file storage to keep the card thumbnails in, for masks that have been saved (default is None - send the thumbnails inline).
+    :param mask_hashes: A hash of each mask's content (see SB_project_image.mask_hashes), used to name the stored thumbnails. Needed with thumbnails_dir.
+    :param image_hash: The content hash of the image (see SB_project_image.get_image_hash), so thumbnails aren't reused if the image is replaced. Needed with thumbnails_dir.
     :return: A list of dbc.Card objects representing the masks with label options.
     """
-    # Convert the image from BGR to RGB color space
-    image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    # Render the card images in the background while the cards are put together
+    card_images = _render_card_images(img, masks, crop_padding, thumbnails_dir, mask_hashes, image_hash)
 
     # Define ID types for the different components based on whether the masks are new
     id_type = "label-dropdown"
@@ -82,7 +118,7 @@ def create_mask_cards(img, masks, labels, label_options = ["unlabeled"], new_mas
     for idx in range(len(masks)):
         label_idx = idx+index_offset
         curr_card = html.Div([
-            html.Img(src='data:image/png;base64,{}'.format(encode_img_for_display(apply_mask_to_image(image,masks[idx]["segmentation"]))),width=IMG_WIDTH),
+            html.Img(src=next(card_images),width=IMG_WIDTH),
             dbc.Button(html.I(className="bi bi-box-arrow-in-up-left"),color="secondary",id={'type':front_button_id_type,'index':label_idx},style={"float":"left"}),
             dbc.Button(html.I(className="bi bi-pencil-fill"),color="info",id={'type':edit_button_id_type,'index':label_idx},style={"float":"left"}),
             dbc.Button(html.I(className="bi bi-backspace"),color="danger",id={'type':delete_button_id_type,'index':label_idx},style={"float":"left"}),
@@ -99,6 +135,70 @@ def create_mask_cards(img, masks, labels, label_options = ["unlabeled"], new_mas
 
 
 
+def _render_card_images(img, masks, crop_padding=None, thumbnails_dir=None, mask_hashes=None, image_hash=None):
+    """
+    Render the thumbnails for a batch of mask cards on the card render pool, yielding them in order.
+
+    At most CARD_RENDER_CONCURRENCY cards from this batch are being rendered (or waiting to be
+    yielded) at any time, so one image with many masks can't take over the whole pool.
+
+    With a thumbnails_dir, each thumbnail is saved in file storage under a name made from the
+    mask's hash, the image's hash, and the render settings, and the card gets the file's URL. Thumbnails that are
+    already there aren't rendered again (and their masks aren't even decoded), so reopening an
+    image, or reloading it after a save that didn't change its masks, costs next to nothing.
+    Without one, the thumbnails are sent inline as data URIs.
+
+    :param img: The original image as a NumPy array.
+    :param masks: A list of masks (dictionaries with a "segmentation" entry).
+    :param crop_padding: If given, only show each mask's bounding box, padded by this fraction of its size.
+    :param thumbnails_dir: The directory in file storage to keep the thumbnails in, or None.
+    :param mask_hashes: A hash of each mask's content, or None.
+    :param image_hash: The content hash of the image, or None.
+    :return: A generator of image URLs (or data URIs), one per mask.
+    """
+    stored_thumbnails = None
+    if thumbnails_dir is not None and mask_hashes is not None and image_hash is not None:
+        stored_thumbnails = set(get_files_in_directory(thumbnails_dir))
+        render_settings = json.dumps([CARD_RENDER_VERSION, image_hash, IMG_WIDTH, crop_padding, CARD_IMAGE_FORMAT])
+        settings_key = hashlib.sha256(render_settings.encode("utf-8")).hexdigest()[:12]
+
+    # The cards are shown IMG_WIDTH pixels wide, so the image is shrunk to that size once (the first
+    # time a card actually needs rendering) and each mask is shrunk to match it before being drawn and encoded
+    thumbnail = []
+    thumbnail_lock = threading.Lock()
+
+    def get_thumbnail():
+        with thumbnail_lock:
+            if not thumbnail:
+                thumbnail.append(resize_to_width(img, IMG_WIDTH))
+            return thumbnail[0]
+
+    def render(idx):
+        thumbnail_path = None
+        if stored_thumbnails is not None:
+            thumbnail_name = mask_hashes[idx]+"_"+settings_key+"."+CARD_IMAGE_FORMAT
+            thumbnail_path = thumbnails_dir+"/"+thumbnail_name
+            if thumbnail_name in stored_thumbnails:
+                return thumbnail_path, None
+        card_image = create_mask_thumbnail(img,masks[idx]["segmentation"],IMG_WIDTH,thumbnail=get_thumbnail(),crop_padding=crop_padding)
+        encoded_image = encode_img(cv2.cvtColor(card_image, cv2.COLOR_BGR2RGB), CARD_IMAGE_FORMAT)
+        if thumbnail_path is not None:
+            write_file(thumbnail_path, encoded_image)
+            return thumbnail_path, None
+        return None, 'data:image/{};base64,{}'.format(CARD_IMAGE_FORMAT, base64.b64encode(encoded_image).decode('utf-8'))
+
+    pending = collections.deque()
+    indices = iter(range(len(masks)))
+    for idx in itertools.islice(indices, max(CARD_RENDER_CONCURRENCY, 1)):
+        pending.append(card_render_executor.submit(render, idx))
+    while pending:
+        thumbnail_path, data_uri = pending.popleft().result()
+        for idx in itertools.islice(indices, 1):
+            pending.append(card_render_executor.submit(render, idx))
+        # URLs are made here rather than in the workers, since serving local files needs the request context
+        yield serve_file(thumbnail_path) if thumbnail_path is not None else data_uri
+
+
 def populate_project_cards(username):
     """
     Populate project cards for a given user.
@@ -120,12 +220,15 @@ def populate_project_cards(username):
     curr_projects = db_results["projects"]
     #print("CURR PROJECTS:",curr_projects)
 
+    # Fetch the cover images for all of the projects at once - each one may need a listing, a thumbnail, and a presigned URL.
+    # Each task runs in a copy of this request's context so that url_for still works in the worker threads.
+    cover_image_futures = [cover_image_executor.submit(contextvars.copy_context().run, SB_project(username,proj).get_cover_image_url) for proj in curr_projects]
+
     # Iterate over each project
-    for proj in curr_projects:
+    for proj, cover_image_future in zip(curr_projects, cover_image_futures):
         
-        sb_project = SB_project(username,proj)
         logging.debug("SBDEBUG: about to create a project card")
-        cover_image_url = sb_project.get_cover_image_url()
+        cover_image_url = cover_image_future.result()
         logging.debug("SBDEBUG: sb_project.get_cover_image_url() - %s",cover_image_url)
 
         # Create a Dash Bootstrap Card for the project
@@ -165,16 +268,20 @@ def populate_files(username,project_name):
     # Get the list of image filenames for the project
     filelist = project_object.get_image_names()
     
+    # Look up which files have masks and segmented images all at once
+    file_statuses = project_object.get_image_statuses(filelist)
+
     for file_idx in range(len(filelist)):
         file = SB_project_image(username,project_name,filelist[file_idx])
+        file_status = file_statuses[filelist[file_idx]]
         item_color = None
 
         # Check if the file has masks (it's "ready") and set item color to primary if true
-        if file.has_masks():
+        if file_status["has_masks"]:
             item_color = "primary"
 
         # Check if the file has segmented images (it's "done") and set item color to success if true
-        if file.has_segmented_image():
+        if file_status["has_segmented_image"]:
             item_color = "success"
 
         image_list.append(dbc.ListGroupItem(dbc.Row([
@@ -198,8 +305,7 @@ def get_label_options(username,project):
     :param project: The name of the project.
     :return: A list of label names.
     """
-    classes_from_db = get_db_item(table_name="project-classes",key_name="username-projectname",key_value=(username+"-"+project),default_return={"classes":[]})
-    classes_list = classes_from_db["classes"]
+    classes_list = get_project_classes(username,[project])[project]
 
     # they all have a name and a color, but we just need the names in this function
     label_options = [n['name'] for n in classes_list]
@@ -218,8 +324,7 @@ def get_label_colors_dict(username,project):
     :return: A dictionary mapping label names to RGB color tuples.
     """
     label_colors_dict = {}
-    classes_from_db = get_db_item(table_name="project-classes",key_name="username-projectname",key_value=(username+"-"+project),default_return={"classes":[]})
-    classes_list = classes_from_db["classes"]
+    classes_list = get_project_classes(username,[project])[project]
 
     # Populate the dictionary with label names and their corresponding color tuples
     for entry in classes_list:
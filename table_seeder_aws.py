@@ -99,6 +99,25 @@ create_table(
     ]
 )
 
+# Create 'exports' table - selections of files for project downloads
+create_table(
+    table_name='exports',
+    key_schema=[
+        {
+            'AttributeName': 'export_id',
+            'KeyType': 'HASH'  # Partition key
+        }
+    ],
+    attribute_definitions=[
+        {
+            'AttributeName': 'export_id',
+            'AttributeType': 'S'
+        }
+    ],
+    read_capacity=1,
+    write_capacity=1
+)
+
 # Print table status
 def print_table_status(table_name):
     try:
@@ -109,6 +128,6 @@ def print_table_status(table_name):
         print(f"Error loading table status for {table_name}: {str(e)}")
 
 # Print the status of all tables
-table_names = ['users', 'projects', 'project-classes', 'flask_sessions']
+table_names = ['users', 'projects', 'project-classes', 'flask_sessions', 'exports']
 for table_name in table_names:
     print_table_status(table_name)
\ No newline at end of file
@@ -9,7 +9,8 @@ def initialize_local_db():
         initial_data = {
             "users": {"local_user":{"password":generate_password_hash("password")}},
             "projects": {"local_user":{"projects":[]}},
-            "project-classes": {}
+            "project-classes": {},
+            "exports": {}
         }
         # Write the initial structure to the local DB file
         with open("local_db.json", 'w') as db_file:
@@ -0,0 +1,74 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+from matplotlib.path import Path
+
+# image_utils only needs numpy and OpenCV, so it is loaded straight from its file - importing it
+# through the app package would build the whole Flask/Dash application
+_spec = importlib.util.spec_from_file_location(
+    "image_utils", os.path.join(os.path.dirname(__file__), "..", "app", "utils", "image_utils.py"))
+image_utils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(image_utils)
+
+
+def contains_points_mask(path_coordinates, img_shape):
+    """
+    The original implementation of create_mask_from_paths: matplotlib's Path.contains_points over every pixel.
+    """
+    height, width = img_shape[:2]
+    x, y = np.meshgrid(np.arange(width), np.arange(height))
+    points = np.vstack((x.flatten(), y.flatten())).T
+    mask = np.zeros((height, width), dtype=bool)
+    for path_coords in path_coordinates:
+        mask |= Path(path_coords).contains_points(points).reshape(height, width)
+    return mask
+
+
+def random_paths(rng, width, height, integer_vertices):
+    paths = []
+    for _ in range(rng.integers(1, 4)):
+        # up to 12 random vertices are usually self-intersecting, and some fall off the image
+        num_vertices = int(rng.integers(1, 13))
+        vertices = rng.uniform(-10, max(width, height) + 10, (num_vertices, 2))
+        if integer_vertices:
+            # vertices on the pixel grid put edges and vertices exactly on pixel centers
+            vertices = np.round(vertices)
+        paths.append([tuple(vertex) for vertex in vertices])
+    return paths
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_create_mask_from_paths_matches_contains_points(seed):
+    rng = np.random.default_rng(seed)
+    img_shape = (int(rng.integers(1, 70)), int(rng.integers(1, 70)), 3)
+    paths = random_paths(rng, img_shape[1], img_shape[0], integer_vertices=(seed % 2 == 0))
+    np.testing.assert_array_equal(image_utils.create_mask_from_paths(paths, img_shape),
+                                  contains_points_mask(paths, img_shape))
+
+
+@pytest.mark.parametrize("paths", [
+    # axis-aligned square with its edges on pixel centers
+    [[(0, 0), (10, 0), (10, 10), (0, 10)]],
+    # the same square, clockwise
+    [[(0, 10), (10, 10), (10, 0), (0, 0)]],
+    # bow tie (self-intersecting)
+    [[(2, 2), (18, 14), (18, 2), (2, 14)]],
+    # pentagram - the center is outside under the even-odd rule
+    [[(10, 0), (16, 19), (0, 7), (20, 7), (4, 19)]],
+    # polygon hanging off every side of the image
+    [[(-5, -5), (30, -3), (25, 30), (-8, 22)]],
+    # polygon entirely outside the image
+    [[(40, 40), (50, 40), (45, 50)]],
+    # degenerate paths: a point, a line, and a zero-area triangle
+    [[(5, 5)], [(1, 1), (9, 9)], [(0, 0), (5, 5), (10, 10)]],
+    # overlapping paths are combined, not XORed
+    [[(0, 0), (12, 0), (12, 12), (0, 12)], [(6, 6), (18, 6), (18, 18), (6, 18)]],
+    # fractional vertices like the ones Plotly sends
+    [[(3.5, 1.25), (17.75, 4.5), (12.2, 18.9), (1.1, 11.6)]],
+])
+def test_create_mask_from_paths_edge_cases(paths):
+    img_shape = (20, 20, 3)
+    np.testing.assert_array_equal(image_utils.create_mask_from_paths(paths, img_shape),
+                                  contains_points_mask(paths, img_shape))